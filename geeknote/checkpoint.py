@@ -0,0 +1,158 @@
+"""
+checkpoint, quarantine and manifest of .enex imports, kept per notebook in a state directory
+
+a checkpoint is saved after each committed batch of notes (tag changes
+flushed), it records the .enex (path, size, mtime), the ordinal and byte
+offset (see enexindex) of the next note to import and the latest note update
+seen so far; an import resumed from it skips the notes before. the
+checkpoint is dropped when the import completes, and ignored if the .enex
+changed since
+
+    <notebook>.checkpoint.json   {"File": .., "Size": .., "Mtime": .., "Ordinal": .., "Offset": .., "LastUpdate": .., "Saved": ..}
+    <notebook>.quarantine.jsonl  one line per failed note: {"File": .., "Ordinal": .., "Offset": .., "Length": .., "Title": .., "Error": .., "Failed": ..}
+
+quarantined notes stay listed until a retry imported them
+
+the manifest lists the notes imported so far with updated and content hash
+(as recorded in the .enex index), notes of the next export matching it are
+skipped without being parsed
+
+    <notebook>.manifest.json     {"<title>\\n<created>": {"Updated": .., "Hash": ..}, ..}
+"""
+
+import os
+import json
+from datetime import datetime
+
+from slugify import slugify
+from jsonfile import read_json, write_json, write_jsonl
+
+import logging
+logger = logging.getLogger("en2mongo.checkpoint")
+
+
+class ImportCheckpoint:
+    """ checkpoint and quarantine list for import of enex_path into notebook """
+
+    def __init__(self, state_dir, enex_path, notebook_name):
+        self.state_dir = state_dir
+        self.enex_path = os.path.abspath(enex_path)
+        name = slugify(notebook_name) or 'default'
+        self.path = os.path.join(state_dir, name + '.checkpoint.json')
+        self.quarantine_path = os.path.join(state_dir, name + '.quarantine.jsonl')
+
+    def _enex_info(self):
+        stat = os.stat(self.enex_path)
+        return {"File": self.enex_path, "Size": stat.st_size, "Mtime": int(stat.st_mtime)}
+
+    def load(self):
+        """ checkpoint info for the current .enex, None if there is none (or stale) """
+        info = read_json(self.path)
+        if info is None:
+            return None
+        enex_info = self._enex_info()
+        if any(info.get(key) != value for key, value in enex_info.items()):
+            logger.warning("ignore checkpoint %s, saved for other version of %s", self.path, self.enex_path)
+            return None
+        return info
+
+    def save(self, ordinal, offset, last_update):
+        """ record that notes before ordinal (at byte offset) are imported """
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        info = self._enex_info()
+        info.update({
+            "Ordinal": ordinal,
+            "Offset": offset,
+            "LastUpdate": last_update.isoformat() if last_update else None,
+            "Saved": datetime.utcnow().isoformat(),
+        })
+        write_json(self.path, info)
+
+    def clear(self):
+        for path in (self.path, self.path + '.part'):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def quarantine(self, ordinal, entry, title, error):
+        """ record note that failed to import, entry as of enexindex """
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        info = {
+            "File": self.enex_path,
+            "Ordinal": ordinal,
+            "Offset": entry['offset'],
+            "Length": entry['length'],
+            "Title": title,
+            "Error": "%s: %s" % (error.__class__.__name__, error),
+            "Failed": datetime.utcnow().isoformat(),
+        }
+        quarantined = self._read_quarantine()
+        if any(self._is_note(other, ordinal, entry['offset']) for other in quarantined):
+            # failed again (retry), replace the entry
+            write_jsonl(self.quarantine_path, [other for other in quarantined
+                                               if not self._is_note(other, ordinal, entry['offset'])] + [info])
+            return
+        with open(self.quarantine_path, 'a') as quarantine_file:
+            quarantine_file.write(json.dumps(info) + '\n')
+
+    def _is_note(self, info, ordinal, offset):
+        return info["File"] == self.enex_path and info["Ordinal"] == ordinal and info["Offset"] == offset
+
+    def _read_quarantine(self):
+        if not os.path.isfile(self.quarantine_path):
+            return []
+        with open(self.quarantine_path, 'r') as quarantine_file:
+            return [json.loads(line) for line in quarantine_file if line.strip()]
+
+    def quarantined(self):
+        """ list of quarantined notes of the current .enex """
+        return [info for info in self._read_quarantine() if info["File"] == self.enex_path]
+
+    def release(self, notes):
+        """ remove notes, (ordinal, entry) pairs imported by a retry, from the quarantine list """
+        done = set((ordinal, entry['offset']) for ordinal, entry in notes)
+        if not done:
+            return
+        quarantined = self._read_quarantine()
+        kept = [info for info in quarantined
+                if info["File"] != self.enex_path or (info["Ordinal"], info["Offset"]) not in done]
+        if len(kept) != len(quarantined):
+            write_jsonl(self.quarantine_path, kept)
+
+
+class ImportManifest:
+    """ notes imported into notebook, by title and created (as in .enex index entries) """
+
+    def __init__(self, state_dir, notebook_name):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, (slugify(notebook_name) or 'default') + '.manifest.json')
+        self.notes = read_json(self.path, {})
+
+    @staticmethod
+    def key(entry):
+        return u'%s\n%s' % (entry['title'] or u'', entry['created'] or u'')
+
+    def unchanged(self, entry):
+        """ check if note of index entry was imported with same updated and content """
+        info = self.notes.get(self.key(entry))
+        return info is not None and entry['hash'] is not None and \
+            info["Updated"] == entry['updated'] and info["Hash"] == entry['hash']
+
+    def add(self, entry):
+        self.notes[self.key(entry)] = {"Updated": entry['updated'], "Hash": entry['hash']}
+
+    def discard(self, entry):
+        self.notes.pop(self.key(entry), None)
+
+    def prune(self, entries):
+        """ forget notes not in entries (no longer in .enex) """
+        keys = set(self.key(entry) for entry in entries)
+        for key in list(self.notes):
+            if key not in keys:
+                del self.notes[key]
+
+    def save(self):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        write_json(self.path, self.notes)
@@ -103,10 +103,28 @@ DB_URI = os.environ.get('DB_URI')
 DB_NAME = os.environ.get('DB_NAME')
 DB_USERNAME = os.environ.get('DB_USERNAME')
 
+# image store for leanote files: ftp, local (IMAGE_STORE_DIR is leanote's base dir containing files/) or gridfs
+IMAGE_STORE = os.environ.get('IMAGE_STORE') or 'ftp'
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR')
+IMAGE_STORE_GRIDFS = os.environ.get('IMAGE_STORE_GRIDFS') or 'fs'
+# optional image variants (requires Pillow), e.g. "web:1600,thumb:240" for name:max width/height
+IMAGE_VARIANTS = os.environ.get('IMAGE_VARIANTS')
+IMAGE_VARIANT_PROCESSES = int(os.environ.get('IMAGE_VARIANT_PROCESSES') or 0) or None  # default: cpu count
+
 # ftp to leanote file storage
 FTP_HOST = os.environ.get('FTP_HOST')
+FTP_PORT = int(os.environ.get('FTP_PORT') or 21)
 FTP_USER = os.environ.get('FTP_USER')
 FTP_PWD = os.environ.get('FTP_PWD')
+FTP_CONNECTIONS = int(os.environ.get('FTP_CONNECTIONS') or 4)  # parallel image uploads
+
+# durable local queue of image uploads, drained in background while notes get processed;
+# files entries are written once queued, see utils/upload_queue.py for failed uploads
+UPLOAD_QUEUE = os.environ.get('UPLOAD_QUEUE', '0') == '1'
+UPLOAD_QUEUE_DIR = os.environ.get('UPLOAD_QUEUE_DIR') or os.path.join(APP_DIR, 'upload_queue')
+
+# enex2mongo checkpoints (for --resume) and quarantined notes, per notebook
+IMPORT_STATE_DIR = os.environ.get('IMPORT_STATE_DIR') or os.path.join(APP_DIR, 'import_state')
 
 # gsyncm
 LAST_UPDATE_FN = "gsyncm_last.json"
\ No newline at end of file
@@ -18,9 +18,19 @@ TODO:
 import sys
 import os
 import argparse
-from enexparser import EnexParser
-from updatenote import UpdateNote
+import multiprocessing
+from itertools import izip
+from collections import Counter
+from enexindex import EnexIndex
+from checkpoint import ImportCheckpoint, ImportManifest
+from enexparser import parse_date, EPOCH, list_enex_files, enex_name
+from updatenote import UpdateNote, TAG_FLUSH_INTERVAL
+from tagregistry import ensure_indexes
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
 from datetime import datetime
+import dateutil.parser
+import pytz
 import json
 import logging
 import config
@@ -51,70 +61,262 @@ def setup_logger(logname):
 
 logger = setup_logger("en2mongo")
 
+CHECKPOINT_INTERVAL = TAG_FLUSH_INTERVAL  # notes per batch, tag changes are written with the checkpoint
+
 
 def get_argparse():
     parser = argparse.ArgumentParser()
-    parser.add_argument('input', help='enex file to import from')
+    parser.add_argument('input', help='enex file (.enex, .enex.gz, .enex.zst) or directory to import from')
     parser.add_argument('--tag', '-t', action='store', help='tag to apply additionally to all notes')
     parser.add_argument('--notebook', '-n', action='store', help='notebook name')
+    parser.add_argument('--verify', action='store_true', help='check size of stored images instead of trusting files collection')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='import .enex files of directory in N processes')
+    parser.add_argument('--title', action='append',
+                        help='import only notes with this title (repeatable), looked up in .enex.idx index')
+    parser.add_argument('--resume', action='store_true', help='skip notes imported before checkpoint of previous run')
+    parser.add_argument('--retry-quarantined', action='store_true', help='import only notes that failed before')
+    parser.add_argument('--full', action='store_true', help='import all notes, also those unchanged since last import '
+                        '(notes deleted in mongodb since are imported again anyway)')
     return parser
 
 
-def update_notebook(enex_path, notebook_name):
-    updater = UpdateNote(notebook_name)
-    enex_parser = EnexParser(enex_path)
+def select_entries(entries, checkpoint, titles=None, resume=False, retry_quarantined=False):
+    """ select (ordinal, index entry) pairs to import, return them and last_update of a resumed import """
+    last_update = None
+    if titles:
+        titles = set(title if isinstance(title, unicode) else title.decode('utf-8') for title in titles)
+        entries = [(ordinal, entry) for ordinal, entry in entries if entry['title'] in titles]
+    elif retry_quarantined:
+        quarantined = set((info['Ordinal'], info['Offset']) for info in checkpoint.quarantined())
+        entries = [(ordinal, entry) for ordinal, entry in entries if (ordinal, entry['offset']) in quarantined]
+    elif resume:
+        state = checkpoint.load()
+        if state is None:
+            logger.info("no checkpoint for %s, import all notes", checkpoint.enex_path)
+        else:
+            entries = [(ordinal, entry) for ordinal, entry in entries if entry['offset'] >= state['Offset']]
+            if entries and entries[0][0] != state['Ordinal']:
+                logger.warning("checkpoint at note %s, but found note %s at byte offset %s",
+                               state['Ordinal'], entries[0][0], state['Offset'])
+            logger.info("resume import of %s at note %s (byte offset %s)",
+                        checkpoint.enex_path, state['Ordinal'], state['Offset'])
+            if state['LastUpdate']:
+                last_update = dateutil.parser.parse(state['LastUpdate']).astimezone(pytz.utc)
+    return entries, last_update
+
+
+def skip_unchanged(entries, manifest, all_entries, existing_notes=None):
+    """ drop entries of notes in manifest, return changed entries and latest update of the unchanged
+
+    existing_notes (see UpdateNote) checks if the unchanged notes are still in
+    mongodb, notes deleted or purged since are imported again
+    """
+    keys = Counter(manifest.key(entry) for entry in all_entries)
+    changed = []
+    unchanged = []
+    for ordinal, entry in entries:
+        if keys[manifest.key(entry)] == 1 and manifest.unchanged(entry):
+            unchanged.append((ordinal, entry))
+        else:
+            changed.append((ordinal, entry))
+
+    if unchanged and existing_notes is not None:
+        exists = existing_notes([(entry['title'], parse_date(entry['created'] or EPOCH)) for _, entry in unchanged])
+        missing = [pair for pair, present in izip(unchanged, exists) if not present]
+        if missing:
+            logger.info("import %s unchanged notes again, no longer in mongodb (deleted or purged)", len(missing))
+            for ordinal, entry in missing:
+                logger.debug(u"note %s '%s' no longer in mongodb", ordinal, entry['title'])
+                manifest.discard(entry)
+            unchanged = [pair for pair, present in izip(unchanged, exists) if present]
+            changed = sorted(changed + missing, key=lambda pair: pair[0])
+
+    last_update = None
+    for ordinal, entry in unchanged:
+        updated = parse_date(entry['updated'] or EPOCH)
+        if last_update is None or updated > last_update:
+            last_update = updated
+    return changed, last_update
+
+
+def update_notebook(enex_path, notebook_name, verify_images=False, titles=None, resume=False,
+                    retry_quarantined=False, full=False):
+    """ import notes of .enex into notebook, return latest note update
+
+    notes that fail to import are quarantined, a checkpoint is saved after
+    each batch (unless only given titles or quarantined notes are imported).
+    notes unchanged since imported before (see manifest) are skipped unless full
+    """
+    updater = UpdateNote(notebook_name, verify_images=verify_images)
+    try:
+        return _update_notebook(updater, enex_path, notebook_name, titles, resume, retry_quarantined, full)
+    finally:
+        updater.close()
+
+
+def _update_notebook(updater, enex_path, notebook_name, titles, resume, retry_quarantined, full):
+    enex_index = EnexIndex(enex_path)
+    checkpoint = ImportCheckpoint(config.IMPORT_STATE_DIR, enex_path, notebook_name)
+    partial = bool(titles or retry_quarantined)
+    manifest = ImportManifest(config.IMPORT_STATE_DIR, notebook_name)
+    all_entries = enex_index.load()
+    entries, last_update = select_entries(
+        list(enumerate(all_entries)), checkpoint, titles, resume, retry_quarantined)
+    if last_update is None:
+        last_update = datetime(1970, 01, 01, tzinfo=pytz.utc)
+    if not partial and not full:
+        selected = len(entries)
+        entries, last_update_unchanged = skip_unchanged(entries, manifest, all_entries, updater.existing_notes)
+        if last_update_unchanged is not None:
+            last_update = max(last_update, last_update_unchanged)
+        logger.info("skip %s notes unchanged since last import (see manifest in %s, --full imports them)",
+                    selected - len(entries), config.IMPORT_STATE_DIR)
+    logger.info("import %s of %s notes of %s", len(entries), len(all_entries), enex_path)
+
     note_count = 0
-    last_update = datetime(1970, 01, 01)
-    for note in enex_parser.parse():
-        # add or update note in mongodb
-        updater.update(note)
-        note_count += 1
-        if note.updated > last_update:
-            last_update = note.updated
+    failed = 0
+    retried = []  # imported quarantined notes, removed from the list with each batch
+    # the index selects the notes, these are parsed streaming (see enexindex, enexparser.NoteTarget)
+    notes = enex_index.parse_entries([entry for ordinal, entry in entries])
+    for processed, ((ordinal, entry), (_, note, error)) in enumerate(izip(entries, notes), 1):
+        try:
+            if error is not None:
+                raise error
+            # add or update note in mongodb
+            updater.update(note)
+        except ConnectionFailure:
+            raise  # all further notes would fail as well, resume later
+        except Exception as err:
+            logger.exception(u"failed to import note %s '%s' of %s, quarantined - %s",
+                             ordinal, entry['title'], notebook_name, err)
+            checkpoint.quarantine(ordinal, entry, entry['title'], err)
+            manifest.discard(entry)
+            failed += 1
+        else:
+            note_count += 1
+            manifest.add(entry)
+            if retry_quarantined:
+                retried.append((ordinal, entry))
+            if note.updated > last_update:
+                last_update = note.updated
+        if processed % CHECKPOINT_INTERVAL == 0:
+            updater.flush()
+            manifest.save()
+            checkpoint.release(retried)
+            retried = []
+            if not partial:
+                checkpoint.save(ordinal + 1, entry['offset'] + entry['length'], last_update)
+    updater.finish()
+    if not partial:
+        manifest.prune(all_entries)
+    manifest.save()
+    checkpoint.release(retried)
+    if not partial:
+        checkpoint.clear()
+    if failed:
+        logger.warning("%s notes of notebook %s quarantined, see %s", failed, notebook_name, checkpoint.quarantine_path)
     logger.info("total %s notes for notebook %s last_update=%s", note_count, notebook_name, last_update)
     return last_update
 
 
+def import_notebook(job):
+    """ import one .enex file in worker process, return (notebook name, last_update, error) """
+    enex_path, notebook_name, options = job
+    try:
+        return notebook_name, update_notebook(enex_path, notebook_name, **options), None
+    except Exception as err:
+        logger.exception("enex2mongo failed syncing %s - %s", notebook_name, err)
+        return notebook_name, None, "%s: %s" % (err.__class__.__name__, err)
+
+
+def import_parallel(jobs, processes):
+    """ import notebooks in parallel processes, return latest last_update, raise if any failed """
+    # USNs are allocated atomically, tag counts use $inc upserts - guard against duplicate tags
+    mongo_client = MongoClient(config.DB_URI)
+    try:
+        ensure_indexes(mongo_client[config.DB_NAME])
+    finally:
+        mongo_client.close()  # not to be inherited by the workers
+    pool = multiprocessing.Pool(processes)
+    last_update = datetime(1970, 01, 01, tzinfo=pytz.utc)
+    failed = []
+    try:
+        for notebook_name, last_update_nb, error in pool.imap_unordered(import_notebook, jobs):
+            if error is not None:
+                failed.append((notebook_name, error))
+                continue
+            logger.info("imported notebook %s, last_update=%s", notebook_name, last_update_nb)
+            last_update = max(last_update, last_update_nb)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if failed:
+        for notebook_name, error in failed:
+            logger.error("failed to import notebook %s - %s", notebook_name, error)
+        # keep last_update as it was, next import must include the failed notebooks
+        raise RuntimeError("failed to import %s of %s notebooks" % (len(failed), len(jobs)))
+    return last_update
+
+
+def save_last_update(last_update):
+    """ record last_update in LAST_UPDATE_FN, unless a later one is recorded already """
+    last_update_fn = config.LAST_UPDATE_FN
+    if last_update.tzinfo is not None:
+        last_update = last_update.astimezone(pytz.utc).replace(tzinfo=None)
+    if os.path.isfile(last_update_fn):
+        last_update_info = json.load(open(last_update_fn, 'r'))
+        recorded = dateutil.parser.parse(last_update_info['succeeded'])
+        if recorded.tzinfo is not None:
+            recorded = recorded.astimezone(pytz.utc).replace(tzinfo=None)
+        if recorded > last_update:
+            logger.info("keep last_update=%s in %s", recorded, last_update_fn)
+            return
+    # format as expected by gnsyncm (naive utc)
+    last_update_info = {
+        'succeeded': last_update.strftime("%Y-%m-%d %H:%M:%S")
+    }
+    json.dump(last_update_info, open(last_update_fn, 'w'), indent=4)
+    logger.info("set last_update=%s in %s", last_update, last_update_fn)
+
+
 def main():
     arg_parser = get_argparse()
     args = arg_parser.parse_args()
     logger.info("run enex2mongo with args: %s", args)
 
-    last_update = datetime(1970, 01, 01)
+    last_update = datetime(1970, 01, 01, tzinfo=pytz.utc)
     notebook_name = '(loading)'
+    options = dict(verify_images=args.verify, titles=args.title,
+                   resume=args.resume, retry_quarantined=args.retry_quarantined, full=args.full)
     try:
         enex_path = args.input
         if os.path.isdir(enex_path):
             # import all .enex files in given directory
             enex_dir = enex_path
-            enex_files = [fn for fn in os.listdir(enex_dir) if fn.endswith('.enex')]
-            for enex_file in enex_files:
-                # assume .enex file name matches notebook name (MUST, dont know how to map otherwise)
-                notebook_name = os.path.splitext(os.path.basename(enex_file))[0]
-                enex_path = os.path.join(enex_dir, enex_file)
-                last_update_nb = update_notebook(enex_path, notebook_name)
-                if last_update:
-                    last_update = max(last_update, last_update_nb)
-                else:
-                    last_update = last_update_nb
-
-            if last_update.year > 1970:
-                last_update_info = {
-                    'succeeded': last_update
-                }
-                last_update_fn = config.LAST_UPDATE_FN
-                # if os.path.isfile(last_update_fn):
-                #    last_update_info = json.load(open(last_update_fn, 'r'), object_hook=fix_last_update)
-                #    changed_after = last_update_info['succeeded']
-
-                json.dump(last_update_info, open(last_update_fn, 'w'), default=str, indent=4)
-                logger.info("set last_update=%s in %s", last_update, last_update_fn)
+            # assume .enex file name matches notebook name (MUST, dont know how to map otherwise)
+            jobs = [(enex_file, notebook_name, options) for enex_file, notebook_name in list_enex_files(enex_dir)]
+            if args.jobs > 1 and len(jobs) > 1:
+                notebook_name = '(%s notebooks)' % len(jobs)
+                last_update = import_parallel(jobs, min(args.jobs, len(jobs)))
+            else:
+                for enex_path, notebook_name, options in jobs:
+                    last_update_nb = update_notebook(enex_path, notebook_name, **options)
+                    if last_update:
+                        last_update = max(last_update, last_update_nb)
+                    else:
+                        last_update = last_update_nb
+
+            if last_update.year > 1970 and not (args.title or args.retry_quarantined):  # partial import
+                save_last_update(last_update)
 
         else:
-            notebook_name = os.path.splitext(os.path.basename(enex_path))[0]
+            notebook_name = enex_name(enex_path)
             if args.notebook and notebook_name != args.notebook:
                 raise ValueError("bad notebook name: %s != %s", args.notebook, notebook_name)
-            update_notebook(enex_path, notebook_name)
+            update_notebook(enex_path, notebook_name, **options)
         logger.info("enex2mongo succeeded")
 
     except Exception as err:
@@ -0,0 +1,334 @@
+"""
+byte-offset index of the notes in an .enex file, kept in a sidecar file
+
+the index records for each <note> element its byte range in the .enex
+together with title, created, updated (as in the .enex), content size, md5
+of the (raw) content, number and (decoded) size of resources;
+built by a single scan of the (memory-mapped) file, skipping CDATA sections
+instead of parsing them. notes are read back by parsing just their range,
+read and fed to the parser in chunks (see enexparser.NoteTarget).
+compressed .enex.gz / .enex.zst are scanned while decompressed, offsets are
+those in the decompressed stream; notes are read back by a single streaming
+pass of EnexParser, building only the notes wanted (by ordinal). if that
+pass fails, the remaining notes are read one by one, each range decompressed
+into memory, so that only the broken note fails
+
+the index is used for selection, checkpoints and skipping unchanged notes;
+notes are always parsed by the parser target of enexparser, without
+building an element tree
+
+sidecar <enex>.idx is json lines: a header with size and mtime of the .enex
+(stale index is rebuilt), then one entry per note; if it cannot be written
+(read-only export directory), the index is used in memory only:
+
+    {"offset": .., "length": .., "title": .., "created": .., "updated": .., "size": .., "hash": ..,
+     "resources": .., "resource_bytes": ..}
+"""
+
+import os
+import re
+import json
+import mmap
+import hashlib
+
+from enexparser import EnexParser, is_compressed, open_enex, parse_chunks, READ_CHUNK_SIZE
+
+import logging
+logger = logging.getLogger("en2mongo.enexindex")
+
+INDEX_VERSION = 4
+INDEX_SUFFIX = '.idx'
+XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+REFERENCE_RE = re.compile(r'&(#[xX][0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+
+
+def _unescape_reference(match):
+    """ utf-8 text of entity or (numeric) character reference """
+    ref = match.group(1)
+    if ref[0] != '#':
+        return XML_ENTITIES[ref]
+    code = int(ref[2:], 16) if ref[1] in 'xX' else int(ref[1:])
+    try:
+        return ('\\U%08x' % code).decode('unicode-escape').encode('utf-8')
+    except UnicodeDecodeError:
+        return match.group(0)  # beyond unicode range, keep as is
+
+
+def _text(mm, start, end_tag):
+    """ element text starting at start, up to end_tag """
+    end = mm.find(end_tag, start)
+    if end < 0:
+        return None
+    text = mm[start:end]
+    if text.startswith('<![CDATA['):
+        text = text[9:-3]
+    else:
+        text = REFERENCE_RE.sub(_unescape_reference, text)
+    return unicode(text, 'utf-8', 'replace')
+
+
+def _base64_size(data):
+    """ size of base64 encoded data when decoded """
+    length = len(data) - sum(data.count(ws) for ws in ' \t\r\n')
+    return length * 3 // 4 - data[-4:].count('=') if length else 0
+
+
+def scan(mm):
+    """ yield index entries for the notes in mm (mmap or string of .enex) """
+    pos = 0
+    note = None
+    content_start = None
+    data_start = None
+    while 1:
+        lt = mm.find('<', pos)
+        if lt < 0:
+            break
+        head = mm[lt:lt + 10]
+        if head.startswith('<![CDATA['):
+            end = mm.find(']]>', lt + 9)
+            if end < 0:
+                raise ValueError("unterminated CDATA section at %s" % lt)
+            pos = end + 3
+            continue
+        if head.startswith('<!--'):
+            end = mm.find('-->', lt + 4)
+            if end < 0:
+                break
+            pos = end + 3
+            continue
+
+        gt = mm.find('>', lt)
+        if gt < 0:
+            break
+        pos = gt + 1
+        tag = mm[lt + 1:gt].split(None, 1)[0] if gt > lt + 1 else ''
+        if tag == 'note':
+            note = {'offset': lt, 'title': None, 'created': None, 'updated': None, 'size': 0, 'hash': None,
+                    'resources': 0, 'resource_bytes': 0}
+        elif note is None:
+            continue
+        elif tag == '/note':
+            note['length'] = pos - note['offset']
+            yield note
+            note = None
+        elif tag in ('title', 'created', 'updated') and note[tag] is None:
+            note[tag] = _text(mm, pos, '</%s>' % tag)
+        elif tag == 'content':
+            content_start = pos
+        elif tag == '/content' and content_start is not None:
+            size = lt - content_start
+            if mm[content_start:content_start + 9] == '<![CDATA[':
+                size -= 12
+            note['size'] = size
+            note['hash'] = hashlib.md5(mm[content_start:lt]).hexdigest()
+            content_start = None
+        elif tag == 'resource':
+            note['resources'] += 1
+        elif tag == 'data':
+            data_start = pos
+        elif tag == '/data' and data_start is not None:
+            note['resource_bytes'] += _base64_size(mm[data_start:lt].rstrip())
+            data_start = None
+
+
+class StreamBuffer:
+    """ find and slice by absolute offset on a stream, as scan() does on mmap
+
+    reads ahead as needed; data before an offset is dropped by release()
+    """
+
+    def __init__(self, fp, chunk_size=READ_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        self.base = 0  # stream offset of buf[0]
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def find(self, sub, start=0):
+        start = max(start - self.base, 0)
+        while 1:
+            found = self.buf.find(sub, start)
+            if found >= 0:
+                return found + self.base
+            start = max(start, len(self.buf) - len(sub) + 1)  # do not search again what was searched
+            if not self._fill():
+                return -1
+
+    def __getitem__(self, key):
+        assert isinstance(key, slice) and key.start >= self.base
+        while key.stop - self.base > len(self.buf) and self._fill():
+            pass
+        return str(self.buf[key.start - self.base:key.stop - self.base])
+
+    def release(self, offset):
+        if offset > self.base:
+            del self.buf[:offset - self.base]
+            self.base = offset
+
+
+def scan_stream(fp):
+    """ yield (index entry, note data) for the notes read from stream fp """
+    stream = StreamBuffer(fp)
+    for entry in scan(stream):
+        end = entry['offset'] + entry['length']
+        yield entry, stream[entry['offset']:end]
+        stream.release(end)
+
+
+def _chunks(data):
+    for offset in xrange(0, len(data), READ_CHUNK_SIZE):
+        yield data[offset:offset + READ_CHUNK_SIZE]
+
+
+def _read_range(fp, offset, length):
+    """ length bytes at offset of file, in chunks """
+    fp.seek(offset)
+    while length > 0:
+        chunk = fp.read(min(length, READ_CHUNK_SIZE))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+def scan_file(enex_path):
+    """ yield index entries for the notes in .enex file, streaming through it """
+    if is_compressed(enex_path):
+        enex_file = open_enex(enex_path)
+        try:
+            for entry, data in scan_stream(enex_file):
+                yield entry
+        finally:
+            enex_file.close()
+        return
+    with open(enex_path, 'rb') as enex_file:
+        if os.fstat(enex_file.fileno()).st_size == 0:
+            return  # mmap fails for empty file
+        mm = mmap.mmap(enex_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for entry in scan(mm):
+                yield entry
+        finally:
+            mm.close()
+
+
+class EnexIndex:
+    """ index of notes in .enex file, see module doc """
+
+    def __init__(self, enex_path):
+        assert os.path.exists(enex_path), "missing %s" % repr(enex_path)
+        self.enex_path = enex_path
+        self.index_path = enex_path + INDEX_SUFFIX
+        self.entries = None
+
+    def _header(self):
+        stat = os.stat(self.enex_path)
+        return {"version": INDEX_VERSION, "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+    def load(self, build=True):
+        """ load index from sidecar, (re)build it if missing or stale; return entries """
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as index_file:
+                header = json.loads(index_file.readline() or 'null')
+                if header == self._header():
+                    self.entries = [json.loads(line) for line in index_file]
+                    return self.entries
+            logger.info("index %s is stale", self.index_path)
+        if not build:
+            return None
+        return self.build()
+
+    def build(self):
+        """ scan .enex, write sidecar (if the directory is writable); return entries """
+        header = self._header()
+        self.entries = list(scan_file(self.enex_path))
+        logger.info("indexed %s notes of %s", len(self.entries), self.enex_path)
+        try:
+            with open(self.index_path + '.part', 'w') as index_file:
+                index_file.write(json.dumps(header) + '\n')
+                for entry in self.entries:
+                    index_file.write(json.dumps(entry) + '\n')
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)  # os.rename does not replace on windows
+            os.rename(self.index_path + '.part', self.index_path)
+        except (IOError, OSError) as err:
+            # e.g. read-only export directory, index is built again next time
+            logger.warning("failed to write index %s, using it in memory - %s", self.index_path, err)
+        return self.entries
+
+    def parse(self, entries=None):
+        """ yield EnNote for given index entries (default: all), reading only their byte ranges """
+        for entry, note, error in self.parse_entries(entries):
+            if error is not None:
+                raise error
+            yield note
+
+    def parse_entries(self, entries=None):
+        """ yield (entry, EnNote, None) for given entries, (entry, None, ValueError) for notes failing to parse
+
+        entries of compressed .enex must be in order of the .enex
+        """
+        all_entries = self.entries if self.entries is not None else self.load()
+        if entries is None:
+            entries = all_entries
+        if not entries:
+            return
+        if not is_compressed(self.enex_path):
+            for item in self._parse_ranges(entries):
+                yield item
+            return
+        ordinals = dict((entry['offset'], ordinal) for ordinal, entry in enumerate(all_entries))
+        parsed = 0
+        try:
+            for ordinal, note in EnexParser(self.enex_path).parse_notes(
+                    set(ordinals[entry['offset']] for entry in entries)):
+                yield entries[parsed], note, None
+                parsed += 1
+        except ValueError as exc:
+            logger.warning("failed to parse %s after %s notes, reading the remaining notes one by one - %s",
+                           self.enex_path, parsed, exc)
+            for item in self._parse_ranges(entries[parsed:]):
+                yield item
+
+    def _parse_ranges(self, entries):
+        for entry, chunks in self._read(entries):
+            try:
+                notes = [note for ordinal, note in parse_chunks(chunks)]
+                if len(notes) != 1:
+                    raise ValueError("%s notes in range" % len(notes))
+            except ValueError as exc:
+                yield entry, None, ValueError("failed to parse note at %s of %s: %s" % (
+                    entry['offset'], self.enex_path, exc))
+                continue
+            yield entry, notes[0], None
+
+    def _read(self, entries):
+        """ yield (entry, chunks of note data) for entries - in order of the .enex for compressed .enex """
+        if is_compressed(self.enex_path):
+            # no seeking in compressed stream, scan it up to the notes
+            wanted = iter(entries)
+            entry = next(wanted, None)
+            enex_file = open_enex(self.enex_path)
+            try:
+                for scanned, data in scan_stream(enex_file):
+                    if entry is None:
+                        break
+                    if scanned['offset'] == entry['offset']:
+                        yield entry, _chunks(data)
+                        entry = next(wanted, None)
+            finally:
+                enex_file.close()
+            return
+        with open(self.enex_path, 'rb') as enex_file:
+            for entry in entries:
+                yield entry, _read_range(enex_file, entry['offset'], entry['length'])
@@ -4,68 +4,168 @@ enex parser
 """
 
 import os
-import re
+import gzip
+import tempfile
 from lxml import etree
 import dateutil
 import dateutil.parser
 import hashlib
 import base64
 import pytz
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECODE_CHUNK_SIZE = 64 * 1024  # base64 text decoded at once
+SPOOL_MAX_SIZE = 1024 * 1024  # larger resource bodies go to a temporary file
+WHITESPACE = ' \t\r\n'
+EPOCH = '19700101T000000Z'  # for missing created / updated
+ENEX_EXTENSIONS = ('.enex', '.enex.gz', '.enex.zst')  # compressed exports are read decompressing
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def is_enex(path):
+    return path.lower().endswith(ENEX_EXTENSIONS)
+
+
+def is_compressed(path):
+    return path.lower().endswith(ENEX_EXTENSIONS[1:])
+
+
+def enex_name(path):
+    """ name of .enex file without directory and (compression) extensions, i.e. the notebook name """
+    name = os.path.basename(path)
+    for extension in reversed(ENEX_EXTENSIONS):
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return os.path.splitext(name)[0]
+
+
+def list_enex_files(enex_dir):
+    """ list (path, notebook name) of .enex files in directory, one per notebook (uncompressed preferred) """
+    found = {}
+    for fn in sorted(os.listdir(enex_dir)):
+        if not is_enex(fn):
+            continue
+        name = enex_name(fn)
+        if name in found:
+            if not is_compressed(found[name]):
+                continue
+            if is_compressed(fn) and found[name].lower().endswith('.gz'):
+                continue
+        found[name] = fn
+    return [(os.path.join(enex_dir, fn), name) for name, fn in sorted(found.items())]
+
+
+class ZstdFile:
+    """ read-only file object on a .zst file, decompressed while read """
+
+    def __init__(self, path):
+        assert zstandard is not None, ".enex.zst input requires zstandard (pip install zstandard)"
+        self._raw = open(path, 'rb')
+        self._reader = zstandard.ZstdDecompressor().stream_reader(self._raw)
+
+    def read(self, size=-1):
+        if size is not None and size >= 0:
+            return self._reader.read(size)
+        chunks = []
+        while 1:
+            chunk = self._reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def close(self):
+        self._reader.close()
+        self._raw.close()
+
+
+def open_enex(path):
+    """ open .enex for reading, decompressing .enex.gz / .enex.zst on the fly """
+    lower = path.lower()
+    if lower.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if lower.endswith('.zst'):
+        return ZstdFile(path)
+    return open(path, 'rb')
+
+
+def parse_date(value):
+    """ aware datetime for .enex timestamp, YYYYMMDDTHHMMSSZ (utc) or else as dateutil parses it """
+    if len(value) == 16 and value[8] == 'T' and value[15] == 'Z':
+        try:
+            return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                            int(value[9:11]), int(value[11:13]), int(value[13:15]), tzinfo=pytz.utc)
+        except ValueError:
+            pass
+    # value = unicode(value)  #TODO avoid Unicode equal comparison failed
+    # https://stackoverflow.com/questions/21296475/python-dateutil-unicode-warning
+    date_value = dateutil.parser.parse(value)
+    if date_value.tzinfo is None:
+        date_value = pytz.utc.localize(date_value)
+    return date_value
 
 
 class EnNote:
     """ wrap note from enex file to mimic EN api node """
 
-    def __init__(self, note):
-        self._extract_note_info(note)
-        self._note = note
+    def __init__(self, note=None):
+        """ note: <note> element, None for a note filled in by NoteTarget """
+        self.title = None
+        self.tags = []
+        self.content = None
+        self.resources = []  # attachements / files, decoded when looked up
+        if note is not None:
+            self._extract_note_info(note)
 
     @property
     def tagNames(self):
         return self.tags
 
-    def _parse_date(self, value):
-        # value = unicode(value)  #TODO avoid Unicode equal comparison failed
-        # https://stackoverflow.com/questions/21296475/python-dateutil-unicode-warning
-        return dateutil.parser.parse(value)
-
     def _extract_note_info(self, note):
-        self.title = note.xpath('title')[0].text
-
-        self.created = self._extract_dateval(note, 'created')
-        self.updated = self._extract_dateval(note, 'updated')
+        # single pass over the children of <note>, instead of an xpath per field
+        created = updated = None
+        for child in note:
+            tag = child.tag
+            if tag == 'title':
+                if self.title is None:
+                    self.title = child.text
+            elif tag == 'content':
+                if self.content is None:
+                    self.content = child.text
+            elif tag == 'created':
+                if created is None:
+                    created = child.text
+            elif tag == 'updated':
+                if updated is None:
+                    updated = child.text
+            elif tag == 'tag':
+                self.tags.append(child.text)
+            elif tag == 'resource':
+                resource_obj = ENResource(child)
+                if resource_obj.has_data:
+                    self.resources.append(resource_obj)
+        self._finish(created, updated)
 
-        self.tags = [tag.text for tag in note.xpath('tag')]
-        content = note.xpath('content')
-        if content:
-            self.content = content[0].text
-        else:
+    def _finish(self, created, updated):
+        if self.content is None:
             self.content = ''  # no content?
-
-        # attachements / files
-        self.resources = []
-        resources = note.xpath('resource')
-        for resource in resources:
-            resource_obj = ENResource(resource)
-            if resource_obj.data:
-                self.resources.append(resource_obj)
-
-    def _extract_dateval(self, note, date_field):
-        if note.xpath(date_field):
-            date_value = note.xpath(date_field)[0].text
-        else:
-            date_value = '19700101T000000Z'
-        date_value = self._parse_date(date_value)
-        if date_value.tzinfo is None:
-            date_value = pytz.utc.localize(date_value)
-        return date_value
+        self.created = parse_date(created or EPOCH)
+        self.updated = parse_date(updated or EPOCH)
+        self._resource_index = {}  # hash -> resource, for resources decoded so far
+        self._decoded = 0
 
     def get_image_resource(self, imageInfo):
+        """ resource for hash, decoding resources only until found """
         image_hash = imageInfo['hash']
-        for resource in self.resources:
-            if resource.hash == image_hash:
-                return resource
-        return None
+        while image_hash not in self._resource_index and self._decoded < len(self.resources):
+            resource = self.resources[self._decoded]
+            self._decoded += 1
+            self._resource_index.setdefault(resource.hash, resource)
+        return self._resource_index.get(image_hash)
 
     def load_content(self):
         pass  # already extracted
@@ -81,36 +181,124 @@ class EnNote:
         # return value
 
 
+def _encoded_chunks(data):
+    """ chunks of base64 text given as string or file-like object """
+    if hasattr(data, 'read'):
+        data.seek(0)
+        while 1:
+            chunk = data.read(DECODE_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    if isinstance(data, unicode):
+        data = data.encode('ascii')
+    for start in xrange(0, len(data), DECODE_CHUNK_SIZE):
+        yield data[start:start + DECODE_CHUNK_SIZE]
+
+
 class ENResourceData:
+    """ decoded resource body, spooled to a temporary file if large
+
+    decoded chunk by chunk, computing md5 on the way, so there is no
+    full-size copy of the body, nor of the base64 text if read from a file
+    """
 
     def __init__(self, data):
-        data = re.sub(r'\n', '', data).strip()
-        self.body = base64.b64decode(data, altchars=None)  # , validate=True
+        """ data: base64 text, or file-like object with it """
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        pending = ''
+        for chunk in _encoded_chunks(data):
+            chunk = pending + chunk.translate(None, WHITESPACE)
+            usable = len(chunk) - len(chunk) % 4
+            pending = chunk[usable:]
+            self._write(base64.b64decode(chunk[:usable]))
+        if pending:
+            self._write(base64.b64decode(pending))  # incorrect padding
+        self.hash = self.md5.hexdigest()
+
+    def _write(self, decoded):
+        self.md5.update(decoded)
+        self.size += len(decoded)
+        self._file.write(decoded)
+
+    def open(self):
+        """ file-like object to stream the body from """
+        self._file.seek(0)
+        return self._file
+
+    @property
+    def body(self):
+        return self.open().read()
+
+
+def _is_base64(data_encoding):
+    """ whether <data> with given encoding attribute has resource data """
+    if data_encoding != "base64":
+        # rarely, but happending
+        assert data_encoding is None, "unknown data encoding: %s" % data_encoding
+        # logger.error("unsupported data encoding: %s" % data_encoding) # note "fst_verknuepfungen  - EDBCore, mgmt script" in hrs
+        return False
+    return True
 
 
 class ENResource:
+    """ resource of note, base64 data decoded on first access to data / hash
 
-    def __init__(self, resource):
-        self._extract_resource_info(resource)
+    the base64 text is kept as string (from an element) or in a spooled
+    temporary file (written by NoteTarget as parsed)
+    """
+
+    def __init__(self, resource=None):
+        """ resource: <resource> element, None for a resource filled in by NoteTarget """
+        self._data = None
+        self._encoded = None
+        self.mime_type = None
+        self.filename = None  # unknown, see updatenote._resource_filename
+        if resource is not None:
+            self._extract_resource_info(resource)
+
+    @property
+    def has_data(self):
+        return self._data is not None or self._encoded is not None
+
+    @property
+    def data(self):
+        if self._data is None and self._encoded is not None:
+            encoded, self._encoded = self._encoded, None  # free base64 text
+            self._data = ENResourceData(encoded)
+            if hasattr(encoded, 'close'):
+                encoded.close()
+        return self._data
+
+    @property
+    def hash(self):
+        data = self.data
+        if data is None:
+            return None
+        return data.hash
 
     def _extract_resource_info(self, resource):
-        self.data = self.hasn = None
-        self.mime_type = resource.xpath('mime')[0].text
-        fn_node = resource.xpath('resource-attributes/file-name')
-        if fn_node:
-            self.filename = fn_node[0].text
-        else:
-            self.filename = 'unnamed'
+        data_node = None
+        for child in resource:
+            tag = child.tag
+            if tag == 'data':
+                data_node = child
+            elif tag == 'mime':
+                self.mime_type = child.text
+            elif tag == 'resource-attributes':
+                for attribute in child:
+                    if attribute.tag == 'file-name':
+                        self.filename = attribute.text
+                        break
+        if data_node is None:
+            return
         # Base64 encoded data has new lines!
-        data_node = resource.xpath('data')[0]
         data_encoding = data_node.attrib.get('encoding')
-        if data_encoding != "base64":
-            # rarely, but happending
-            assert data_encoding is None, "unknown data encoding: %s" % data_encoding
-            # logger.error("unsupported data encoding: %s" % data_encoding) # note "fst_verknuepfungen  - EDBCore, mgmt script" in hrs
+        if not _is_base64(data_encoding):
             return
-        self.data = ENResourceData(data_node.text)
-        self.hash = hashlib.md5(self.data.body).hexdigest()
+        self._encoded = data_node.text
 
         """
         additional resource info currently ignored / discarded:
@@ -134,6 +322,139 @@ class ENResource:
         """
 
 
+class NoteTarget:
+    """ lxml parser target building EnNote for <note> elements, no element tree
+
+    the text of fields is collected as it arrives; base64 text of resources
+    goes to a spooled temporary file, as the parser hands it over in pieces
+    of (at most) the size fed, so memory does not grow with resource size.
+    notes are numbered in document order (ordinal), those not wanted are
+    skipped without collecting anything
+    """
+
+    FIELDS = ('title', 'content', 'created', 'updated', 'tag')
+
+    def __init__(self, wanted=None):
+        """ wanted: ordinals of notes to build, None for all """
+        self.wanted = wanted
+        self.ordinal = -1  # of the current / last note
+        self.notes = []  # (ordinal, EnNote) completed, see take()
+        self._note = None  # note being built
+        self._skipping = False  # in a note not wanted
+        self._depth = 0  # below <note>
+        self._fields = None
+        self._resource = None
+        self._attributes = False  # in <resource-attributes>
+        self._text = None  # pieces of text being collected
+        self._spool = None  # for base64 text being collected
+
+    def take(self):
+        """ notes completed since last call """
+        notes, self.notes = self.notes, []
+        return notes
+
+    def start(self, tag, attrib):
+        if self._note is None and not self._skipping:
+            if tag == 'note':
+                self.ordinal += 1
+                self._depth = 0
+                if self.wanted is None or self.ordinal in self.wanted:
+                    self._note = EnNote()
+                    self._fields = {}
+                else:
+                    self._skipping = True
+            return
+        self._depth += 1
+        if self._skipping:
+            return
+        if self._depth == 1:
+            if tag in self.FIELDS:
+                self._text = []
+            elif tag == 'resource':
+                self._resource = ENResource()
+        elif self._resource is not None:
+            if self._depth == 2 and tag == 'data':
+                if _is_base64(attrib.get('encoding')) and self._resource._encoded is None:
+                    self._spool = self._resource._encoded = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            elif self._depth == 2 and tag == 'resource-attributes':
+                self._attributes = True
+            elif (self._depth == 2 and tag == 'mime') or (self._depth == 3 and self._attributes and tag == 'file-name'):
+                self._text = []
+
+    def data(self, text):
+        if self._spool is not None:
+            if isinstance(text, unicode):
+                text = text.encode('ascii')
+            self._spool.write(text)
+        elif self._text is not None:
+            self._text.append(text)
+
+    def end(self, tag):
+        if self._note is None and not self._skipping:
+            return
+        if self._depth == 0:
+            if not self._skipping:
+                self._note.title = self._fields.get('title')
+                self._note.content = self._fields.get('content')
+                self._note._finish(self._fields.get('created'), self._fields.get('updated'))
+                self.notes.append((self.ordinal, self._note))
+            self._note = None
+            self._skipping = False
+            return
+        self._depth -= 1
+        if self._skipping:
+            return
+        text = None
+        if self._text is not None:
+            text = ''.join(self._text) if self._text else None
+            self._text = None
+        if self._depth == 0:
+            if tag == 'tag':
+                self._note.tags.append(text)
+            elif tag in self.FIELDS:
+                self._fields.setdefault(tag, text)
+            elif tag == 'resource':
+                if self._resource.has_data:
+                    self._note.resources.append(self._resource)
+                self._resource = None
+        elif self._resource is not None and self._depth == 1:
+            if tag == 'data':
+                self._spool = None
+            elif tag == 'mime':
+                self._resource.mime_type = text
+            elif tag == 'resource-attributes':
+                self._attributes = False
+        elif self._resource is not None and self._depth == 2 and self._attributes and tag == 'file-name':
+            self._resource.filename = text
+
+    def close(self):
+        pass  # notes are taken as completed
+
+
+def parse_chunks(chunks, wanted=None):
+    """ yield (ordinal, EnNote) for the notes in xml text given in chunks, see NoteTarget """
+    target = NoteTarget(wanted)
+    parser = etree.XMLParser(target=target, huge_tree=True, resolve_entities=False)
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for item in target.take():
+                yield item
+        parser.close()
+    except etree.XMLSyntaxError as exc:
+        raise ValueError("syntax error in enex file: %s" % exc)
+    for item in target.take():
+        yield item
+
+
+def read_chunks(fp, size=READ_CHUNK_SIZE):
+    while 1:
+        chunk = fp.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
 class EnexParser:
 
     def __init__(self, enex_file):
@@ -141,14 +462,26 @@ class EnexParser:
         self._enex_file = enex_file
 
     def parse(self):
+        """ yield EnNote for each note in the .enex, parsed incrementally """
+        for ordinal, note in self.parse_notes():
+            yield note
+
+    def parse_notes(self, ordinals=None):
+        """ yield (ordinal, EnNote) for the notes in the .enex, only those with given ordinals if set
+
+        the .enex is fed to a NoteTarget in chunks, there is no element tree,
+        so memory does not grow with the size of the .enex nor with that of
+        resources; .enex.gz and .enex.zst are decompressed while parsed.
+        reading stops after the last note wanted
+        """
+        if ordinals is not None and not ordinals:
+            return
+        last = max(ordinals) if ordinals is not None else None
+        enex_file = open_enex(self._enex_file)
         try:
-            parser = etree.XMLParser(huge_tree=True, resolve_entities=False)
-            data = self._enex_file
-            xml_tree = etree.parse(data, parser)
-        except (etree.XMLSyntaxError, ) as exc:
-            raise ValueError("syntax error in enex file: %s" % exc)
-
-        raw_notes = xml_tree.xpath('//note')
-        for note in raw_notes:
-            yield EnNote(note)
-        return
+            for ordinal, note in parse_chunks(read_chunks(enex_file), ordinals):
+                yield ordinal, note
+                if ordinal == last:
+                    return
+        finally:
+            enex_file.close()
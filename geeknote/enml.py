@@ -0,0 +1,224 @@
+"""
+rewrite ENML note content for leanote
+
+parses the content once with lxml and, in a single walk over the tree,
+collects en-media references, drops img tags preceeding them (EN web clips)
+and replaces image en-media elements with img tags pointing to leanote,
+other en-media elements (attachments) with links to them; restore() reverts
+this for exporting notes to .enex
+"""
+
+import re
+import hashlib
+from lxml import etree
+
+import logging
+logger = logging.getLogger("en2mongo.enml")
+
+ENML_DTDS = (
+    'http://xml.evernote.com/pub/enml2.dtd',
+    'http://xml.evernote.com/pub/enml.dtd',  # e.g. notes created 2019-10
+)
+
+# html elements without content, serialized as <br/> - all others get an end tag
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+])
+
+IMAGE_URL = '/api/file/getImage?fileId=%s'
+ATTACH_URL = '/api/file/getAttach?fileId=%s'
+IMAGE_URL_RE = re.compile(r'/(?:api/file/getImage|file/outputImage)\?fileId=([0-9a-fA-F]{24})')
+ATTACH_URL_RE = re.compile(r'/(?:api/file/getAttach|attach/download)\?(?:fileId|attachId)=([0-9a-fA-F]{24})')
+
+ENML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-note SYSTEM "%s">\n' % ENML_DTDS[0]
+
+
+def media_info(en_media):
+    """ return dict with hash, type and extension for en-media element, None if incomplete """
+    media_hash = en_media.get('hash')
+    media_type = en_media.get('type')
+    if not media_hash or not media_type or '/' not in media_type:
+        return None
+    main_type, extension = media_type.split('/', 1)
+    return {'hash': media_hash, 'type': main_type, 'extension': extension}
+
+
+class EnmlContent:
+    """ ENML note content, parsed once """
+
+    def __init__(self, content):
+        self.content = content
+        if isinstance(content, unicode):
+            # lxml refuses unicode with encoding declaration
+            content = content.encode('utf-8')
+        parser = etree.XMLParser(
+            resolve_entities=False, load_dtd=False, no_network=True,
+            huge_tree=True, remove_blank_text=False)
+        try:
+            self.root = etree.fromstring(content, parser)
+        except etree.XMLSyntaxError as err:
+            raise ValueError("content format unsupported: %s - %s" % (err, content[:180]))
+        self.tree = self.root.getroottree()
+        self._media = None
+        if self.tree.docinfo.system_url not in ENML_DTDS:
+            raise ValueError("content format unsupported: %s" % content[:180])
+
+    def digest(self):
+        """ md5 hex digest of the (original) content """
+        content = self.content
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return hashlib.md5(content).hexdigest()
+
+    def resource_hashes(self):
+        """ sorted list of distinct hashes of resources referenced by content """
+        return sorted(set(info['hash'] for info in self.media()))
+
+    def media(self):
+        """ list of media info (hash, type, extension) referenced by en-media elements """
+        if self._media is None:
+            self._media = []
+            for en_media in self.root.iter('en-media'):
+                info = media_info(en_media)
+                if info is not None:
+                    self._media.append(info)
+        return self._media
+
+    def rewrite(self, resolve, resolve_attachment=None):
+        """ replace en-media elements, return new content
+
+        resolve(info) is called once per distinct image hash and returns the id
+        of the stored file, or None to keep the en-media element as is;
+        resolve_attachment(info) likewise for other media types, returning
+        (id of attachment, title) or None
+
+        returns the original content unchanged if nothing was replaced
+        """
+        self.media()  # collect before en-media elements get replaced
+        resolved = {}
+        changed = False
+        for elmt in list(self.root.iter()):
+            tag = elmt.tag
+            if not isinstance(tag, basestring):
+                continue  # comment, entity, processing instruction
+
+            if tag not in VOID_ELEMENTS and elmt.text is None and not len(elmt):
+                # keep <div></div> instead of <div/> which browsers take as start tag
+                elmt.text = ''
+
+            if tag == 'en-media' and self._replace_media(elmt, resolve, resolve_attachment, resolved):
+                changed = True
+
+        if not changed:
+            return self.content
+        return etree.tostring(self.tree, encoding='UTF-8', xml_declaration=True)
+
+    def _replace_media(self, en_media, resolve, resolve_attachment, resolved):
+        """
+        transform EN image refs:
+            <img src="file:/C:/Users/pifre/AppData/Local/Temp/enhtmlclip/Image.jpg"/>
+            <en-media hash="9aad6b0d39f6e0856afde5d941a5c6a2" type="image/jpeg"></en-media>
+        """
+        changed = False
+        # handle img tag followed by en-media tag from EN
+        previous = en_media.getprevious()
+        if previous is not None and previous.tag == 'img' and not previous.tail:
+            # drop img tag preceeding en-media elmt
+            if previous.attrib.keys() != ['src']:
+                logger.debug("extra attribs in img tag: %s", previous.attrib.keys())  # width, height
+            en_media.getparent().remove(previous)
+            changed = True
+
+        info = media_info(en_media)
+        if info is None:
+            logger.warning("detected en-media elmt without type/hash attribs")  # unexpected
+            return changed
+        if info['type'] != 'image':
+            if resolve_attachment is None:
+                logger.info("ignore en-media elmt for type=%s", en_media.get('type'))
+                return changed
+            return self._replace_attachment(en_media, info, resolve_attachment, resolved) or changed
+
+        if info['hash'] not in resolved:
+            resolved[info['hash']] = resolve(info)
+        file_id = resolved[info['hash']]
+        if file_id is None:
+            logger.warning("failed to fetch image for hash %s", info['hash'])
+            return changed
+
+        img = etree.Element('img')
+        img.set('src', IMAGE_URL % file_id)
+        img.tail = en_media.tail
+        en_media.getparent().replace(en_media, img)
+        # en-media elmt is restored from files entry on export, see restore()
+        return True
+
+    def _replace_attachment(self, en_media, info, resolve_attachment, resolved):
+        """ replace en-media elmt of attachment by link to it """
+        if info['hash'] not in resolved:
+            resolved[info['hash']] = resolve_attachment(info)
+        attachment = resolved[info['hash']]
+        if attachment is None:
+            logger.warning("failed to fetch attachment for hash %s", info['hash'])
+            return False
+
+        attach_id, title = attachment
+        link = etree.Element('a')
+        link.set('href', ATTACH_URL % attach_id)
+        link.text = title
+        link.tail = en_media.tail
+        en_media.getparent().replace(en_media, link)
+        return True
+
+
+def _en_media(elmt, media):
+    """ replace elmt by en-media element for media (hash, mime type) """
+    en_media = etree.Element('en-media')
+    en_media.set('hash', media[0])
+    en_media.set('type', media[1])
+    en_media.tail = elmt.tail
+    elmt.getparent().replace(elmt, en_media)
+
+
+def restore(content, resolve_image, resolve_attachment):
+    """ ENML for leanote note content, return utf-8 encoded ENML
+
+    images and attachment links pointing to leanote are replaced by en-media
+    elements again; resolve_image(file id) and resolve_attachment(attach id)
+    return (hash, mime type), or None to keep the element. content written
+    in leanote (html, not ENML) is wrapped into an en-note element
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    root = None
+    if content and content.lstrip().startswith('<?xml'):
+        parser = etree.XMLParser(
+            resolve_entities=False, load_dtd=False, no_network=True,
+            huge_tree=True, remove_blank_text=False)
+        try:
+            root = etree.fromstring(content, parser)
+        except etree.XMLSyntaxError:
+            root = None
+        if root is not None and root.tag != 'en-note':
+            root = None
+    if root is None:
+        root = etree.Element('en-note')
+        if content and content.strip():
+            html = etree.fromstring(content, etree.HTMLParser(encoding='utf-8'))
+            body = html.find('body') if html is not None else None
+            if body is not None:
+                root.text = body.text
+                root.extend(list(body))
+
+    for elmt in list(root.iter('img', 'a')):
+        if elmt.tag == 'img':
+            match = IMAGE_URL_RE.search(elmt.get('src') or '')
+            media = resolve_image(match.group(1)) if match else None
+        else:
+            match = ATTACH_URL_RE.search(elmt.get('href') or '')
+            media = resolve_attachment(match.group(1)) if match else None
+        if media is not None:
+            _en_media(elmt, media)
+    return ENML_HEADER + etree.tostring(root, encoding='UTF-8')
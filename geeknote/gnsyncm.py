@@ -22,6 +22,8 @@ from datetime import datetime, timedelta
 import pytz
 import json
 import binascii
+import threading
+import collections
 
 from evernote.edam.limits.constants import EDAM_USER_NOTES_MAX
 
@@ -82,6 +84,10 @@ logger = setup_logging("en2mongo")
 # http://en.wikipedia.org/wiki/Unicode_control_characters
 CONTROL_CHARS_RE = re.compile(u'[\x00-\x08\x0e-\x1f\x7f-\x9f]')
 
+# notes fetched from EN ahead of writing to mongodb, at most SYNC_QUEUE_BYTES of content and resources
+SYNC_QUEUE_SIZE = 8
+SYNC_QUEUE_BYTES = 64 * 1024 * 1024
+
 FILE_FORMAT = {
     '.md': 'markdown',
     '.html': 'html',
@@ -120,6 +126,7 @@ class ENNoteObj:
         self.sleep_on_ratelimit = sleep_on_ratelimit
         self._note = note
         self._note.content = None
+        self._resources = None
 
     def load_tags(self):
         self.gn = GeekNote(sleepOnRateLimit=self.sleep_on_ratelimit)
@@ -129,7 +136,27 @@ class ENNoteObj:
         self.gn = GeekNote(sleepOnRateLimit=self.sleep_on_ratelimit)
         self.gn.loadNoteContent(self._note)
 
+    def load_resources(self, enml):
+        """ fetch resources (images, attachments) referenced by content ahead of time (fetch stage) """
+        self._resources = {}
+        for imageInfo in enml.media():
+            if imageInfo['hash'] not in self._resources:
+                self._resources[imageInfo['hash']] = self._fetch_image_resource(imageInfo)
+
+    def loaded_size(self):
+        """ bytes of content and prefetched resources held by note """
+        size = len(self._note.content or '')
+        for resource in (self._resources or {}).values():
+            if resource is not None and resource.data is not None:
+                size += len(resource.data.body or '')
+        return size
+
     def get_image_resource(self, imageInfo):
+        if self._resources is not None:
+            return self._resources.get(imageInfo['hash'])
+        return self._fetch_image_resource(imageInfo)
+
+    def _fetch_image_resource(self, imageInfo):
         guid = self._note.guid
         binary_hash = binascii.unhexlify(imageInfo['hash'])
         try:
@@ -148,6 +175,49 @@ class ENNoteObj:
         return value
 
 
+class PrefetchQueue:
+    """ queue between fetch and write stage, bounded by number and size of items
+
+    an item larger than max_bytes is let through when the queue is empty
+    """
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.closed = False
+        self._items = collections.deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+
+    def put(self, item, size=0):
+        """ wait for room and queue item, return False if closed meanwhile """
+        with self._cond:
+            while not self.closed and self._items and \
+                    (len(self._items) >= self.max_items or self._bytes + size > self.max_bytes):
+                self._cond.wait(0.5)
+            if self.closed:
+                return False
+            self._items.append((item, size))
+            self._bytes += size
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait(0.5)
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        """ release fetch stage waiting in put() """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
 class GNSyncM:
     """ sync application targeting mongodb """
 
@@ -155,14 +225,15 @@ class GNSyncM:
     notebook_guid = None
 
     sleep_on_ratelimit = False
+    pipeline = True
 
-    def __init__(self, notebook_name, sleep_on_ratelimit=True):
+    def __init__(self, notebook_name, sleep_on_ratelimit=True, pipeline=True, verify_images=False):
         # check auth
         if not Storage().getUserToken():
             raise Exception("Auth error. There is not any oAuthToken.")
 
         # establish mongodb connectivity
-        self.updater = UpdateNote(notebook_name)
+        self.updater = UpdateNote(notebook_name, verify_images=verify_images)
 
         # set notebook to sync from
         logger.debug('Sync notebook=%s ...', notebook_name)
@@ -173,6 +244,10 @@ class GNSyncM:
         self.all_set = True
 
         self.sleep_on_ratelimit = sleep_on_ratelimit
+        self.pipeline = pipeline
+
+    def close(self):
+        self.updater.close()
 
     def _get_notebook(self, notebook_name):
         """
@@ -216,7 +291,21 @@ class GNSyncM:
             return 0
 
         logger.info(u"found %s notes to be synced in notebook %s", len(notes), self.notebook_name)
-        synced = 0
+        if self.pipeline:
+            synced = self._sync_pipelined(notes, changed_after)
+        else:
+            synced = 0
+            for note_obj, db_note, enml in self._fetch(notes, changed_after):
+                if self.updater.apply(note_obj, db_note, enml):
+                    synced += 1  # count number of notes effectively synced
+
+        self.updater.finish()
+        self.updater.update_note_count()
+        logger.info(u'Sync Complete\n')
+        return synced
+
+    def _fetch(self, notes, changed_after, prefetch=False):
+        """ fetch stage: yield notes prepared for update, loaded from EN as needed """
         for note in notes:
             if changed_after is not None:
                 # double checked, as changed_after is used as constraint by _get_notes already
@@ -227,11 +316,52 @@ class GNSyncM:
 
             # wrap note (NoteMetadata object) to provide get_resource_by_hash ...
             note_obj = ENNoteObj(note, self.sleep_on_ratelimit)
-            if self.updater.update(note_obj):
-                synced += 1  # count number of notes effectively synced
-
-        self.updater.update_note_count()
-        logger.info(u'Sync Complete\n')
+            db_note, enml = self.updater.prepare(note_obj)
+            if prefetch and self.updater.content_changed(db_note, enml):
+                # write stage must not call EN api, noteStore is shared and not thread-safe
+                note_obj.load_resources(enml)
+            yield note_obj, db_note, enml
+
+    def _sync_pipelined(self, notes, changed_after):
+        """ fetch from EN in background thread while writing to mongodb
+
+        bounded queue between fetch and write stage, so EN network waits and
+        database / image writes overlap instead of adding up. notes not found
+        in mongodb when fetched are looked up again when written, a note with
+        the same title and date created may have been written meanwhile
+        """
+        prepared = PrefetchQueue(SYNC_QUEUE_SIZE, SYNC_QUEUE_BYTES)
+        done = object()
+        failed = []
+
+        def fetch_stage():
+            try:
+                for item in self._fetch(notes, changed_after, prefetch=True):
+                    if not prepared.put(item, item[0].loaded_size()):
+                        return
+            except BaseException:
+                failed.append(sys.exc_info())
+            prepared.put(done)
+
+        fetcher = threading.Thread(target=fetch_stage, name="gnsyncm-fetch")
+        fetcher.daemon = True
+        fetcher.start()
+        synced = 0
+        try:
+            while True:
+                item = prepared.get()
+                if item is done:
+                    break
+                note_obj, db_note, enml = item
+                if self.updater.apply(note_obj, db_note, enml, lookup=True):
+                    synced += 1  # count number of notes effectively synced
+        finally:
+            prepared.close()
+            fetcher.join()
+        if failed:
+            # failed in fetch stage, reraise with original traceback
+            exc_type, exc_value, exc_tb = failed[0]
+            raise exc_type, exc_value, exc_tb
         return synced
 
     def _get_notes(self, changed_after=None):
@@ -269,6 +399,8 @@ def main():
         parser.add_argument('--incremental', action='store_true', help='only notes created or updated since last successful run')
         parser.add_argument('--keep-lastupdate', action='store_true', help='do not change date last_updated')
         parser.add_argument('--no-sleep-on-ratelimit', action='store_true', help='dont sleep on being ratelimited')
+        parser.add_argument('--verify', action='store_true', help='check size of stored images instead of trusting files collection')
+        parser.add_argument('--sequential', action='store_true', help='dont overlap fetching from EN with writing to mongodb')
 
         args = parser.parse_args()
         logger.info(u"run gnsyncm with args: %s", args)
@@ -305,15 +437,21 @@ def main():
             notes_synced = 0
             for notebook in all_notebooks(sleep_on_ratelimit=sleepOnRateLimit):
                 logger.debug("Syncing notebook %s (%s)", notebook.name, notebook.guid)
-                GNS = GNSyncM(notebook.name, sleep_on_ratelimit=sleepOnRateLimit)
+                GNS = GNSyncM(notebook.name, sleep_on_ratelimit=sleepOnRateLimit, pipeline=not args.sequential, verify_images=args.verify)
                 assert GNS.all_set, "GNSyncM initialization incomplete"
-                notes_synced += GNS.sync(changed_after)
+                try:
+                    notes_synced += GNS.sync(changed_after)
+                finally:
+                    GNS.close()
                 notebook_count += 1
             logger.info(u"synced total %s notebooks, %s notes", notebook_count, notes_synced)
         else:
-            GNS = GNSyncM(notebook_name, sleep_on_ratelimit=sleepOnRateLimit)
+            GNS = GNSyncM(notebook_name, sleep_on_ratelimit=sleepOnRateLimit, pipeline=not args.sequential, verify_images=args.verify)
             assert GNS.all_set, "troubles with GNSyncM initialization"
-            notes_synced = GNS.sync(changed_after)
+            try:
+                notes_synced = GNS.sync(changed_after)
+            finally:
+                GNS.close()
             logger.info("synced notebook %s, %s notes", notebook_name, notes_synced)
 
         if args.incremental and not args.keep_lastupdate:
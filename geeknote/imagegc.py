@@ -0,0 +1,124 @@
+"""
+mark-and-sweep garbage collection of images
+
+mark: collect the ids of files referenced from note_contents, and from the
+previous versions in note_content_histories (restored versions keep their
+images), both ours and those kept by leanote itself; sweep: remove
+unreferenced files of the user in batches from the image store (including
+variants), files and note_images. note_images entries of deleted notes, or
+of images no longer in their note, are removed as well.
+
+images of leanote albums (AlbumId) are never collected. not to be run while
+notes get imported, images of notes not yet written would be collected
+"""
+
+import re
+import zlib
+from bson.objectid import ObjectId
+
+import logging
+logger = logging.getLogger("en2mongo.imagegc")
+
+BATCH_SIZE = 500
+
+# image refs in note content, e.g. /api/file/getImage?fileId=5d9b.. or /file/outputImage?fileId=5d9b..
+FILE_ID_RE = re.compile(r'fileId=([0-9a-fA-F]{24})')
+
+
+def file_ids(content):
+    """ set of ids of files referenced by content """
+    if not content:
+        return set()
+    return set(ObjectId(file_id) for file_id in FILE_ID_RE.findall(content))
+
+
+class ImageGC:
+    """ garbage collection of images of a user, store None to clean up mongodb only """
+
+    def __init__(self, db, user_id, store=None, batch_size=BATCH_SIZE):
+        self.db = db
+        self.user_id = user_id
+        self.store = store
+        self.batch_size = batch_size
+        self.referenced = set()  # file ids
+        self.note_refs = set()  # (note id, file id)
+        self.note_ids = set()
+
+    def run(self, dry_run=False):
+        self.mark()
+        return self.sweep(dry_run)
+
+    def mark(self):
+        for note_content in self.db.note_contents.find({"UserId": self.user_id}, {"Content": 1}):
+            note_id = note_content["_id"]
+            self.note_ids.add(note_id)
+            for file_id in file_ids(note_content.get("Content")):
+                self.referenced.add(file_id)
+                self.note_refs.add((note_id, file_id))
+        current = len(self.referenced)
+
+        for history in self.db.note_content_histories.find({"UserId": self.user_id},
+                                                            {"Versions": 1, "Histories.Content": 1}):
+            for version in history.get("Versions", []):
+                # refs of older versions are in the snapshot or the inserted text of the (json) delta
+                self.referenced.update(file_ids(zlib.decompress(version.get("Snapshot") or version["Delta"])))
+            for version in history.get("Histories", []):
+                # versions kept by leanote itself
+                self.referenced.update(file_ids(version.get("Content")))
+        logger.info("marked %s images referenced by %s notes, %s more by previous versions",
+                    current, len(self.note_ids), len(self.referenced) - current)
+
+    def sweep(self, dry_run=False):
+        """ remove files not marked and stale note_images, return stats """
+        stats = {"files": 0, "bytes": 0, "stored": 0, "missing": 0, "note_images": 0}
+
+        user_files = set()
+        orphans = []
+        for file_obj in self.db.files.find({"UserId": self.user_id},
+                                           {"Path": 1, "Size": 1, "Variants": 1, "AlbumId": 1}):
+            user_files.add(file_obj["_id"])
+            if file_obj["_id"] in self.referenced or file_obj.get("AlbumId"):
+                continue
+            orphans.append(file_obj)
+            stats["files"] += 1
+            stats["bytes"] += (file_obj.get("Size") or 0) + \
+                sum(variant.get("Size") or 0 for variant in file_obj.get("Variants", []))
+            logger.debug("unreferenced image %s", file_obj.get("Path"))
+
+        for start in range(0, len(orphans), self.batch_size):
+            self._remove_files(orphans[start:start + self.batch_size], stats, dry_run)
+
+        stale = []
+        for note_image in self.db.note_images.find({}, {"NoteId": 1, "ImageId": 1}):
+            if note_image["NoteId"] not in self.note_ids and note_image["ImageId"] not in user_files:
+                continue  # other user
+            if (note_image["NoteId"], note_image["ImageId"]) not in self.note_refs:
+                stale.append(note_image["_id"])
+        stats["note_images"] = len(stale)
+        if not dry_run:
+            for start in range(0, len(stale), self.batch_size):
+                self.db.note_images.delete_many({"_id": {"$in": stale[start:start + self.batch_size]}})
+
+        logger.info("%s %s unreferenced images (%s bytes), %s stale note_images",
+                    "found" if dry_run else "removed", stats["files"], stats["bytes"], stats["note_images"])
+        if self.store is not None and not dry_run:
+            logger.info("deleted %s stored images, %s were missing already", stats["stored"], stats["missing"])
+        return stats
+
+    def _remove_files(self, batch, stats, dry_run):
+        if dry_run:
+            return
+        if self.store is not None:
+            # store first, files left behind by an interrupted run are collected next time
+            for file_obj in batch:
+                paths = [file_obj.get("Path")] + [variant.get("Path") for variant in file_obj.get("Variants", [])]
+                for path in paths:
+                    if not path:
+                        continue
+                    if self.store.delete(path):
+                        stats["stored"] += 1
+                    else:
+                        stats["missing"] += 1
+        ids = [file_obj["_id"] for file_obj in batch]
+        self.db.files.delete_many({"_id": {"$in": ids}})
+        self.db.note_images.delete_many({"ImageId": {"$in": ids}})
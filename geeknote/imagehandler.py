@@ -4,78 +4,449 @@ handle images referenced by notes in mongodb
 
 import config
 
+import os
 import io
+import sys
+import shutil
+import threading
+import Queue
+import ftplib
 from ftplib import FTP
+import gridfs
 
 import logging
 logger = logging.getLogger("en2mongo.imagehandler")
 
+# errors after which a ftp session is dropped and the operation retried on a new one
+CONNECTION_ERRORS = (EOFError, IOError, ftplib.error_temp, ftplib.error_reply, ftplib.error_proto)
 
-class ImageHandler:
 
-    def __init__(self):
-        self.ftp = FTP(config.FTP_HOST)
-        self.ftp.login(config.FTP_USER, config.FTP_PWD)
+def join_path(img_dir, img_name):
+    """ path of img_name in img_dir, with or without trailing slash """
+    if not img_dir.endswith('/'):
+        img_dir += '/'
+    return img_dir + img_name
 
-    def upload_image(self, img_dir, img_name, img_data):
+
+class FTPPool:
+    """ pool of logged-in FTP sessions
+
+    broken sessions (e.g. 421 Timeout) are dropped and replaced by new ones
+    """
+
+    def __init__(self, size, retries=5):
+        self.size = size
+        self.retries = retries
+        self._idle = Queue.Queue()
+        self._slots = threading.Semaphore(size)
+
+    def _connect(self):
+        ftp = FTP()
+        ftp.connect(config.FTP_HOST, config.FTP_PORT)
+        ftp.login(config.FTP_USER, config.FTP_PWD)
+        return ftp
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, ftp, broken=False):
+        if broken:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+        else:
+            self._idle.put(ftp)
+        self._slots.release()
+
+    def run(self, operation):
+        """ call operation(ftp) with a pooled session, retry on new session if connection fails """
+        retry = self.retries
+        while 1:
+            ftp = None
+            try:
+                ftp = self._acquire()
+                result = operation(ftp)
+            except CONNECTION_ERRORS as err:
+                # 421 Timeout, after retry / login:
+                # error(10053, 'Eine bestehende Verbindung wurde softwaregesteuert\r\ndurch den Hostcomputer abgebrochen')
+                if ftp is not None:
+                    self._release(ftp, broken=True)
+                if retry <= 0:
+                    raise RuntimeError("ftp connection failed: %s" % err)
+                logger.warning("ftp connection failed, reconnecting - %s", err)
+                retry -= 1
+            except Exception:
+                if ftp is not None:
+                    self._release(ftp)
+                raise
+            else:
+                self._release(ftp)
+                return result
+
+    def close(self):
+        while 1:
+            try:
+                ftp = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                pass
+
+
+class UploadTask:
+    """ image upload submitted to ImageHandler, done when uploaded or failed """
+
+    def __init__(self, img_dir, img_name, img_data):
+        self.img_dir = img_dir
+        self.img_name = img_name
+        self.img_data = img_data
+        self.img_path = None
+        self.exc_info = None
+        self._done = threading.Event()
+
+    def finish(self, img_path=None, exc_info=None):
+        self.img_path = img_path
+        self.exc_info = exc_info
+        self.img_data = None  # free image body
+        self._done.set()
+
+    def wait(self):
+        """ wait for upload, return path of uploaded image, reraise upload failure """
+        self._done.wait()
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_tb = self.exc_info
+            raise exc_type, exc_value, exc_tb
+        return self.img_path
+
+
+class ImageStoreBase:
+    """ storage backend for images, paths are relative to leanote's base directory """
+
+    workers = 1  # parallel uploads
+
+    def put(self, img_dir, img_name, fp):
+        """ store image read from fp as img_dir + img_name, return path of image """
+        assert False, 'put to be implemented by derived class'
+
+    def size(self, img_path):
+        """ size of stored image, None if missing """
+        assert False, 'size to be implemented by derived class'
+
+    def delete(self, img_path):
+        """ remove stored image, return False if missing """
+        assert False, 'delete to be implemented by derived class'
+
+    def retrieve(self, img_path, fp):
+        """ write stored image to fp, return False if missing """
+        assert False, 'retrieve to be implemented by derived class'
+
+    def close(self):
+        pass
+
+
+class FTPStore(ImageStoreBase):
+    """ upload to leanote file storage through ftp """
+
+    def __init__(self, connections=None):
+        if connections is None:
+            connections = config.FTP_CONNECTIONS
+        self.workers = connections
+        self.pool = FTPPool(connections)
+        # remote directories known to exist, filled as directories are listed or created;
+        # leanote's files/ is taken as given, as an empty listing may also mean missing
+        self._known_dirs = set(['files/'])
+        self._lock = threading.Lock()
+
+    def put(self, img_dir, img_name, fp):
+        return self.pool.run(lambda ftp: self._upload(ftp, img_dir, img_name, fp))
+
+    def size(self, img_path):
+        def get_size(ftp):
+            ftp.voidcmd('TYPE I')  # SIZE is not reliable in ascii mode
+            try:
+                return ftp.size(img_path)
+            except ftplib.error_perm:
+                return None  # 550 No such file
+        return self.pool.run(get_size)
+
+    def delete(self, img_path):
+        def delete_file(ftp):
+            try:
+                ftp.delete(img_path)
+            except ftplib.error_perm:
+                return False  # 550 No such file
+            return True
+        return self.pool.run(delete_file)
+
+    def retrieve(self, img_path, fp):
+        def retrieve_file(ftp):
+            fp.seek(0)  # may be a retry
+            fp.truncate()
+            try:
+                ftp.retrbinary("RETR %s" % img_path, fp.write)
+            except ftplib.error_perm:
+                return False  # 550 No such file
+            return True
+        return self.pool.run(retrieve_file)
+
+    def close(self):
+        self.pool.close()
+
+    def _upload(self, ftp, img_dir, img_name, fp):
         logger.debug("prepare image upload to %s", img_dir)
-        img_dir = self._prepare_upload_target(self.ftp, img_dir)
+        img_dir = self._prepare_upload_target(ftp, img_dir)
         logger.debug("upload image '%s' to '%s'", img_name, img_dir)
-        fp = io.BytesIO(img_data)
-        img_path = "%s/%s" % (img_dir, img_name)
-        self.ftp.storbinary("STOR %s" % img_path, fp)
+        fp.seek(0)  # may be a retry
+        img_path = join_path(img_dir, img_name)
+        ftp.storbinary("STOR %s" % img_path, fp)
         return img_path
 
     def _prepare_upload_target(self, ftp, img_dir):
+        if img_dir in self._known_dirs:
+            return img_dir  # steady state, no extra round trips
+
+        create_steps = []
+        dir_path = img_dir
+        while dir_path not in self._known_dirs and not self._list_dir(ftp, dir_path):
+            create_steps.append(dir_path)
+            dir_path = dir_path[:-1]  # strip trailing slash
+            assert '/' in dir_path
+            dir_path = dir_path[:dir_path.rfind('/') + 1]
+        self._add_known_dir(dir_path)
+
+        while create_steps:
+            dir_path = create_steps.pop()
+            try:
+                ftp.mkd(dir_path)
+            except ftplib.error_perm as err:
+                # error_perm('550 Create directory operation failed.',)
+                # happens under not yet determined circumstances, although directory is created successfully
+                # (or created meanwhile by another upload worker)
+                # double-check to avoid false positive errors
+                pardir = '/'.join(dir_path.rsplit('/')[:-2])
+                subdir = dir_path.rsplit('/')[-2]
+                test = [d for d in self._list_dir(ftp, pardir) if d == subdir or d.endswith('/' + subdir)]
+                if test:
+                    logger.warning("ftp reported error creating %s, but exists", dir_path)
+                    self._add_known_dir(dir_path)
+                    continue
+                logger.error("ftp.mkd failed for %s %s", dir_path, err)
+                raise RuntimeError("failed create directory %s to upload image " % dir_path)
+            else:
+                # logger.debug('created ftp dir %s', dir_path)
+                self._add_known_dir(dir_path)
+
+        return img_dir
+
+    def _list_dir(self, ftp, dir_path):
+        """ names in directory, empty if missing (some servers answer 550 instead of an empty list) """
+        try:
+            return ftp.nlst(dir_path)
+        except ftplib.error_perm:
+            return []
+
+    def _add_known_dir(self, dir_path):
+        """ remember dir_path and its parents as existing """
+        with self._lock:
+            while dir_path not in self._known_dirs and '/' in dir_path[:-1]:
+                self._known_dirs.add(dir_path)
+                dir_path = dir_path[:dir_path[:-1].rfind('/') + 1]
+            self._known_dirs.add(dir_path)
+
+
+class LocalStore(ImageStoreBase):
+    """ write to leanote's files directory on local disk (or mounted volume) """
+
+    workers = 2
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir or config.IMAGE_STORE_DIR
+        assert self.base_dir and os.path.isdir(self.base_dir), \
+            "missing leanote base directory for local image store: %s" % self.base_dir
+
+    def put(self, img_dir, img_name, fp):
+        img_path = join_path(img_dir, img_name)
+        local_dir = os.path.join(self.base_dir, *img_dir.split('/'))
+        if not os.path.isdir(local_dir):
+            try:
+                os.makedirs(local_dir)
+            except OSError:
+                if not os.path.isdir(local_dir):  # created meanwhile by other worker?
+                    raise
+        local_path = os.path.join(local_dir, img_name)
+        fp.seek(0)
+        with open(local_path + '.part', 'wb') as img_file:
+            shutil.copyfileobj(fp, img_file)
+        if os.path.exists(local_path):
+            os.remove(local_path)  # os.rename does not replace on windows
+        os.rename(local_path + '.part', local_path)
+        return img_path
+
+    def size(self, img_path):
+        local_path = os.path.join(self.base_dir, *img_path.split('/'))
+        if not os.path.isfile(local_path):
+            return None
+        return os.path.getsize(local_path)
+
+    def delete(self, img_path):
+        local_path = os.path.join(self.base_dir, *img_path.split('/'))
+        if not os.path.isfile(local_path):
+            return False
+        os.remove(local_path)
+        return True
+
+    def retrieve(self, img_path, fp):
+        local_path = os.path.join(self.base_dir, *img_path.split('/'))
+        if not os.path.isfile(local_path):
+            return False
+        with open(local_path, 'rb') as img_file:
+            shutil.copyfileobj(img_file, fp)
+        return True
+
+
+class GridFSStore(ImageStoreBase):
+    """ store images in GridFS of leanote's mongodb, file name is the image path """
+
+    workers = 2
+
+    def __init__(self, db):
+        self.fs = gridfs.GridFS(db, collection=config.IMAGE_STORE_GRIDFS)
+
+    def put(self, img_dir, img_name, fp):
+        img_path = join_path(img_dir, img_name)
+        fp.seek(0)
+        file_id = self.fs.put(fp, filename=img_path)
+        for old_file in self.fs.find({"filename": img_path, "_id": {"$ne": file_id}}):
+            self.fs.delete(old_file._id)  # replaced
+        return img_path
+
+    def size(self, img_path):
+        grid_out = self.fs.find_one({"filename": img_path})
+        if grid_out is None:
+            return None
+        return grid_out.length
+
+    def delete(self, img_path):
+        deleted = False
+        for grid_out in self.fs.find({"filename": img_path}):
+            self.fs.delete(grid_out._id)
+            deleted = True
+        return deleted
+
+    def retrieve(self, img_path, fp):
+        grid_out = self.fs.find_one({"filename": img_path})
+        if grid_out is None:
+            return False
+        shutil.copyfileobj(grid_out, fp)
+        return True
+
+
+IMAGE_STORES = {
+    'ftp': FTPStore,
+    'local': LocalStore,
+    'gridfs': GridFSStore,
+}
+
+
+def get_image_store(db=None, name=None):
+    """ create image store selected by config.IMAGE_STORE """
+    name = name or config.IMAGE_STORE
+    if name not in IMAGE_STORES:
+        raise ValueError("unknown image store %s, expected one of %s" % (name, ', '.join(sorted(IMAGE_STORES))))
+    if name == 'gridfs':
+        assert db is not None, "must have db for gridfs image store"
+        return GridFSStore(db)
+    return IMAGE_STORES[name]()
+
+
+class ImageHandler:
+
+    def __init__(self, store=None):
+        if store is None:
+            store = get_image_store()
+        self.store = store
+        # bounded, so image bodies waiting for upload do not pile up in memory
+        self._queue = Queue.Queue(maxsize=2 * store.workers)
+        self._workers = []
+        for n in range(store.workers):
+            worker = threading.Thread(target=self._upload_worker, name="imagehandler-%s" % n)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def target_dir(self, img_dir):
+        """ directory images for img_dir get uploaded to """
         if not img_dir.startswith('files/'):
             img_dir = 'files/' + img_dir
         if not img_dir.endswith('/'):
             img_dir += '/'
+        return img_dir
 
-        create_steps = []
-        dir_path = img_dir
-        retry = 5
+    def target_path(self, img_dir, img_name):
+        """ path of image after upload, as returned by upload_image """
+        return join_path(self.target_dir(img_dir), img_name)
+
+    def submit(self, img_dir, img_name, img_data):
+        """ queue image for upload, returns UploadTask to wait for
+
+        img_data is the image body or a file-like object to stream it from,
+        which must not be used elsewhere until the upload is done
+        """
+        task = UploadTask(img_dir, img_name, img_data)
+        self._queue.put(task)
+        return task
+
+    def wait(self, tasks):
+        """ wait until all tasks are done, raise first failure """
+        failed = None
+        for task in tasks:
+            try:
+                task.wait()
+            except Exception:
+                if failed is None:
+                    failed = sys.exc_info()
+        if failed is not None:
+            raise failed[0], failed[1], failed[2]
+
+    def upload_image(self, img_dir, img_name, img_data):
+        return self.submit(img_dir, img_name, img_data).wait()
+
+    def stored_size(self, img_path):
+        """ size of image as stored, None if missing """
+        return self.store.size(img_path)
+
+    def close(self):
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self.store.close()
+
+    def _upload_worker(self):
         while 1:
+            task = self._queue.get()
+            if task is None:
+                break
             try:
-                while not ftp.nlst(dir_path):
-                    create_steps.append(dir_path)
-                    dir_path = dir_path[:-1]  # strip trailing slash
-                    assert '/' in dir_path
-                    dir_path = dir_path[:dir_path.rfind('/') + 1]
-
-                while create_steps:
-                    dir_path = create_steps.pop()
-                    try:
-                        ftp.mkd(dir_path)
-                    except Exception as err:
-                        # error_perm('550 Create directory operation failed.',)
-                        # happens under not yet determined circumstances, although directory is created successfully
-                        # double-check to avoid false positive errors
-                        pardir = '/'.join(dir_path.rsplit('/')[:-2])
-                        subdir = dir_path.rsplit('/')[-2]
-                        test = [d for d in ftp.nlst(pardir) if d.endswith('/' + subdir)]
-                        if test:
-                            logger.warning("ftp reported error creating %s, but exists", dir_path)
-                            continue
-                        logger.error("ftp.mkd failed for %s %s", dir_path, err)
-                        retry = 0
-                        raise RuntimeError("failed create directory %s to upload image " % dir_path)
-                    else:
-                        # logger.debug('created ftp dir %s', dir_path)
-                        pass
-
-            except Exception as err:
-                # 421 Timeout, after retry / login:
-                # error(10053, 'Eine bestehende Verbindung wurde softwaregesteuert\r\ndurch den Hostcomputer abgebrochen')
-                # failed to restore connectivity
-                if retry > 0:
-                    # session expired? unfortunately does not fix it
-                    self.ftp = FTP(config.FTP_HOST)
-                    self.ftp.login(config.FTP_USER, config.FTP_PWD)
-                    retry -= 1
-                else:
-                    raise RuntimeError("failed to prepare upload target")
+                fp = task.img_data
+                if not hasattr(fp, 'read'):
+                    fp = io.BytesIO(fp)
+                img_path = self.store.put(self.target_dir(task.img_dir), task.img_name, fp)
+            except Exception:
+                logger.error("upload of image %s to %s failed", task.img_name, task.img_dir)
+                task.finish(exc_info=sys.exc_info())
             else:
-                break
-
-        return img_dir
+                task.finish(img_path)
@@ -0,0 +1,110 @@
+"""
+size-capped, recompressed variants of images (web size, thumbnail)
+
+variants are computed in a process pool - a thread pool within daemonic
+processes (enex2mongo --jobs workers), which must not have child processes.
+requires Pillow (optional dependency)
+configured through IMAGE_VARIANTS, e.g. "web:1600,thumb:240" (name:max width/height)
+"""
+
+import io
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import logging
+logger = logging.getLogger("en2mongo.imagevariants")
+
+WEB_MIN_BYTES = 256 * 1024  # smaller images are served as they are
+JPEG_QUALITY = 85
+
+
+def parse_variants(spec):
+    """ parse "web:1600,thumb:240" into (name, max size) pairs """
+    variants = []
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, max_size = item.partition(':')
+        variants.append((name.strip(), int(max_size)))
+    return variants
+
+
+def _encode(image, has_alpha):
+    """ recompress image, png if transparent (keep alpha), jpeg otherwise """
+    output = io.BytesIO()
+    if has_alpha:
+        image.save(output, 'PNG', optimize=True)
+        return output.getvalue(), 'png'
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return output.getvalue(), 'jpg'
+
+
+def make_variants(data, variants):
+    """ create variants for image data, runs in worker process
+
+    returns list of dicts with Name, Extension, Width, Height and Data;
+    variants that would not be smaller than the original are skipped
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        # not an image PIL can handle (e.g. svg), keep original only
+        return []
+    if getattr(image, 'is_animated', False):
+        return []  # keep animated gifs as they are
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    width, height = image.size
+    results = []
+    for name, max_size in variants:
+        if max(width, height) <= max_size and (name != 'web' or len(data) < WEB_MIN_BYTES):
+            continue  # small enough already
+        variant = image.copy()
+        variant.thumbnail((max_size, max_size), Image.ANTIALIAS)
+        variant_data, extension = _encode(variant, has_alpha)
+        if len(variant_data) >= len(data):
+            continue
+        results.append({
+            'Name': name,
+            'Extension': extension,
+            'Width': variant.size[0],
+            'Height': variant.size[1],
+            'Data': variant_data,
+        })
+    return results
+
+
+class ImageVariants:
+    """ compute image variants in a process pool
+
+    to be created before threads are started, the pool forks right away
+    """
+
+    def __init__(self, variants, processes=None):
+        assert Image is not None, "image variants require Pillow (pip install Pillow)"
+        self.variants = variants
+        self.processes = processes
+        if multiprocessing.current_process().daemon:
+            logger.debug("in daemonic process, create image variants in threads")
+            self._pool = ThreadPool(processes)
+        else:
+            self._pool = multiprocessing.Pool(processes)
+
+    def submit(self, data):
+        """ start creating variants for image data, returns AsyncResult (list of variants) """
+        return self._pool.apply_async(make_variants, (data, self.variants))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
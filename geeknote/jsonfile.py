@@ -0,0 +1,45 @@
+"""
+json files of the import state (checkpoints, manifests, upload queue jobs),
+written to a .part file, then renamed over the file - atomic on posix, so a
+crash never leaves a partial one. windows cannot rename over an existing
+file, there it is removed first; read_json falls back to the .part if a crash
+came in between
+"""
+
+import os
+import json
+
+
+def _replace(path):
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)  # os.rename does not replace on windows
+    os.rename(path + '.part', path)
+
+
+def read_json(path, default=None):
+    """ load json file, default if missing (and no complete .part left by an interrupted replace) """
+    if os.path.isfile(path):
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    if not os.path.isfile(path + '.part'):
+        return default
+    try:
+        with open(path + '.part', 'r') as json_file:
+            return json.load(json_file)
+    except ValueError:
+        return default  # interrupted while written
+
+
+def write_json(path, info):
+    """ replace json file """
+    with open(path + '.part', 'w') as json_file:
+        json.dump(info, json_file, indent=1)
+    _replace(path)
+
+
+def write_jsonl(path, infos):
+    """ replace file with one json line per info """
+    with open(path + '.part', 'w') as json_file:
+        for info in infos:
+            json_file.write(json.dumps(info) + '\n')
+    _replace(path)
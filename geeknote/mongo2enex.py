@@ -0,0 +1,284 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+export notes from leanote's mongodb into .enex files, one per notebook
+
+notes are read in cursor batches together with their note_contents, files
+and attachs entries; images and attachments are fetched from the image store
+one at a time (spooled to a temporary file if large) and base64 encoded
+chunk by chunk into the .enex, so memory does not grow with the export.
+with --since-usn only notes changed since (Usn greater than) are exported,
+into subdirectory usn<N> of the output directory - next to the full export,
+and named by notebook, so enex2mongo imports them into the same notebooks
+
+    python geeknote/mongo2enex.py backup/ --notebook diary --since-usn 1200
+    (writes backup/usn1200/diary.enex)
+"""
+
+import sys
+import os
+import base64
+import argparse
+import mimetypes
+import tempfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+import pytz
+
+from imagehandler import get_image_store
+import enml
+import config
+
+import logging
+logger = logging.getLogger("en2mongo.mongo2enex")
+
+BATCH_SIZE = 100  # notes read at once
+ENCODE_CHUNK_SIZE = 57 * 1024  # bytes encoded at once, multiple of 57 for whole base64 lines
+SPOOL_MAX_SIZE = 1024 * 1024  # larger images are spooled to a temporary file
+
+ENEX_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">\n' \
+    '<en-export export-date="%s" application="geeknote/mongo2enex" version="1.0">\n'
+
+
+def enex_date(timestamp):
+    """ .enex timestamp YYYYMMDDTHHMMSSZ for (naive utc or aware) datetime """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.utc)
+    return timestamp.strftime('%Y%m%dT%H%M%SZ')
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return escape(value or '')
+
+
+class EnexWriter:
+    """ write notes into .enex file, incrementally; file appears when closed """
+
+    def __init__(self, path):
+        self.path = path
+        self.notes = 0
+        self._file = open(path + '.part', 'wb')
+        self._file.write(ENEX_HEAD % enex_date(datetime.utcnow()))
+
+    def start_note(self, title, content, created=None, updated=None, tags=()):
+        """ write note up to its resources, content is utf-8 encoded ENML """
+        out = self._file
+        out.write('<note><title>%s</title>' % _text(title))
+        # ]]> must not end the CDATA section early
+        out.write('<content><![CDATA[%s]]></content>' % content.replace(']]>', ']]]]><![CDATA[>'))
+        if created is not None:
+            out.write('<created>%s</created>' % enex_date(created))
+        if updated is not None:
+            out.write('<updated>%s</updated>' % enex_date(updated))
+        for tag in tags:
+            out.write('<tag>%s</tag>' % _text(tag))
+        out.write('\n')
+
+    def resource(self, fp, mime_type, filename=None):
+        """ write resource with body read from fp, return its size """
+        out = self._file
+        out.write('<resource><data encoding="base64">\n')
+        fp.seek(0)
+        size = 0
+        while 1:
+            chunk = fp.read(ENCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            out.write(base64.encodestring(chunk))
+        out.write('</data><mime>%s</mime>' % _text(mime_type))
+        if filename:
+            out.write('<resource-attributes><file-name>%s</file-name></resource-attributes>' % _text(filename))
+        out.write('</resource>\n')
+        return size
+
+    def end_note(self):
+        self._file.write('</note>\n')
+        self.notes += 1
+
+    def close(self):
+        self._file.write('</en-export>\n')
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)  # os.rename does not replace on windows
+        os.rename(self.path + '.part', self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path + '.part')
+
+
+class MongoExporter:
+    """ export notes of user from mongodb, images and attachments from store """
+
+    def __init__(self, db, user, store, batch_size=BATCH_SIZE):
+        self.db = db
+        self.user = user
+        self.store = store
+        self.batch_size = batch_size
+
+    def notebooks(self, names=None):
+        """ notebooks of user, those with given titles only if names """
+        query = {"UserId": self.user['_id'], "IsDeleted": {"$ne": True}}
+        if names:
+            query["Title"] = {"$in": [name.lower() for name in names]}
+        return list(self.db.notebooks.find(query, {"Title": 1}))
+
+    def export_notebook(self, notebook, enex_path, since_usn=None):
+        """ write notes of notebook to .enex, return number of notes and highest usn exported """
+        query = {"NotebookId": notebook['_id'], "UserId": self.user['_id'],
+                 "IsDeleted": {"$ne": True}, "IsTrash": {"$ne": True}}
+        if since_usn is not None:
+            query["Usn"] = {"$gt": since_usn}
+        cursor = self.db.notes.find(query).sort("Usn", 1).batch_size(self.batch_size)
+        writer = None
+        max_usn = since_usn
+        batch = []
+        try:
+            for db_note in cursor:
+                batch.append(db_note)
+                max_usn = max(max_usn, db_note.get('Usn'))
+                if len(batch) == self.batch_size:
+                    writer = writer or EnexWriter(enex_path)
+                    self._export_batch(writer, batch)
+                    batch = []
+            if batch:
+                writer = writer or EnexWriter(enex_path)
+                self._export_batch(writer, batch)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is None:
+            return 0, max_usn  # no .enex without notes
+        writer.close()
+        return writer.notes, max_usn
+
+    def _export_batch(self, writer, batch):
+        """ write batch of notes, reading their contents, files and attachs entries at once """
+        note_ids = [db_note['_id'] for db_note in batch]
+        contents = dict((note_content['_id'], note_content.get('Content'))
+                        for note_content in self.db.note_contents.find({"_id": {"$in": note_ids}}, {"Content": 1}))
+        image_ids = set(note_image['ImageId']
+                        for note_image in self.db.note_images.find({"NoteId": {"$in": note_ids}}, {"ImageId": 1}))
+        files = dict((file_obj['_id'], file_obj) for file_obj in self.db.files.find(
+            {"_id": {"$in": list(image_ids)}, "UserId": self.user['_id']}, {"Path": 1, "Title": 1, "Hash": 1}))
+        attachs = dict((attach_obj['_id'], attach_obj) for attach_obj in self.db.attachs.find(
+            {"NoteId": {"$in": note_ids}}, {"Path": 1, "Title": 1, "Hash": 1, "NoteId": 1}))
+        for db_note in batch:
+            self._export_note(writer, db_note, contents.get(db_note['_id']), files, attachs)
+
+    def _file_obj(self, file_id, files):
+        file_obj = files.get(file_id)
+        if file_obj is None:
+            # image not linked in note_images (e.g. inserted in leanote)
+            file_obj = self.db.files.find_one({"_id": file_id, "UserId": self.user['_id']},
+                                              {"Path": 1, "Title": 1, "Hash": 1})
+            files[file_id] = file_obj
+        return file_obj
+
+    def _export_note(self, writer, db_note, content, files, attachs):
+        resources = []  # (spooled body, mime type, file name)
+        resolved = {}
+
+        def resolve_image(file_id):
+            file_obj = self._file_obj(ObjectId(file_id), files)
+            if file_obj is None:
+                logger.warning(u"missing image %s of note %s", file_id, db_note['Title'])
+                return None
+            title = file_obj.get('Title') or ''
+            media_hash = file_obj.get('Hash') or title.rsplit('.', 1)[0]
+            extension = title.rsplit('.', 1)[1] if '.' in title else 'png'
+            return self._add_resource(db_note, resources, resolved, file_obj['Path'], media_hash,
+                                      'image/' + extension, None)
+
+        def resolve_attachment(attach_id):
+            attach_obj = attachs.get(ObjectId(attach_id))
+            if attach_obj is None or attach_obj['NoteId'] != db_note['_id']:
+                logger.warning(u"missing attachment %s of note %s", attach_id, db_note['Title'])
+                return None
+            mime_type = mimetypes.guess_type(attach_obj['Title'])[0] or 'application/octet-stream'
+            return self._add_resource(db_note, resources, resolved, attach_obj['Path'], attach_obj['Hash'],
+                                      mime_type, attach_obj['Title'])
+
+        try:
+            # bodies are retrieved while resolving, elements of missing ones are kept
+            enml_content = enml.restore(content or '', resolve_image, resolve_attachment)
+            tags = [tag for tag in db_note.get('Tags') or [] if tag]
+            writer.start_note(db_note['Title'], enml_content,
+                              db_note.get('CreatedTime'), db_note.get('UpdatedTime'), tags)
+            for body, mime_type, filename in resources:
+                writer.resource(body, mime_type, filename)
+            writer.end_note()
+        finally:
+            for body, mime_type, filename in resources:
+                body.close()
+
+    def _add_resource(self, db_note, resources, resolved, path, media_hash, mime_type, filename):
+        """ retrieve body of resource once, return (hash, mime type) for en-media or None if missing """
+        if media_hash not in resolved:
+            body = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+            if self.store.retrieve(path, body):
+                resources.append((body, mime_type, filename))
+                resolved[media_hash] = (media_hash, mime_type)
+            else:
+                logger.warning(u"missing stored file %s of note %s", path, db_note['Title'])
+                body.close()
+                resolved[media_hash] = None
+        return resolved[media_hash]
+
+
+def enex_filename(notebook_title):
+    return notebook_title.replace('/', '_').replace('\\', '_') + '.enex'
+
+
+def export_dir(output, since_usn=None):
+    """ directory to write the .enex files to, see module doc """
+    if since_usn is None:
+        return output
+    return os.path.join(output, 'usn%s' % since_usn)
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help='directory to write .enex files to')
+    parser.add_argument('--notebook', '-n', action='append', help='notebook to export (repeatable), default all')
+    parser.add_argument('--since-usn', type=int, help='export only notes changed since (Usn greater than)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='notes read from mongodb at once')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    logging.basicConfig(format='%(asctime)-15s %(levelname)s  %(message)s', level=logging.INFO)
+    logger.info("run mongo2enex with args: %s", args)
+    try:
+        output_dir = export_dir(args.output, args.since_usn)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        db = MongoClient(config.DB_URI)[config.DB_NAME]
+        user = db.users.find_one({"Username": config.DB_USERNAME})
+        assert user is not None, "failed to lookup db user %s" % config.DB_USERNAME
+        store = get_image_store(db)
+        exporter = MongoExporter(db, user, store, args.batch_size)
+        max_usn = args.since_usn
+        for notebook in exporter.notebooks(args.notebook):
+            enex_path = os.path.join(output_dir, enex_filename(notebook['Title']))
+            count, usn = exporter.export_notebook(notebook, enex_path, args.since_usn)
+            logger.info(u"exported %s notes of %s", count, notebook['Title'])
+            max_usn = max(max_usn, usn)
+        store.close()
+        logger.info("mongo2enex succeeded, highest usn exported: %s", max_usn)
+    except Exception as err:
+        logger.exception("mongo2enex failed - %s", err)
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main()
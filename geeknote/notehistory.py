@@ -0,0 +1,140 @@
+"""
+previous versions of note content, kept in note_content_histories
+
+versions are kept newest first, at most max_versions per note; the newest
+is a compressed snapshot, each older one a compressed delta against the next
+newer version. the chain does not depend on note_contents, so notes edited
+in leanote meanwhile do not break it:
+
+    {"_id": NoteId, "UserId": .., "Versions": [
+        {"UpdatedTime": .., "UpdatedUserId": .., "Size": .., "Snapshot": Binary(zlib(utf-8))},
+        {"UpdatedTime": .., "UpdatedUserId": .., "Size": .., "Delta": Binary(zlib(json))}, ...
+    ]}
+
+a delta is a list of operations applied to the tokens of the newer version,
+[0, i1, i2] copies tokens i1:i2, [1, "text"] inserts text.
+leanote's own history (Histories, full contents) may share the document
+"""
+
+import re
+import json
+import zlib
+import difflib
+from bson.binary import Binary
+
+import logging
+logger = logging.getLogger("en2mongo.notehistory")
+
+MAX_VERSIONS = 10
+
+# ENML has long lines (web clips), so split after each tag or newline
+TOKEN_RE = re.compile(r'[^>\n]*(?:>|\n)|[^>\n]+')
+
+
+def _to_unicode(content):
+    if content is None:
+        return u''
+    if not isinstance(content, unicode):
+        content = unicode(content, 'utf-8', 'replace')
+    return content
+
+
+def tokenize(content):
+    return TOKEN_RE.findall(_to_unicode(content))
+
+
+def make_delta(newer, older):
+    """ delta to restore older content from newer content """
+    newer_tokens = tokenize(newer)
+    older_tokens = tokenize(older)
+    matcher = difflib.SequenceMatcher(None, newer_tokens, older_tokens, autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([0, i1, i2])
+        elif j2 > j1:  # replace, insert
+            ops.append([1, u''.join(older_tokens[j1:j2])])
+        # delete: nothing to copy
+    return ops
+
+
+def apply_delta(newer, ops):
+    """ restore older content from newer content and delta """
+    newer_tokens = tokenize(newer)
+    parts = []
+    for op in ops:
+        if op[0] == 0:
+            parts.extend(newer_tokens[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return u''.join(parts)
+
+
+def pack_delta(ops):
+    return Binary(zlib.compress(json.dumps(ops, separators=(',', ':')), 9))
+
+
+def unpack_delta(data):
+    return json.loads(zlib.decompress(data))
+
+
+def pack_snapshot(content):
+    return Binary(zlib.compress(_to_unicode(content).encode('utf-8'), 9))
+
+
+def unpack_snapshot(data):
+    return unicode(zlib.decompress(data), 'utf-8')
+
+
+class NoteHistory:
+    """ note content versions in note_content_histories """
+
+    def __init__(self, db, max_versions=MAX_VERSIONS):
+        self.db = db
+        self.max_versions = max_versions
+
+    def add(self, note_id, user_id, old_content, new_content, updated_time, updated_user_id):
+        """ keep old_content (updated at updated_time) as previous version of new_content """
+        if self.max_versions <= 0:
+            return
+        old_content = _to_unicode(old_content)
+        if old_content == _to_unicode(new_content):
+            return
+        history = self.db.note_content_histories.find_one({"_id": note_id}, {"Versions": 1})
+        versions = history.get("Versions", []) if history is not None else []
+        if versions and "Snapshot" in versions[0]:
+            # previous snapshot becomes delta against the version added now
+            head = dict(versions[0])
+            head["Delta"] = pack_delta(make_delta(old_content, unpack_snapshot(head.pop("Snapshot"))))
+            versions[0] = head
+        versions.insert(0, {
+            "UpdatedTime": updated_time,
+            "UpdatedUserId": updated_user_id,
+            "Size": len(old_content),
+            "Snapshot": pack_snapshot(old_content),
+        })
+        self.db.note_content_histories.update_one(
+            {"_id": note_id},
+            {
+                "$setOnInsert": {"UserId": user_id},
+                "$set": {"Versions": versions[:self.max_versions]},
+            },
+            upsert=True
+        )
+        logger.debug("added history for note %s, %s versions", note_id, min(len(versions), self.max_versions))
+
+    def versions(self, note_id):
+        """ yield (UpdatedTime, content) of previous versions, newest first """
+        history = self.db.note_content_histories.find_one({"_id": note_id}, {"Versions": 1})
+        if history is None:
+            return
+        content = None
+        for version in history.get("Versions", []):
+            if "Snapshot" in version:
+                content = unpack_snapshot(version["Snapshot"])
+            else:
+                content = apply_delta(content, unpack_delta(version["Delta"]))
+            yield version["UpdatedTime"], content
+
+    def purge(self, note_id):
+        self.db.note_content_histories.delete_one({"_id": note_id})
@@ -0,0 +1,131 @@
+"""
+tags of a leanote user, kept in memory while syncing
+and written back to mongodb in bulk
+"""
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import logging
+logger = logging.getLogger("en2mongo.tagregistry")
+
+
+class TagRegistry:
+    """ user tags and note_tags counts, loaded once per run
+
+    count changes are collected as deltas and written back on flush(),
+    using $inc so concurrent importers do not overwrite each others counts
+    """
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+        self._load()
+
+    def _load(self):
+        tags = self.db.tags.find_one({'_id': self.user_id})
+        self._has_user_tags = tags is not None
+        self.user_tags = set(tags['Tags']) if tags is not None else set()
+        self.user_tags.add("")
+        self._user_tags_added = set()
+
+        self.note_tags = {}
+        for note_tag in self.db.note_tags.find({"UserId": self.user_id}, {"Tag": 1, "Count": 1}):
+            self.note_tags[note_tag["Tag"]] = note_tag["Count"]
+
+        self._deltas = {}  # tag name -> (count delta, created, updated)
+
+    @property
+    def dirty(self):
+        return bool(self._deltas or self._user_tags_added or not self._has_user_tags)
+
+    def add_user_tag(self, tag_name):
+        tag_name = tag_name.lower()
+        if tag_name not in self.user_tags:
+            self.user_tags.add(tag_name)
+            self._user_tags_added.add(tag_name)
+
+    def adjust(self, tag_name, delta, created, updated):
+        """ register count change for tag used by note created / updated at given time """
+        if not tag_name:
+            return
+        if delta < 0 and tag_name not in self.note_tags and tag_name not in self._deltas:
+            return  # not counted yet, nothing to decrement
+        count, first_created, _ = self._deltas.get(tag_name, (0, created, None))
+        self._deltas[tag_name] = (count + delta, first_created, updated)
+
+    def count(self, tag_name):
+        """ tag count including changes not yet flushed """
+        count = self.note_tags.get(tag_name, 0)
+        return count + self._deltas.get(tag_name, (0, None, None))[0]
+
+    def flush(self, reserve_usns):
+        """ write pending changes to mongodb
+
+        reserve_usns(n) must allocate n update sequence numbers and return the first one
+        """
+        if not self._has_user_tags or self._user_tags_added:
+            # note: adding tags only; upsert, as another importer may create it meanwhile
+            added = self.user_tags if not self._has_user_tags else self._user_tags_added
+            logger.debug("add tags for user: %s", added)
+            self._retry_duplicate(lambda: self.db.tags.update_one(
+                {'_id': self.user_id},
+                {'$addToSet': {'Tags': {'$each': list(added)}}},
+                upsert=True
+            ))
+            self._has_user_tags = True
+        self._user_tags_added = set()
+
+        deltas = sorted((tag_name, change) for tag_name, change in self._deltas.items() if change[0])
+        if not deltas:
+            self._deltas = {}
+            return 0
+
+        usn = reserve_usns(len(deltas))
+        requests = []
+        for tag_name, (delta, created, updated) in deltas:
+            # match on user and tag (not _id), another importer may have created it meanwhile
+            requests.append(UpdateOne(
+                {"UserId": self.user_id, "Tag": tag_name},
+                {
+                    "$setOnInsert": {"CreatedTime": created, "IsDeleted": False},
+                    "$set": {"Usn": usn, "UpdatedTime": updated},
+                    "$inc": {"Count": delta},
+                },
+                upsert=True
+            ))
+            usn += 1
+
+        self._retry_duplicate(lambda: self._write_note_tags(requests))
+        self._deltas = {}
+        for tag_name, (delta, _, _) in deltas:
+            self.note_tags[tag_name] = self.note_tags.get(tag_name, 0) + delta
+        logger.debug("flushed %s note_tags changes", len(deltas))
+        return len(deltas)
+
+    def _write_note_tags(self, requests):
+        try:
+            self.db.note_tags.bulk_write(requests, ordered=False)
+        except BulkWriteError as err:
+            # upserts racing with another importer, given unique index (see ensure_indexes)
+            duplicates = [error['index'] for error in err.details['writeErrors'] if error['code'] == 11000]
+            if len(duplicates) < len(err.details['writeErrors']):
+                raise
+            logger.debug("retry %s note_tags upserts", len(duplicates))
+            self.db.note_tags.bulk_write([requests[index] for index in duplicates], ordered=False)
+
+    def _retry_duplicate(self, write):
+        """ concurrent upserts may fail with duplicate key, once - then the doc exists """
+        try:
+            write()
+        except DuplicateKeyError:
+            write()
+
+
+def ensure_indexes(db):
+    """ unique index on note_tags, so concurrent importers cannot create a tag twice """
+    try:
+        db.note_tags.create_index([("UserId", 1), ("Tag", 1)], unique=True, background=True)
+    except Exception as err:
+        # e.g. duplicates from before, upserts may race then
+        logger.warning("failed to create unique index on note_tags - %s", err)
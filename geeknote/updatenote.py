@@ -5,10 +5,16 @@ update note in mongodb
 
 import config
 import tools
-from imagehandler import ImageHandler
-
-import re
-from pymongo import MongoClient
+from imagehandler import ImageHandler, get_image_store
+from imagevariants import ImageVariants, parse_variants
+from tagregistry import TagRegistry
+from uploadqueue import UploadQueue
+from enml import EnmlContent
+from notehistory import NoteHistory
+
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+import os
+import io
 import binascii
 import bson
 import uuid
@@ -16,7 +22,6 @@ from datetime import datetime, timedelta
 import pytz
 import dateutil.tz
 from slugify import slugify
-from bs4 import BeautifulSoup
 
 import logging
 logger = logging.getLogger("en2mongo.updatenote")
@@ -24,6 +29,8 @@ logger = logging.getLogger("en2mongo.updatenote")
 DATE_INVALID_BEFORE = datetime(1990, 01, 01)
 DATE_UNKNOWN_YEAR = 1970
 DATE_EQUAL_DELTA = 2.0
+TAG_FLUSH_INTERVAL = 200  # notes processed between writes of tag changes
+LOOKUP_BATCH_SIZE = 1000  # titles per query of existing_notes
 
 
 def log_title(value):
@@ -48,12 +55,42 @@ def log_date(value):
     return value2.strftime("%Y-%m-%dT%H:%M")  # .isoformat() without timezone
 
 
+def _resource_size(resource):
+    """ size of resource body, without reading it """
+    size = getattr(resource.data, 'size', None)
+    if size is None:
+        size = len(resource.data.body)
+    return size
+
+
+def _resource_filename(resource):
+    """ file name of resource (.enex or EN api), None if unknown """
+    filename = getattr(resource, 'filename', None)
+    if filename is None and getattr(resource, 'attributes', None) is not None:
+        filename = resource.attributes.fileName
+    if filename and not isinstance(filename, unicode):
+        filename = unicode(filename, 'utf-8', 'replace')
+    return filename
+
+
+def _resource_stream(resource):
+    """ file-like object to stream resource body from (spooled for .enex, in memory for EN api) """
+    if hasattr(resource.data, 'open'):
+        return resource.data.open()
+    return io.BytesIO(resource.data.body)
+
+
 class UpdateNote:
 
-    def __init__(self, notebook_name, force_update=False):
+    def __init__(self, notebook_name, force_update=False, verify_images=False):
         assert notebook_name, 'must have notebook name, cannot determine from .enex'
         self.notebook_name = notebook_name.lower()
         self.force_update = force_update
+        self.verify_images = verify_images  # check size of stored image instead of trusting files entry
+        self.variants = None
+        if config.IMAGE_VARIANTS:
+            # first, variants pool forks before mongodb and upload threads get started
+            self.variants = ImageVariants(parse_variants(config.IMAGE_VARIANTS), config.IMAGE_VARIANT_PROCESSES)
         self.mongo_client = MongoClient(
             config.DB_URI,
             tz_aware=False,
@@ -61,8 +98,17 @@ class UpdateNote:
         )
         self.db = self.mongo_client[config.DB_NAME]
         self.authenticate()
-        self.imghandler = ImageHandler()
+        self.imghandler = ImageHandler(get_image_store(self.db))
+        self.upload_queue = None
+        if config.UPLOAD_QUEUE:
+            # per notebook, notebooks may be imported in parallel processes
+            queue_dir = os.path.join(config.UPLOAD_QUEUE_DIR, slugify(self.notebook_name) or 'default')
+            self.upload_queue = UploadQueue(queue_dir, self.imghandler, base_dir=config.UPLOAD_QUEUE_DIR)
+        self.history = NoteHistory(self.db)
         self._select_notebook(self.notebook_name)
+        self.tags = TagRegistry(self.db, self.user['_id'])
+        self._note_tags = {}  # note id -> tag list, written by flush() together with the counts
+        self._tag_updates = 0
 
     def authenticate(self):
         """ authenticate using preconfigured user """
@@ -134,6 +180,30 @@ class UpdateNote:
             db_note = candidates[0]
         return db_note
 
+    def existing_notes(self, notes):
+        """ check which notes, (title, created) pairs, exist in the notebook (as _lookup_db_note), return list of bools """
+        created_by_title = {}
+        titles = list(set(title for title, created in notes))
+        for start in range(0, len(titles), LOOKUP_BATCH_SIZE):
+            cond = {
+                "Title": {"$in": titles[start:start + LOOKUP_BATCH_SIZE]},
+                "IsTrash": False,
+                "NotebookId": self._db_notebook['_id'],
+            }
+            for db_note in self.db.notes.find(cond, {"Title": 1, "CreatedTime": 1}):
+                db_created = db_note.get("CreatedTime")
+                if db_created is not None and db_created.tzinfo is None:
+                    db_created = pytz.utc.localize(db_created)
+                created_by_title.setdefault(db_note["Title"], []).append(db_created)
+
+        rounded = timedelta(seconds=2)
+        exists = []
+        for title, created in notes:
+            created = self._get_note_timestamp(created)
+            exists.append(any(created is None or (db_created is not None and abs(db_created - created) <= rounded)
+                              for db_created in created_by_title.get(title, [])))
+        return exists
+
     def _compare_timestamps(self, first, second):
         """ return 0 if equal, > 0 (= seconds difference) if nearly equal, or -1 if timestamps different """
         if second is None:
@@ -163,13 +233,19 @@ class UpdateNote:
 
     def update(self, note):
         """ update note in mongodb from EN note if missing or updated """
-        updated = False
+        db_note, enml = self.prepare(note)
+        return self.apply(note, db_note, enml)
+
+    def prepare(self, note):
+        """ lookup note in mongodb and load content and tags from EN as needed
+
+        returns db note (None if new) and parsed content (None if unchanged),
+        to be passed to apply() - mongodb is only read here
+        """
         db_note = self._lookup_db_note(note)
-        if db_note is not None and db_note["IsDeleted"]:  
-            # TODO deleted in EN?
-            db_note = self._purge_note(db_note)
+        note.load_tags()
 
-        if db_note is not None:
+        if db_note is not None and not db_note["IsDeleted"]:
             note_updated = self._get_note_updated_or_created(note)
             db_note_updated = self._get_db_timestamp(db_note, 'UpdatedTime')
             if db_note_updated is None and note_updated is not None:
@@ -181,22 +257,45 @@ class UpdateNote:
                 logger.debug(u'note changed: "%s"\nupdated in db: %s\nupdated in EN: %s',
                              log_title(note.title), log_date(db_note_updated), log_date(note_updated),
                             )
-                note.load_content()
-                updated = self._update_db_note(db_note, note)
             else:
                 # logger.debug(u"note unchanged: %s", log_title(note.title)) # blather
-                updated = False
+                return db_note, None
+
+        note.load_content()
+        return db_note, EnmlContent(note.content)
 
-        else:  # new note
-            note.load_content()
+    def apply(self, note, db_note, enml, lookup=False):
+        """ write note as prepared by prepare() to mongodb
+
+        with lookup, a note not found by prepare() is looked up again, as
+        prepared notes with the same title and date created may be written meanwhile
+        """
+        if db_note is None and lookup:
+            db_note = self._lookup_db_note(note)
+        if db_note is not None and db_note["IsDeleted"]:
+            # TODO deleted in EN?
+            db_note = self._purge_note(db_note)
+
+        if db_note is None:  # new note
             note_created = self._get_note_timestamp(note.created)
             logger.debug(u'new note: %s created=%s', log_title(note.title), log_date(note_created))
-            db_note = self._create_db_note(note)
+            db_note = self._create_db_note(note, enml)
             updated = True
+        elif enml is not None:
+            updated = self._update_db_note(db_note, note, enml)
+        else:
+            updated = False
 
         self._update_tags(db_note, note)
         return updated
 
+    def content_changed(self, db_note, enml):
+        """ check if prepared content differs from content of db note """
+        if db_note is None or db_note["IsDeleted"] or enml is None:
+            return enml is not None
+        return not (db_note.get('ContentHash') == enml.digest() and
+                    db_note.get('ResourceHashes') == enml.resource_hashes())
+
     def _get_note_timestamp(self, timestamp):
         """ convert timestamp to mongodb timestamp """
         if isinstance(timestamp, datetime):
@@ -212,13 +311,16 @@ class UpdateNote:
         return timestamp
 
     def _purge_note(self, db_note):
-        self.db.note_content_histories.delete_one({"_id": db_note["_id"]})
+        self._note_tags.pop(db_note["_id"], None)
+        self.history.purge(db_note["_id"])
         self.db.note_contents.delete_one({"_id": db_note["_id"]})
         self.db.notes.delete_one({"_id": db_note["_id"]})
-        # TODO delete note_images, too
+        self.db.note_images.delete_many({"NoteId": db_note["_id"]})
+        self._remove_attachments(self.db.attachs.find({"NoteId": db_note["_id"]}, {"Path": 1}))
+        # images no longer referenced by any note are removed by imagegc
         return None
 
-    def _create_db_note(self, note):
+    def _create_db_note(self, note, enml):
         """
         Creates mongodb note from EN note
         """
@@ -229,23 +331,22 @@ class UpdateNote:
 
         assert self._db_notebook is not None, "must have notebook to sync to"
         noteId = bson.objectid.ObjectId()
-        content = note.content
-        EN_NOTE = '\<\!DOCTYPE\s+en-note\s+SYSTEM\s+"http://xml.evernote.com/pub/%s"\s*\>'  # noqa: W605
-        EN_NOTE_1 = EN_NOTE % 'enml.dtd'
-        EN_NOTE_2 = EN_NOTE % 'enml2.dtd'
-        if re.search(EN_NOTE_2, content, re.MULTILINE + re.DOTALL) is None:
-            # note created 2019-10 using enml.dtd
-            if re.search(EN_NOTE_1, content, re.MULTILINE + re.DOTALL) is None:
-                raise ValueError("content format unsupported: %s" % content[:180])
-
-        # Save images
-        imageList = self.get_images(content)
-        img_map = self._handle_images(noteId, note, imageList)
-
-        if img_map:
-            # update img src= in note content to match target location
-            logger.debug("update image refs in note %s", noteId)
-            content = self._fixup_img_refs(content, img_map)
+        content_hash = enml.digest()
+        resource_hashes = enml.resource_hashes()
+
+        # Save images, update img src= in note content to match target location
+        content, attach_num, _ = self._store_images(noteId, note, enml)  # new note, no stale attachments
+
+        # content first, a note failing before its notes entry (with content hash) is created again
+        self.db.note_contents.insert_one({
+            "_id": noteId,  # "NoteId"
+            "UserId": self.user['_id'],
+            "IsBlog": False,
+            "Content": content,
+            "CreatedTime": self._get_note_timestamp(note.created),
+            "UpdatedTime": self._get_note_timestamp(note.updated),
+            "UpdatedUserId": self.user['_id'],
+        })
 
         is_markdown = False
         usn = self._get_user_usn(self.user)
@@ -272,21 +373,14 @@ class UpdateNote:
             "IsTrash": False,
             "IsDeleted": False,
             "ReadNum": 0,
+            "AttachNum": attach_num,
+            "ContentHash": content_hash,
+            "ResourceHashes": resource_hashes,
         })
         db_note = self.db.notes.find_one({'_id': noteId})
         assert db_note
 
         self.update_note_count()
-        self.db.note_contents.insert_one({
-            "_id": noteId,  # "NoteId"
-            "UserId": self.user['_id'],
-            "IsBlog": False,
-            "Content": content,
-            "CreatedTime": self._get_note_timestamp(note.created),
-            "UpdatedTime": self._get_note_timestamp(note.updated),
-            "UpdatedUserId": self.user['_id'],
-        })
-
         return db_note
 
     def update_note_count(self):
@@ -305,104 +399,43 @@ class UpdateNote:
         Creates a list of image resources to save.
         Each has a hash and extension attribute.
         '''
-        soup = BeautifulSoup(content, features="lxml")
-        imageList = []
-        for section in soup.findAll('en-media'):
-            if 'type' in section.attrs and 'hash' in section.attrs:
-                imageType, imageExtension = section['type'].split('/')
-                if imageType == "image":
-                    imageList.append({'hash': section['hash'], 'extension': imageExtension})
-        return imageList
+        return [{'hash': info['hash'], 'extension': info['extension']}
+                for info in EnmlContent(content).media() if info['type'] == 'image']
 
     def _get_user_usn(self, user):
         """  return per-user value for UpdateSequenceNum """
-        usn = user['Usn'] + 1
-        self.db.users.update_one(
+        return self._reserve_user_usns(1, user)
+
+    def _reserve_user_usns(self, count, user=None):
+        """ allocate count UpdateSequenceNums for user, return the first one """
+        if user is None:
+            user = self.user
+        db_user = self.db.users.find_one_and_update(
             {'_id': user['_id']},
-            {"$set": {"Usn": usn}}
+            {"$inc": {"Usn": count}},
+            projection={"Usn": 1},
+            return_document=ReturnDocument.AFTER
         )
-        return usn
-
-    def _fixup_img_refs(self, content, img_map):
-        """
-        transform EN image refs:
-            <img src="file:/C:/Users/pifre/AppData/Local/Temp/enhtmlclip/Image.jpg"/>
-            <en-media hash="9aad6b0d39f6e0856afde5d941a5c6a2" type="image/jpeg"></en-media>
-        """
-        soup = BeautifulSoup(content, 'html.parser')
-        img_tag_count = 0
-        for img_tag in soup.select('img'):
-            assert len(img_tag.contents) == 0  # expect img elements to have no content
-            # handle img tag followed by en-media tag from EN
-            next_elmt = img_tag.next_sibling
-            if next_elmt and next_elmt.name == 'en-media':
-                # drop img tag preceeding en-media elmt
-                if img_tag.attrs.keys() != [u'src', ]:
-                    logger.debug("extra attribs in img tag: %s", img_tag.attrs.keys())  # width, height
-                img_tag.extract()
-            else:
-                # logger.warning("missing en-media after img tag?")
-                img_tag_count += 1
-
-        img_tags = soup.findAll('img')
-        assert len(img_tags) == img_tag_count
-
-        for en_media in soup.findAll('en-media'):
-            if 'type' in en_media.attrs and 'hash' in en_media.attrs:
-                imageType, imageExtension = en_media['type'].split('/')
-                if imageType == "image":
-                    newTag = soup.new_tag("img")
-                    # new_path = img_map[en_media['hash']]['Path']
-                    if en_media['hash'] not in img_map:
-                        logger.warning("failed to fetch image from img_map")
-                        continue
-                    image_id = img_map[en_media['hash']]['ImageId']
-                    new_path = '/api/file/getImage?fileId=%s' % image_id
-                    newTag['src'] = new_path
-
-                    en_media.replace_with(newTag)
-                    # TODO keep en-media elmt for (future) usecase to restore EN note
-                else:
-                    logger.info("ignore en-media elmt for type=%s", en_media['type'])
-            else:
-                logger.warning("detected en-media elmt without type/hash attribs")  # unexpected
-
-        return str(soup)
+        user['Usn'] = db_user['Usn']
+        return db_user['Usn'] - count + 1
 
     def _update_tags(self, db_note, note):
-        """ update tags """
-        note.load_tags()
-        user_id = db_note['UserId']
-        user = self.db.users.find_one({"_id": user_id})
-        assert user is not None, 'must have user to update tags'
-        tags = self.db.tags.find_one({'_id': user_id})
-        user_tags = set()
-        if tags is not None:
-            user_tags = set(tags['Tags'])
-        user_tags.add("")
+        """ update tags
+
+        note_tags counts and user tags are maintained in self.tags, written by flush()
+        """
+        assert db_note['UserId'] == self.user['_id'], 'must have user to update tags'
 
         tag_names_new = set(note.tagNames)
         tag_names_new.add("")
         if self.notebook_name not in tag_names_new:
             # automatically add notebook_name as tag name - for easier searching
             tag_names_new.add(self.notebook_name)
-        tag_names_db = set(db_note.get('Tags', []))
+        tag_names_db = set(self._note_tags.get(db_note['_id'], db_note.get('Tags', [])))
         tag_names_db.add("")
         added = tag_names_new.difference(tag_names_db)
         for tag_name in added:
-            user_tags.add(tag_name.lower())
-
-        db_tags = self.db.tags.find_one({'_id': user_id})
-        if db_tags is None:
-            logger.debug("set tags for user: %s", user_tags)
-            self.db.tags.insert_one({
-                "_id": user_id,
-                "Tags": list(user_tags)
-            })
-        if added:
-            # update tag list for user; note: adding tags only
-            # logger.debug("add new tags for user: %s", user_tags) #blather
-            self.db.tags.update_one({'_id': user_id}, {'$set': {'Tags': list(user_tags)}})
+            self.tags.add_user_tag(tag_name)
 
         removed = tag_names_db.difference(tag_names_new)
         for tag_name in removed:
@@ -410,62 +443,52 @@ class UpdateNote:
             # handle tag removal?
 
         if added or removed:
-            # update tag list of note
+            # update tag list of note, with the counts: a run stopped before flush() writes neither
             logger.debug(u'update tags for note: %s (%s)', tag_names_new, log_title(note.title))
-            self.db.notes.update_one(
-                {'_id': db_note['_id']},
-                {"$set": {"Tags": list(tag_names_new)}}
-            )
+            self._note_tags[db_note['_id']] = list(tag_names_new)
 
         # update note_tags
+        note_created = self._get_note_timestamp(note.created)
+        note_updated = self._get_note_timestamp(note.updated)
         for tag_name in added:
-            if not tag_name:
-                continue
-            usn = self._get_user_usn(user)
-            note_tags = self.db.note_tags.find_one({"UserId": user_id, "Tag": tag_name})
-            if note_tags is None:
-                tag_id = bson.objectid.ObjectId()
-                self.db.note_tags.insert_one({
-                    "_id": tag_id,
-                    "UserId": user_id,
-                    "Tag": tag_name,
-                    "Usn": usn,
-                    "Count": 1,
-                    "CreatedTime": self._get_note_timestamp(note.created),
-                    "UpdatedTime": self._get_note_timestamp(note.updated),
-                    "IsDeleted": False
-                })
-            else:
-                self.db.note_tags.update_one(
-                    {"_id": note_tags["_id"]},
-                    {"$set": {
-                        "Usn": usn,
-                        "Count": note_tags["Count"] + 1,
-                        "UpdatedTime": self._get_note_timestamp(note.updated),
-                    }}
-                )
+            self.tags.adjust(tag_name, +1, note_created, note_updated)
         for tag_name in removed:
-            if not tag_name:
-                continue
-            usn = self._get_user_usn(user)
-            note_tags = self.db.note_tags.find_one({"UserId": user_id, "Tag": tag_name})
-            if note_tags is not None:
-                self.db.note_tags.update_one(
-                    {"_id": note_tags["_id"]},
-                    {"$set": {
-                        "Usn": usn,
-                        "Count": note_tags["Count"] - 1,
-                        "UpdatedTime": self._get_note_timestamp(note.updated),
-                    }}
-                )
-
-    def _update_db_note(self, db_note, note):
+            self.tags.adjust(tag_name, -1, note_created, note_updated)
+
+        self._tag_updates += 1
+        if self._tag_updates >= TAG_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """ write pending tag changes to mongodb, note_tags counts first, then the tag lists of the notes """
+        if self.tags.dirty:
+            self.tags.flush(self._reserve_user_usns)
+        if self._note_tags:
+            self.db.notes.bulk_write([UpdateOne({'_id': note_id}, {"$set": {"Tags": tag_names}})
+                                      for note_id, tag_names in self._note_tags.items()], ordered=False)
+            self._note_tags = {}
+        self._tag_updates = 0
+
+    def finish(self):
+        """ write pending changes, wait for queued image uploads and report on them """
+        self.flush()
+        if self.upload_queue is not None:
+            self.upload_queue.wait()
+            self.upload_queue.report()
+
+    def close(self):
+        """ stop upload queue, variants pool and image handler, releasing their threads and sessions """
+        if self.upload_queue is not None:
+            self.upload_queue.close()
+            self.upload_queue = None
+        if self.variants is not None:
+            self.variants.close()
+        self.imghandler.close()
+
+    def _update_db_note(self, db_note, note, enml):
         """
         Updates mongodb note from EN note
         """
-        content = note.content
-        EN_NOTE_2 = '\<\!DOCTYPE\s+en-note\s+SYSTEM\s+"http://xml.evernote.com/pub/enml2.dtd"\>'  # noqa: W605
-        assert re.search(EN_NOTE_2, content) is not None, "content format unsupported: %s" % content[:180]
         noteId = db_note["_id"]
         db_note_created = self._get_db_timestamp(db_note, 'CreatedTime')
         note_created = self._get_note_timestamp(note.created)
@@ -476,22 +499,51 @@ class UpdateNote:
                          log_title(note.title), log_date(db_note_created), log_date(note_created))
             return False
 
+        if not self.content_changed(db_note, enml):
+            # e.g. force_update or drift of date updated, skip rewriting content and images
+            logger.debug(u'note content unchanged: %s', log_title(note.title))
+            self._touch_db_note(db_note, note)
+            return False
+
         logger.info(u'update note %s created=%s updated=%s',
                     log_title(note.title), 
                     log_date(self._get_note_timestamp(note.created)), 
                     log_date(self._get_note_timestamp(note.updated)))
 
-        # Save images
-        imageList = self.get_images(content)
-        img_map = self._handle_images(noteId, note, imageList)
+        content_hash = enml.digest()
+        resource_hashes = enml.resource_hashes()
 
-        if img_map:
-            # update img src= in note content to match target location
-            logger.debug("update image refs in note %s", noteId)
-            content = self._fixup_img_refs(content, img_map)
+        # Save images, update img src= in note content to match target location
+        content, attach_num, stale_attachments = self._store_images(noteId, note, enml)
 
-        # TODO purge removed images
+        # images removed from the note are left to imagegc
 
+        db_content = self.db.note_contents.find_one(
+            {"_id": noteId}, {"Content": 1, "UpdatedTime": 1, "UpdatedUserId": 1})
+
+        # update note content
+        self.db.note_contents.update_one(
+            {
+                "_id": noteId,
+            },
+            {
+                "$set": {
+                    "UserId": self.user['_id'],
+                    # "IsBlog": False,
+                    "Content": content,
+                    "CreatedTime": self._get_note_timestamp(note.created),
+                    "UpdatedTime": self._get_note_timestamp(note.updated),
+                    "UpdatedUserId": self.user['_id'],
+                }
+            }
+        )
+
+        # keep old note content in note_content_histories, once the new content is written
+        if db_content is not None:
+            self.history.add(noteId, self.user['_id'], db_content.get("Content"), content,
+                             db_content.get("UpdatedTime"), db_content.get("UpdatedUserId"))
+
+        # content hash last, a note failing before is rewritten by the next import
         usn = self._get_user_usn(self.user)
         self.db.notes.update_one(
             {
@@ -510,6 +562,9 @@ class UpdateNote:
                     "UrlTitle": slugify(note.title),
                     "UserId": self.user['_id'],
                     "Usn": usn,
+                    "AttachNum": attach_num,
+                    "ContentHash": content_hash,
+                    "ResourceHashes": resource_hashes,
                     # "ImgSrc": imgSrc,
                     # "IsBlog": False,
                     # "IsMarkdown": is_markdown,
@@ -520,90 +575,253 @@ class UpdateNote:
             }
         )
 
-        # create entry in note_content_histories with old note content
-        # TODO future
-
-        # update note content
-        self.db.note_contents.update_one(
-            {
-                "_id": noteId,
-            },
-            {
-                "$set": {
-                    "UserId": self.user['_id'],
-                    # "IsBlog": False,
-                    "Content": content,
-                    "CreatedTime": self._get_note_timestamp(note.created),
-                    "UpdatedTime": self._get_note_timestamp(note.updated),
-                    "UpdatedUserId": self.user['_id'],
-                }
-            }
-        )
+        # attachments no longer in the note, once the note no longer links them
+        self._remove_attachments(stale_attachments)
 
         # note: note tags to be updated by caller
         return True
 
-    def _handle_images(self, noteId, note, imageList):
-        img_map = {}
-        if not imageList:
-            return img_map
-
-        def handle_image(resource):
-            img_title = '{}.{}'.format(imageInfo['hash'], imageInfo['extension'])
-            file_obj = self.db.files.find_one({'Title': img_title, 'UserId': self.user['_id']})
-            if not file_obj:
-                # new image
-                new_guid = uuid.uuid4().hex
-                img_dir = tools.get_random_filepath(str(self.user['_id']), new_guid)
-                img_name = '{}.{}'.format(new_guid, imageInfo['extension'])
-                img_path = '{}/{}'.format(img_dir, img_name)
-                # logger.info('new image {}'.format(img_path))  # log bloat
-            else:
-                img_path = file_obj['Path']
-                img_dir = img_path[:img_path.rfind('/') + 1]
-                img_name = img_path[len(img_dir):]
-                logger.debug('existing image {}'.format(img_path))
-
-            # resource.data.body is bytestream of image
-            img_path = self.imghandler.upload_image(img_dir, img_name, resource.data.body)
-
-            # add or update files and note_images entries
-            if not file_obj:
-                img_id = bson.objectid.ObjectId()
-                self.db.files.insert_one({
-                    "_id": img_id,
-                    "UserId": self.user['_id'],
-                    "Name": img_name,
-                    "Title": img_title,
-                    "Size": len(resource.data.body),
-                    "Type": "",
-                    "Path": img_path,
-                    # "AlbumId": "52d3e8ac99c37b7f0d000001",  # what for?
-                    # "IsDefaultAlbum": True,
-                    "CreatedTime": self._get_note_timestamp(note.created),
-                })
-            else:
-                img_id = file_obj['_id']
+    def _touch_db_note(self, db_note, note):
+        """ adjust date updated of unchanged note, so next sync does not consider it changed again """
+        note_updated = self._get_note_timestamp(note.updated)
+        db_note_updated = self._get_db_timestamp(db_note, 'UpdatedTime')
+        if note_updated is None or self._compare_timestamps(note_updated, db_note_updated) >= 0:
+            return
+        self.db.notes.update_one(
+            {"_id": db_note["_id"]},
+            {"$set": {
+                "UpdatedTime": note_updated,
+                "SyncedTime": datetime.utcnow().replace(tzinfo=pytz.utc),
+            }}
+        )
 
-            # collect info to update image ref in note content
-            img_map[imageInfo['hash']] = {'Path': img_path, 'ImageId': str(img_id)}
+    def _store_images(self, noteId, note, enml):
+        """ save images and attachments of note, return content with refs pointing to leanote,
+        number of attachments and attachs entries no longer in the note (to be removed by caller)
 
-            note_image = self.db.note_images.find_one({
-                'NoteId': noteId,
-                "ImageId": img_id,
-            })
-            if not note_image:
-                self.db.note_images.insert_one({
-                    "_id": bson.objectid.ObjectId(),
-                    "NoteId": noteId,
-                    "ImageId": img_id
-                })
+        images are uploaded in parallel, files / note_images entries are added
+        once all uploads of the note are confirmed - or queued, with UPLOAD_QUEUE;
+        attachments are streamed to the image store likewise and kept in attachs
+        """
+        uploads = []
+        variant_jobs = []
+        attachments = []
+        unresolved = set()  # hashes of attachments left as en-media
 
-        for imageInfo in imageList:
+        def resolve(imageInfo):
             resource = note.get_image_resource(imageInfo)
             if resource is None:
                 logger.warning(u'failed to lookup image for %s: %s', log_title(note.title), imageInfo)
-            else:
-                handle_image(resource)
+                return None
+            return self._handle_image(noteId, note, imageInfo, resource, uploads, variant_jobs)
+
+        def resolve_attachment(mediaInfo):
+            resource = note.get_image_resource(mediaInfo)
+            if resource is None:
+                logger.warning(u'failed to lookup attachment for %s: %s', log_title(note.title), mediaInfo)
+                unresolved.add(mediaInfo['hash'])
+                return None
+            return self._handle_attachment(noteId, note, mediaInfo, resource, uploads, attachments)
+
+        content = enml.rewrite(resolve, resolve_attachment)
+        variant_uploads = self._upload_variants(variant_jobs)
+        self._finish_variants(variant_uploads)
+        self._finish_uploads(noteId, uploads)
+        attach_num, stale_attachments = self._finish_attachments(noteId, attachments, unresolved)
+        return content, attach_num, stale_attachments
+
+    def _handle_attachment(self, noteId, note, mediaInfo, resource, uploads, attachments):
+        """ submit upload of attachment unless stored already, return (id, title) of attachment """
+        size = _resource_size(resource)
+        title = _resource_filename(resource) or u'{}.{}'.format(mediaInfo['hash'], mediaInfo['extension'])
+        extension = os.path.splitext(title)[1][1:] or mediaInfo['extension']
+        attach_obj = self.db.attachs.find_one({'NoteId': noteId, 'Hash': mediaInfo['hash']})
+        if attach_obj is not None and attach_obj.get('Size') == size:
+            attachments.append((attach_obj, False))
+            return str(attach_obj['_id']), attach_obj['Title']
+
+        if attach_obj is None:
+            new_guid = uuid.uuid4().hex
+            attach_dir = tools.get_random_filepath(str(self.user['_id']), new_guid) + '/attachs'
+            attach_name = u'{}.{}'.format(new_guid, extension)
+            attach_id = bson.objectid.ObjectId()
+        else:
+            # changed, upload again to same place
+            attach_path = attach_obj['Path']
+            attach_dir = attach_path[:attach_path.rfind('/') + 1]
+            attach_name = attach_path[len(attach_dir):]
+            attach_id = attach_obj['_id']
+        attach_obj = {
+            "_id": attach_id,
+            "NoteId": noteId,
+            "UploadUserId": self.user['_id'],
+            "Name": attach_name,
+            "Title": title,
+            "Size": size,
+            "Type": extension,
+            "Hash": mediaInfo['hash'],
+            "Path": self.imghandler.target_path(attach_dir, attach_name),
+            "CreatedTime": self._get_note_timestamp(note.created),
+        }
+        task = self._submit_upload(attach_dir, attach_name, _resource_stream(resource))
+        uploads.append((task, None, False))
+        attachments.append((attach_obj, True))
+        return str(attach_obj['_id']), title
+
+    def _finish_attachments(self, noteId, attachments, unresolved):
+        """ write attachs entries of uploaded attachments, return number of attachments of note
+        and attachs entries no longer in the note
 
-        return img_map
+        entries of attachments left unresolved (still en-media in the content) are kept
+        """
+        for attach_obj, uploaded in attachments:
+            if uploaded:
+                self.db.attachs.replace_one({"_id": attach_obj['_id']}, attach_obj, upsert=True)
+        kept = [attach_obj['_id'] for attach_obj, uploaded in attachments]
+        others = list(self.db.attachs.find({"NoteId": noteId, "_id": {"$nin": kept}}, {"Path": 1, "Hash": 1}))
+        stale = [attach_obj for attach_obj in others if attach_obj.get('Hash') not in unresolved]
+        return len(attachments) + len(others) - len(stale), stale
+
+    def _remove_attachments(self, attach_objs):
+        """ remove attachs entries and stored attachments """
+        attach_ids = []
+        for attach_obj in attach_objs:
+            attach_ids.append(attach_obj['_id'])
+            try:
+                self.imghandler.store.delete(attach_obj['Path'])
+            except Exception as err:
+                logger.warning("failed to delete stored attachment %s - %s", attach_obj['Path'], err)
+        if attach_ids:
+            self.db.attachs.delete_many({"_id": {"$in": attach_ids}})
+
+    def _handle_image(self, noteId, note, imageInfo, resource, uploads, variant_jobs):
+        """ submit image upload, return id of image """
+        img_title = '{}.{}'.format(imageInfo['hash'], imageInfo['extension'])
+        size = _resource_size(resource)
+        file_obj = self.db.files.find_one({'Title': img_title, 'UserId': self.user['_id']})
+        if not file_obj:
+            # new image
+            new_guid = uuid.uuid4().hex
+            img_dir = tools.get_random_filepath(str(self.user['_id']), new_guid)
+            img_name = '{}.{}'.format(new_guid, imageInfo['extension'])
+            # logger.info('new image {}/{}'.format(img_dir, img_name))  # log bloat
+            img_id = bson.objectid.ObjectId()
+            file_obj = {
+                "_id": img_id,
+                "UserId": self.user['_id'],
+                "Name": img_name,
+                "Title": img_title,
+                "Hash": imageInfo['hash'],
+                "Size": size,
+                "Type": "",
+                "Path": self.imghandler.target_path(img_dir, img_name),
+                # "AlbumId": "52d3e8ac99c37b7f0d000001",  # what for?
+                # "IsDefaultAlbum": True,
+                "CreatedTime": self._get_note_timestamp(note.created),
+            }
+            is_new = True
+        else:
+            img_path = file_obj['Path']
+            img_dir = img_path[:img_path.rfind('/') + 1]
+            img_name = img_path[len(img_dir):]
+            if self._image_present(file_obj, imageInfo, size):
+                # logger.debug('image already stored {}'.format(img_path))  # log bloat
+                uploads.append((None, file_obj, False))
+                if self.variants is not None and 'Variants' not in file_obj:
+                    variant_jobs.append((self.variants.submit(resource.data.body), file_obj, img_dir, img_name))
+                return str(file_obj['_id'])
+            logger.debug('existing image {}, upload again'.format(img_path))
+            file_obj['Hash'] = imageInfo['hash']
+            file_obj['Size'] = size
+            is_new = False
+
+        if self.variants is not None:
+            # read body before the upload starts streaming from the same buffer
+            variant_jobs.append((self.variants.submit(resource.data.body), file_obj, img_dir, img_name))
+        task = self._submit_upload(img_dir, img_name, _resource_stream(resource))
+        uploads.append((task, file_obj, is_new))
+        return str(file_obj['_id'])
+
+    def _upload_variants(self, variant_jobs):
+        """ submit uploads of image variants computed meanwhile, recorded as Variants of files entry
+
+        returns (files entry, upload tasks) pairs
+        """
+        variant_uploads = []
+        for job, file_obj, img_dir, img_name in variant_jobs:
+            try:
+                variants = job.get()
+            except Exception as err:
+                logger.warning("failed to create variants for image %s - %s", file_obj['Path'], err)
+                continue
+            base_name = img_name.rsplit('.', 1)[0]
+            file_obj['Variants'] = []
+            tasks = []
+            for variant in variants:
+                variant_name = '{}.{}.{}'.format(base_name, variant['Name'], variant['Extension'])
+                tasks.append(self._submit_upload(img_dir, variant_name, variant['Data']))
+                file_obj['Variants'].append({
+                    "Name": variant['Name'],
+                    "Path": self.imghandler.target_path(img_dir, variant_name),
+                    "Size": len(variant['Data']),
+                    "Width": variant['Width'],
+                    "Height": variant['Height'],
+                })
+            variant_uploads.append((file_obj, tasks))
+        return variant_uploads
+
+    def _finish_variants(self, variant_uploads):
+        """ wait for uploads of variants, failing ones are dropped from files entry - variants are optional """
+        for file_obj, tasks in variant_uploads:
+            try:
+                self.imghandler.wait(tasks)
+            except Exception as err:
+                logger.warning("failed to upload variants for image %s - %s", file_obj['Path'], err)
+                del file_obj['Variants']
+
+    def _submit_upload(self, img_dir, img_name, img_data):
+        """ upload through the durable queue if configured (task done once queued), directly otherwise """
+        if self.upload_queue is not None:
+            return self.upload_queue.put(img_dir, img_name, img_data)
+        return self.imghandler.submit(img_dir, img_name, img_data)
+
+    def _image_present(self, file_obj, imageInfo, size):
+        """ check if image of files entry is stored already, by hash and size """
+        stored_hash = file_obj.get('Hash') or file_obj['Title'].rsplit('.', 1)[0]
+        if stored_hash != imageInfo['hash'] or file_obj.get('Size') != size:
+            return False
+        if self.upload_queue is not None and self.upload_queue.failed(file_obj['Path']):
+            logger.info("queued upload of image %s failed, upload again", file_obj['Path'])
+            return False
+        if self.verify_images:
+            stored_size = self.imghandler.stored_size(file_obj['Path'])
+            if stored_size != size:
+                logger.warning("stored image %s has size %s, expected %s", file_obj['Path'], stored_size, size)
+                return False
+        return True
+
+    def _finish_uploads(self, noteId, uploads):
+        """ wait for uploads of note, then add files and note_images entries """
+        self.imghandler.wait([task for task, file_obj, is_new in uploads if task is not None])
+        uploads = [(task, file_obj, is_new) for task, file_obj, is_new in uploads if file_obj is not None]  # w/o attachments
+
+        new_files = [file_obj for task, file_obj, is_new in uploads if is_new]
+        if new_files:
+            self.db.files.insert_many(new_files, ordered=False)
+        for task, file_obj, is_new in uploads:
+            if is_new:
+                continue
+            changes = {}
+            if task is not None:
+                # uploaded again, record what is stored now
+                changes.update({"Hash": file_obj['Hash'], "Size": file_obj['Size']})
+            if 'Variants' in file_obj:
+                changes["Variants"] = file_obj['Variants']
+            if changes:
+                self.db.files.update_one({"_id": file_obj['_id']}, {"$set": changes})
+        for task, file_obj, is_new in uploads:
+            self.db.note_images.update_one(
+                {"NoteId": noteId, "ImageId": file_obj['_id']},
+                {"$setOnInsert": {"_id": bson.objectid.ObjectId()}},
+                upsert=True
+            )
@@ -0,0 +1,255 @@
+"""
+durable local queue of image uploads
+
+note processing only spools the image body to the queue directory and goes
+on with the next note, image paths (and so the image URLs in the note) are
+known before the upload. background threads drain the queue through
+ImageHandler, retrying failed uploads. queued jobs survive restarts and are
+picked up by the next run, each job is a pair of files:
+
+    <job id>.data   image body
+    <job id>.json   {"Dir": .., "Name": .., "Size": .., "Queued": .., "Attempts": .., "Error": .., "Failed": ..}
+
+uploaded jobs are removed; jobs that failed max_attempts times are kept,
+marked as failed, until retried (see utils/upload_queue.py) or replaced by
+a new job for the same image. UpdateNote uses a queue directory per
+notebook below UPLOAD_QUEUE_DIR, and uploads images of failed jobs again;
+notebooks share image paths (same image in several notebooks), so failed
+jobs in the queues of the other notebooks count as well
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+import Queue
+from datetime import datetime
+
+from imagehandler import UploadTask
+from jsonfile import write_json
+
+import logging
+logger = logging.getLogger("en2mongo.uploadqueue")
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 10.0  # seconds, multiplied by number of failed attempts
+
+
+def _job_path(queue_dir, job_id, kind):
+    return os.path.join(queue_dir, '%s.%s' % (job_id, kind))
+
+
+def list_jobs(queue_dir):
+    """ list queued jobs (dicts with job info and JobId), oldest first """
+    jobs = []
+    if not os.path.isdir(queue_dir):
+        return jobs
+    for fn in os.listdir(queue_dir):
+        if not fn.endswith('.json'):
+            continue
+        job_id = fn[:-len('.json')]
+        try:
+            with open(os.path.join(queue_dir, fn), 'r') as json_file:
+                info = json.load(json_file)
+        except ValueError:
+            logger.warning("skip unreadable upload job %s", fn)
+            continue
+        info['JobId'] = job_id
+        jobs.append(info)
+    jobs.sort(key=lambda info: info.get('Queued'))
+    return jobs
+
+
+def queue_dirs(base_dir):
+    """ queue directories in base_dir (one per notebook) """
+    if not os.path.isdir(base_dir):
+        return []
+    return [os.path.join(base_dir, fn) for fn in sorted(os.listdir(base_dir))
+            if os.path.isdir(os.path.join(base_dir, fn))]
+
+
+def queue_report(queue_dir):
+    """ return (pending, failed) lists of queued jobs """
+    jobs = list_jobs(queue_dir)
+    pending = [info for info in jobs if not info.get('Failed')]
+    failed = [info for info in jobs if info.get('Failed')]
+    return pending, failed
+
+
+class UploadQueue:
+    """ durable upload queue in queue_dir, drained through imghandler
+
+    with base_dir (the directory of the queues of all notebooks), failed
+    jobs found in the other queues at start are known as failed as well
+    """
+
+    def __init__(self, queue_dir, imghandler, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY, base_dir=None):
+        self.queue_dir = queue_dir
+        self.imghandler = imghandler
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        if not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir)
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._failed = {}  # image path -> (queue dir, job id) of failed jobs
+        self.uploaded = 0
+
+        self._cleanup()
+        resumed = 0
+        for info in list_jobs(queue_dir):
+            if info.get('Failed'):
+                self._failed[self._target_path(info)] = (queue_dir, info['JobId'])
+            else:
+                self._queue.put(info['JobId'])
+                resumed += 1
+        if resumed:
+            logger.info("resuming %s queued image uploads from %s", resumed, queue_dir)
+        if base_dir is not None:
+            for other_dir in queue_dirs(base_dir):
+                if os.path.abspath(other_dir) == os.path.abspath(queue_dir):
+                    continue
+                for info in list_jobs(other_dir):
+                    if info.get('Failed'):
+                        self._failed.setdefault(self._target_path(info), (other_dir, info['JobId']))
+
+        self._workers = []
+        for n in range(imghandler.store.workers):
+            worker = threading.Thread(target=self._drain, name="uploadqueue-%s" % n)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _cleanup(self):
+        """ drop leftovers of jobs interrupted while being queued """
+        for fn in os.listdir(self.queue_dir):
+            path = os.path.join(self.queue_dir, fn)
+            orphan = fn.endswith('.part') or \
+                (fn.endswith('.data') and not os.path.exists(path[:-len('.data')] + '.json'))
+            if orphan:
+                logger.warning("removing incomplete upload job file %s", fn)
+                os.remove(path)
+
+    def _target_path(self, info):
+        return self.imghandler.target_path(info['Dir'], info['Name'])
+
+    def failed(self, img_path):
+        """ check if upload of img_path failed for good """
+        with self._lock:
+            return img_path in self._failed
+
+    def put(self, img_dir, img_name, img_data):
+        """ queue image for upload, returns UploadTask done as soon as the job is queued
+
+        img_data is the image body or a file-like object to read it from
+        """
+        img_path = self.imghandler.target_path(img_dir, img_name)
+        with self._lock:
+            failed_job = self._failed.pop(img_path, None)
+        if failed_job is not None:
+            logger.info("replacing failed upload job of image %s in %s", img_path, failed_job[0])
+            for kind in ('json', 'data'):
+                try:
+                    os.remove(_job_path(failed_job[0], failed_job[1], kind))
+                except OSError as err:
+                    # job of other notebook, replaced or retried by a parallel import
+                    logger.warning("failed to remove failed upload job %s - %s", failed_job[1], err)
+        job_id = uuid.uuid4().hex
+        data_path = _job_path(self.queue_dir, job_id, 'data')
+        with open(data_path, 'wb') as data_file:
+            if hasattr(img_data, 'read'):
+                img_data.seek(0)
+                shutil.copyfileobj(img_data, data_file)
+            else:
+                data_file.write(img_data)
+            size = data_file.tell()
+        write_json(_job_path(self.queue_dir, job_id, 'json'), {
+            "Dir": img_dir,
+            "Name": img_name,
+            "Size": size,
+            "Queued": datetime.utcnow().isoformat(),
+            "Attempts": 0,
+        })
+        self._queue.put(job_id)
+        task = UploadTask(img_dir, img_name, None)
+        task.finish(img_path)
+        return task
+
+    def retry_failed(self):
+        """ queue failed jobs again, return number of jobs """
+        count = 0
+        for info in list_jobs(self.queue_dir):
+            if not info.get('Failed'):
+                continue
+            job_id = info.pop('JobId')
+            info.update({"Failed": False, "Attempts": 0})
+            write_json(_job_path(self.queue_dir, job_id, 'json'), info)
+            with self._lock:
+                self._failed.pop(self._target_path(info), None)
+            self._queue.put(job_id)
+            count += 1
+        return count
+
+    def wait(self):
+        """ wait until queued jobs are uploaded or failed """
+        self._queue.join()
+
+    def report(self):
+        """ log summary of uploads, return (pending, failed) lists of jobs left in queue """
+        pending, failed = queue_report(self.queue_dir)
+        logger.info("image uploads: %s done, %s failed, %s pending in %s",
+                    self.uploaded, len(failed), len(pending), self.queue_dir)
+        for info in failed:
+            logger.warning("failed upload of image %s%s - %s", info['Dir'], info['Name'], info.get('Error'))
+        return pending, failed
+
+    def close(self):
+        self.wait()
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _drain(self):
+        while 1:
+            job_id = self._queue.get()
+            try:
+                if job_id is None:
+                    break
+                self._upload(job_id)
+            except Exception:
+                logger.exception("failed to process upload job %s", job_id)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, job_id):
+        json_path = _job_path(self.queue_dir, job_id, 'json')
+        data_path = _job_path(self.queue_dir, job_id, 'data')
+        with open(json_path, 'r') as json_file:
+            info = json.load(json_file)
+        try:
+            with open(data_path, 'rb') as data_file:
+                self.imghandler.upload_image(info['Dir'], info['Name'], data_file)
+        except Exception as err:
+            info['Attempts'] = info.get('Attempts', 0) + 1
+            info['Error'] = str(err)
+            if info['Attempts'] >= self.max_attempts:
+                info['Failed'] = True
+                logger.error("upload of image %s%s failed %s times, giving up - %s",
+                             info['Dir'], info['Name'], info['Attempts'], err)
+            write_json(json_path, info)
+            if info.get('Failed'):
+                with self._lock:
+                    self._failed[self._target_path(info)] = (self.queue_dir, job_id)
+            if info['Attempts'] < self.max_attempts:
+                logger.warning("upload of image %s%s failed, retrying - %s", info['Dir'], info['Name'], err)
+                time.sleep(self.retry_delay * info['Attempts'])
+                self._queue.put(job_id)  # before task_done, so wait() covers the retry
+            return
+        os.remove(data_path)
+        os.remove(json_path)
+        with self._lock:
+            self.uploaded += 1
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+UpdateNote on mongomock, images and attachments in a local store below a
+temporary directory; notes are parsed from .enex written by the test
+"""
+
+import os
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+import unittest
+from geeknote import config, updatenote
+from geeknote.enexparser import EnexParser
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+ENML = '<?xml version="1.0" encoding="UTF-8"?>' \
+    '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd"><en-note>%s</en-note>'
+
+ENEX_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">\n' \
+    '<en-export export-date="20191020T120000Z" application="Evernote/Windows" version="6.x">\n'
+
+CONFIG = {
+    'DB_NAME': 'leanote',
+    'DB_USERNAME': 'user',
+    'IMAGE_STORE': 'local',
+    'IMAGE_VARIANTS': None,
+    'UPLOAD_QUEUE': False,
+}
+
+
+def media(body, mime_type='image/png'):
+    return '<en-media hash="%s" type="%s"/>' % (hashlib.md5(body).hexdigest(), mime_type)
+
+
+def note_xml(title, text='', tags=(), created='20190101T120000Z', updated='20190102T120000Z', resources=()):
+    """ <note> of .enex, resources as (body, mime type, file name or None) """
+    parts = ['<note><title>%s</title><content><![CDATA[%s]]></content>' % (title, ENML % text),
+             '<created>%s</created><updated>%s</updated>' % (created, updated)]
+    parts.extend('<tag>%s</tag>' % tag for tag in tags)
+    for body, mime_type, filename in resources:
+        parts.append('<resource><data encoding="base64">\n%s</data><mime>%s</mime>' % (
+            base64.encodestring(body), mime_type))
+        if filename:
+            parts.append('<resource-attributes><file-name>%s</file-name></resource-attributes>' % filename)
+        parts.append('</resource>')
+    parts.append('</note>\n')
+    return ''.join(parts)
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class UpdateNoteTestCase(unittest.TestCase):
+    """ base of tests writing notes through UpdateNote into mongomock """
+
+    def setUp(self):
+        # local time for logging, other tests leave TZ set to a zone dateutil cannot handle
+        self.old_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, 'leanote')
+        os.mkdir(self.store_dir)
+        self.old_config = dict((name, getattr(config, name)) for name in list(CONFIG) + ['IMAGE_STORE_DIR'])
+        for name, value in CONFIG.items():
+            setattr(config, name, value)
+        config.IMAGE_STORE_DIR = self.store_dir
+        self.client = mongomock.MongoClient()
+        self.old_mongo_client = updatenote.MongoClient
+        updatenote.MongoClient = lambda *args, **kwargs: self.client
+        self.db = self.client[config.DB_NAME]
+        self.user_id = self.db.users.insert_one({"Username": config.DB_USERNAME, "Usn": 0}).inserted_id
+        self.updaters = []
+
+    def tearDown(self):
+        for updater in self.updaters:
+            updater.close()
+        updatenote.MongoClient = self.old_mongo_client
+        for name, value in self.old_config.items():
+            setattr(config, name, value)
+        shutil.rmtree(self.tmp_dir)
+        if self.old_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.old_tz
+        time.tzset()
+
+    def updater(self, notebook_name='notebook', **kwargs):
+        updater = updatenote.UpdateNote(notebook_name, **kwargs)
+        self.updaters.append(updater)
+        return updater
+
+    def write_enex(self, notes, name='notebook.enex'):
+        enex_path = os.path.join(self.tmp_dir, name)
+        with open(enex_path, 'wb') as enex_file:
+            enex_file.write(ENEX_HEAD + ''.join(notes) + '</en-export>\n')
+        return enex_path
+
+    def parse(self, *notes):
+        """ parsed notes of .enex with given <note> elements """
+        return list(EnexParser(self.write_enex(notes, 'parsed.enex')).parse())
+
+    def stored(self, path):
+        """ body of stored image or attachment, None if missing """
+        local_path = os.path.join(self.store_dir, *path.split('/'))
+        if not os.path.isfile(local_path):
+            return None
+        with open(local_path, 'rb') as stored_file:
+            return stored_file.read()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+import pytz
+from geeknote.checkpoint import ImportCheckpoint, ImportManifest
+
+
+class testImportCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.tmp_dir, 'state')
+        self.enex_path = os.path.join(self.tmp_dir, 'notebook.enex')
+        with open(self.enex_path, 'wb') as enex_file:
+            enex_file.write('<en-export></en-export>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        checkpoint = ImportCheckpoint(self.state_dir, self.enex_path, 'Note Book')
+        self.assertIsNone(checkpoint.load())
+        checkpoint.save(200, 12345, datetime(2019, 1, 2, tzinfo=pytz.utc))
+        info = ImportCheckpoint(self.state_dir, self.enex_path, 'Note Book').load()
+        self.assertEqual(info['Ordinal'], 200)
+        self.assertEqual(info['Offset'], 12345)
+        self.assertEqual(info['LastUpdate'], '2019-01-02T00:00:00+00:00')
+        checkpoint.clear()
+        self.assertIsNone(checkpoint.load())
+
+    def test_interrupted_replace(self):
+        # windows: crash after removing the checkpoint, before renaming the .part
+        checkpoint = ImportCheckpoint(self.state_dir, self.enex_path, 'notebook')
+        checkpoint.save(3, 30, None)
+        os.rename(checkpoint.path, checkpoint.path + '.part')
+        self.assertEqual(checkpoint.load()['Ordinal'], 3)
+        checkpoint.clear()
+        self.assertIsNone(checkpoint.load())
+
+        # crash while writing the .part
+        with open(checkpoint.path + '.part', 'w') as part_file:
+            part_file.write('{"Ordinal": ')
+        self.assertIsNone(checkpoint.load())
+
+    def test_stale(self):
+        checkpoint = ImportCheckpoint(self.state_dir, self.enex_path, 'notebook')
+        checkpoint.save(1, 10, None)
+        with open(self.enex_path, 'ab') as enex_file:
+            enex_file.write('\n')
+        later = time.time() + 10
+        os.utime(self.enex_path, (later, later))
+        self.assertIsNone(checkpoint.load())
+
+    def test_quarantine(self):
+        checkpoint = ImportCheckpoint(self.state_dir, self.enex_path, 'notebook')
+        other_path = os.path.join(self.tmp_dir, 'other.enex')
+        with open(other_path, 'wb') as enex_file:
+            enex_file.write('<en-export></en-export>')
+        other = ImportCheckpoint(self.state_dir, other_path, 'notebook')
+        checkpoint.quarantine(3, {'offset': 100, 'length': 50}, u't\xfctel', ValueError('bad doctype'))
+        other.quarantine(1, {'offset': 10, 'length': 5}, u'other', ValueError('bad'))
+        quarantined = checkpoint.quarantined()
+        self.assertEqual(len(quarantined), 1)
+        self.assertEqual(quarantined[0]['Ordinal'], 3)
+        self.assertEqual(quarantined[0]['Title'], u't\xfctel')
+        self.assertEqual(quarantined[0]['Error'], 'ValueError: bad doctype')
+
+        # failed again on retry, entry replaced
+        checkpoint.quarantine(4, {'offset': 150, 'length': 20}, u'second', ValueError('bad'))
+        checkpoint.quarantine(3, {'offset': 100, 'length': 50}, u't\xfctel', IOError('missing'))
+        quarantined = checkpoint.quarantined()
+        self.assertEqual([(info['Offset'], info['Error']) for info in quarantined],
+                         [(150, 'ValueError: bad'), (100, 'IOError: missing')])
+
+        # only notes imported by the retry are removed
+        checkpoint.release([(4, {'offset': 150, 'length': 20})])
+        self.assertEqual([info['Offset'] for info in checkpoint.quarantined()], [100])
+        checkpoint.release([(1, {'offset': 10, 'length': 5})])  # of other .enex
+        self.assertEqual(len(other.quarantined()), 1)
+        checkpoint.release([(3, {'offset': 100, 'length': 50})])
+        self.assertEqual(checkpoint.quarantined(), [])
+        self.assertEqual(len(other.quarantined()), 1)
+
+
+class testImportManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_unchanged(self):
+        entry = {'title': u't\xfctel', 'created': '20190101T120000Z', 'updated': '20190102T120000Z', 'hash': 'abc'}
+        manifest = ImportManifest(self.state_dir, 'notebook')
+        self.assertFalse(manifest.unchanged(entry))
+        manifest.add(entry)
+        manifest.save()
+
+        manifest = ImportManifest(self.state_dir, 'notebook')
+        self.assertTrue(manifest.unchanged(entry))
+        self.assertFalse(manifest.unchanged(dict(entry, updated='20190103T120000Z')))
+        self.assertFalse(manifest.unchanged(dict(entry, hash='def')))
+        self.assertFalse(ImportManifest(self.state_dir, 'other').unchanged(entry))
+
+        other = dict(entry, title='other')
+        manifest.add(other)
+        manifest.prune([other])
+        self.assertFalse(manifest.unchanged(entry))
+        self.assertTrue(manifest.unchanged(other))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import itertools
+from datetime import datetime
+import pytz
+from geeknote import config, enex2mongo
+from geeknote.checkpoint import ImportManifest
+from geeknote.enex2mongo import skip_unchanged
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mongofixture import UpdateNoteTestCase, note_xml
+
+
+def index_entry(title, updated, content_hash):
+    return {'title': title, 'created': '20190101T120000Z', 'updated': updated, 'hash': content_hash}
+
+
+class testSkipUnchanged(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.manifest = ImportManifest(self.state_dir, 'notebook')
+        self.entries = [
+            index_entry(u'one', '20190102T120000Z', 'a'),
+            index_entry(u'two', '20190105T120000Z', 'b'),
+            index_entry(u'three', '20190103T120000Z', 'c'),
+        ]
+        for entry in self.entries:
+            self.manifest.add(entry)
+        self.entries[0] = dict(self.entries[0], hash='changed')
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_skip(self):
+        changed, last_update = skip_unchanged(list(enumerate(self.entries)), self.manifest, self.entries)
+        self.assertEqual([ordinal for ordinal, entry in changed], [0])
+        self.assertEqual(last_update.isoformat(), '2019-01-05T12:00:00+00:00')
+
+    def test_deleted_in_mongodb(self):
+        queried = []
+
+        def existing_notes(notes):
+            queried.append(notes)
+            return [title != u'two' for title, created in notes]
+        changed, last_update = skip_unchanged(list(enumerate(self.entries)), self.manifest, self.entries,
+                                              existing_notes)
+        self.assertEqual(len(queried), 1)  # one lookup for all unchanged notes
+        self.assertEqual([title for title, created in queried[0]], [u'two', u'three'])
+        self.assertEqual(queried[0][0][1].isoformat(), '2019-01-01T12:00:00+00:00')
+        self.assertEqual([ordinal for ordinal, entry in changed], [0, 1])
+        self.assertEqual(last_update.isoformat(), '2019-01-03T12:00:00+00:00')
+        self.assertFalse(self.manifest.unchanged(self.entries[1]))
+
+
+class InlinePool:
+    """ multiprocessing.Pool running the jobs in this process, so they see mongomock """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.closed = self.joined = False
+
+    def imap_unordered(self, func, jobs):
+        return itertools.imap(func, jobs)
+
+    def close(self):
+        self.closed = True
+
+    def terminate(self):
+        self.closed = True
+
+    def join(self):
+        self.joined = True
+
+
+class testImportParallel(UpdateNoteTestCase):
+
+    def setUp(self):
+        UpdateNoteTestCase.setUp(self)
+        self.old_state_dir = config.IMPORT_STATE_DIR
+        config.IMPORT_STATE_DIR = os.path.join(self.tmp_dir, 'state')
+        self.events = []
+        client = self.client
+
+        class RecordingClient:
+            """ mongomock client recording when it is closed """
+
+            def __getitem__(_, name):
+                return client[name]
+
+            def close(_):
+                self.events.append('client closed')
+
+        def pool(processes):
+            self.events.append('pool')
+            self.pool = InlinePool(processes)
+            return self.pool
+        self.old_mongo_client = enex2mongo.MongoClient
+        enex2mongo.MongoClient = lambda *args, **kwargs: RecordingClient()
+        self.old_pool = enex2mongo.multiprocessing.Pool
+        enex2mongo.multiprocessing.Pool = pool
+
+    def tearDown(self):
+        enex2mongo.multiprocessing.Pool = self.old_pool
+        enex2mongo.MongoClient = self.old_mongo_client
+        config.IMPORT_STATE_DIR = self.old_state_dir
+        UpdateNoteTestCase.tearDown(self)
+
+    def job(self, notebook_name, notes):
+        return (self.write_enex(notes, notebook_name + '.enex'), notebook_name, {})
+
+    def test_import_parallel(self):
+        jobs = [self.job('one', [note_xml('a', updated='20190103T120000Z')]),
+                self.job('two', [note_xml('b', updated='20190105T120000Z'), note_xml('c')])]
+        last_update = enex2mongo.import_parallel(jobs, 2)
+        self.assertEqual(last_update, datetime(2019, 1, 5, 12, tzinfo=pytz.utc))
+        self.assertEqual(self.events, ['client closed', 'pool'])
+        self.assertEqual((self.pool.processes, self.pool.closed, self.pool.joined), (2, True, True))
+        self.assertEqual(sorted(note['Title'] for note in self.db.notes.find()), ['a', 'b', 'c'])
+        self.assertEqual(len(self.db.note_tags.index_information()), 2)  # _id and unique UserId, Tag
+
+    def test_import_parallel_failed(self):
+        jobs = [self.job('one', [note_xml('a')]), (os.path.join(self.tmp_dir, 'missing.enex'), 'missing', {})]
+        self.assertRaises(RuntimeError, enex2mongo.import_parallel, jobs, 2)
+        self.assertTrue(self.pool.joined)
+        self.assertEqual([note['Title'] for note in self.db.notes.find()], ['a'])  # others imported
+
+    def test_import_notebook(self):
+        self.assertEqual(enex2mongo.import_notebook(self.job('one', [note_xml('a')])),
+                         ('one', datetime(2019, 1, 2, 12, tzinfo=pytz.utc), None))
+        notebook_name, last_update, error = enex2mongo.import_notebook(
+            (os.path.join(self.tmp_dir, 'missing.enex'), 'missing', {}))
+        self.assertEqual((notebook_name, last_update), ('missing', None))
+        self.assertTrue(error.startswith('AssertionError: missing '))
+
+
+class testSaveLastUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_last_update_fn = config.LAST_UPDATE_FN
+        config.LAST_UPDATE_FN = os.path.join(self.tmp_dir, 'last.json')
+
+    def tearDown(self):
+        config.LAST_UPDATE_FN = self.old_last_update_fn
+        shutil.rmtree(self.tmp_dir)
+
+    def recorded(self):
+        with open(config.LAST_UPDATE_FN) as json_file:
+            return json.load(json_file)
+
+    def test_save(self):
+        # naive utc, as gnsyncm expects
+        enex2mongo.save_last_update(datetime(2019, 1, 2, 13, tzinfo=pytz.timezone('Etc/GMT-1')))
+        self.assertEqual(self.recorded(), {'succeeded': '2019-01-02 12:00:00'})
+
+    def test_later_kept(self):
+        enex2mongo.save_last_update(datetime(2019, 1, 5, tzinfo=pytz.utc))
+        enex2mongo.save_last_update(datetime(2019, 1, 2, tzinfo=pytz.utc))
+        self.assertEqual(self.recorded(), {'succeeded': '2019-01-05 00:00:00'})
+        enex2mongo.save_last_update(datetime(2019, 1, 6, tzinfo=pytz.utc))
+        self.assertEqual(self.recorded(), {'succeeded': '2019-01-06 00:00:00'})
+
+    def test_recorded_with_zone(self):
+        with open(config.LAST_UPDATE_FN, 'w') as json_file:
+            json.dump({'succeeded': '2019-01-05T01:00:00+02:00'}, json_file)
+        enex2mongo.save_last_update(datetime(2019, 1, 5, tzinfo=pytz.utc))
+        self.assertEqual(self.recorded(), {'succeeded': '2019-01-05 00:00:00'})
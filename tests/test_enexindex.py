@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import io
+import gzip
+import base64
+import unittest
+from geeknote.enexindex import EnexIndex, StreamBuffer, scan, scan_file
+
+ENEX = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">
+<en-export export-date="20191020T120000Z" application="Evernote/Windows" version="6.x">
+<note><title>first &amp; one</title><content><![CDATA[<en-note><note>not a note</note></en-note>]]></content>
+<created>20190101T120000Z</created><tag>a</tag></note>
+<!-- <note> in comment -->
+<note><title>zweite \xc3\xbcbung</title><content><![CDATA[<en-note>two</en-note>]]></content>
+<created>20190101T120000Z</created><updated>20190102T120000Z</updated>
+<resource><data encoding="base64">
+%s
+</data><mime>image/png</mime></resource><resource><data encoding="base64">YWI=</data></resource></note>
+</en-export>
+''' % base64.encodestring('x' * 1000)
+
+
+class testEnexIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.enex_path = os.path.join(self.tmp_dir, 'notebook.enex')
+        with open(self.enex_path, 'wb') as enex_file:
+            enex_file.write(ENEX)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scan(self):
+        entries = list(scan(ENEX))
+        self.assertEqual(len(entries), 2)
+        first, second = entries
+        self.assertEqual(first['title'], u'first & one')
+        self.assertEqual(first['created'], u'20190101T120000Z')
+        self.assertIsNone(first['updated'])
+        self.assertEqual(first['size'], len('<en-note><note>not a note</note></en-note>'))
+        self.assertEqual(second['title'], u'zweite \xfcbung')
+        self.assertEqual(second['updated'], u'20190102T120000Z')
+        self.assertEqual((first['resources'], first['resource_bytes']), (0, 0))
+        self.assertEqual((second['resources'], second['resource_bytes']), (2, 1002))
+        self.assertEqual(len(first['hash']), 32)
+        self.assertNotEqual(first['hash'], second['hash'])
+        for entry in entries:
+            data = ENEX[entry['offset']:entry['offset'] + entry['length']]
+            self.assertTrue(data.startswith('<note>') and data.endswith('</note>'))
+
+    def test_scan_file(self):
+        self.assertEqual(list(scan_file(self.enex_path)), list(scan(ENEX)))
+        with open(self.enex_path, 'wb'):
+            pass
+        self.assertEqual(list(scan_file(self.enex_path)), [])
+
+    def test_sidecar(self):
+        enex_index = EnexIndex(self.enex_path)
+        self.assertIsNone(enex_index.load(build=False))
+        entries = enex_index.load()
+        self.assertTrue(os.path.isfile(self.enex_path + '.idx'))
+        self.assertEqual(EnexIndex(self.enex_path).load(build=False), entries)
+
+        # changed .enex makes index stale
+        with open(self.enex_path, 'ab') as enex_file:
+            enex_file.write('\n')
+        later = time.time() + 10
+        os.utime(self.enex_path, (later, later))
+        self.assertIsNone(EnexIndex(self.enex_path).load(build=False))
+
+    def test_character_references(self):
+        note = '<note><title>caf&#233; &#xE4;&#x1F600; &amp;#1; &lt;b&gt; &quot;q&apos;</title>' \
+            '<content><![CDATA[<en-note/>]]></content></note>'
+        entry, = scan(note)
+        self.assertEqual(entry['title'], u'caf\xe9 \xe4\U0001F600 &#1; <b> "q\'')
+        with open(self.enex_path, 'wb') as enex_file:
+            enex_file.write(note)
+        self.assertEqual([note.title for note in EnexIndex(self.enex_path).parse()], [entry['title']])
+
+    def test_sidecar_not_writable(self):
+        os.mkdir(self.enex_path + '.idx.part')  # cannot be written, like a read-only directory
+        enex_index = EnexIndex(self.enex_path)
+        entries = enex_index.load()
+        self.assertEqual(len(entries), 2)
+        self.assertFalse(os.path.exists(self.enex_path + '.idx'))
+        self.assertEqual([note.title for note in enex_index.parse()], [u'first & one', u'zweite \xfcbung'])
+
+    def test_parse(self):
+        enex_index = EnexIndex(self.enex_path)
+        entries = enex_index.load()
+        notes = list(enex_index.parse(entries[1:]))
+        self.assertEqual(len(notes), 1)
+        self.assertEqual(notes[0].title, u'zweite \xfcbung')
+        self.assertEqual(notes[0].content, '<en-note>two</en-note>')
+        self.assertEqual([note.title for note in enex_index.parse()], [u'first & one', u'zweite \xfcbung'])
+
+    def test_stream_buffer(self):
+        stream = StreamBuffer(io.BytesIO(ENEX), chunk_size=7)
+        self.assertEqual(list(scan(stream)), list(scan(ENEX)))
+        self.assertEqual(stream.find('<note>', 0), ENEX.find('<note>'))
+        stream.release(100)
+        self.assertEqual(stream[100:110], ENEX[100:110])
+        self.assertEqual(stream.find('</en-export>', 100), ENEX.find('</en-export>'))
+        self.assertEqual(stream.find('missing', 100), -1)
+
+    def test_compressed(self):
+        gz_path = self.enex_path + '.gz'
+        with gzip.open(gz_path, 'wb') as gz_file:
+            gz_file.write(ENEX)
+        self.assertEqual(list(scan_file(gz_path)), list(scan(ENEX)))
+        enex_index = EnexIndex(gz_path)
+        entries = enex_index.load()
+        self.assertTrue(os.path.isfile(gz_path + '.idx'))
+        self.assertEqual([note.title for note in enex_index.parse(entries[1:])], [u'zweite \xfcbung'])
+        self.assertEqual([note.title for note in enex_index.parse()], [u'first & one', u'zweite \xfcbung'])
+
+    def test_compressed_broken_note(self):
+        # streaming pass fails at the broken note, the notes after it are still read
+        head, notes = ENEX.split('<note>', 1)
+        notes = '<note>' + notes.rsplit('</en-export>', 1)[0]
+        gz_path = self.enex_path + '.gz'
+        with gzip.open(gz_path, 'wb') as gz_file:
+            gz_file.write(head + notes + notes.replace('<tag>a</tag>', '<tag>a</tga>') + '</en-export>\n')
+        enex_index = EnexIndex(gz_path)
+        entries = enex_index.load()
+        self.assertEqual(len(entries), 4)
+        results = [(note.title if note else None, error is not None)
+                   for entry, note, error in enex_index.parse_entries(entries[1:])]
+        self.assertEqual(results, [(u'zweite \xfcbung', False), (None, True), (u'zweite \xfcbung', False)])
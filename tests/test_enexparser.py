@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import shutil
+import base64
+import hashlib
+import tempfile
+import unittest
+from datetime import datetime
+import pytz
+from lxml import etree
+from geeknote import enexparser
+from geeknote.enexparser import EnexParser, ENResource, ENResourceData
+from geeknote.enexindex import EnexIndex
+
+RESOURCE = '''<resource><data encoding="base64">
+%s
+</data><mime>image/png</mime><resource-attributes><file-name>a.png</file-name></resource-attributes></resource>'''
+
+ENEX = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">
+<en-export export-date="20191020T120000Z" application="Evernote/Windows" version="6.x">
+<note><title>first</title><content><![CDATA[<en-note>one</en-note>]]></content>
+<created>20190101T120000Z</created><tag>a</tag><tag>b</tag></note>
+<note><title>second</title><content><![CDATA[<en-note>two</en-note>]]></content>
+<created>20190101T120000Z</created><updated>20190102T120000Z</updated>%s</note>
+</en-export>
+'''
+
+
+class testEnexParser(unittest.TestCase):
+
+    def test_resource_data(self):
+        body = ''.join(chr(n % 256) for n in range(10000))
+        encoded = base64.encodestring(body)  # wrapped lines
+        data = ENResourceData(encoded)
+        self.assertEqual(data.size, len(body))
+        self.assertEqual(data.hash, hashlib.md5(body).hexdigest())
+        self.assertEqual(data.body, body)
+        self.assertEqual(data.open().read(), body)
+
+    def test_resource_data_chunks(self):
+        # chunk boundaries not aligned with base64 quads
+        body = 'x' * 1000 + 'yz'
+        old_chunk_size = enexparser.DECODE_CHUNK_SIZE
+        enexparser.DECODE_CHUNK_SIZE = 7
+        try:
+            data = ENResourceData(base64.encodestring(body))
+        finally:
+            enexparser.DECODE_CHUNK_SIZE = old_chunk_size
+        self.assertEqual(data.body, body)
+
+    def test_resource(self):
+        body = 'png data'
+        resource = ENResource(etree.fromstring(RESOURCE % base64.b64encode(body)))
+        self.assertEqual(resource.hash, hashlib.md5(body).hexdigest())
+        self.assertEqual(resource.filename, 'a.png')
+        self.assertEqual(resource.data.body, body)
+
+    def test_parse(self):
+        fd, enex_path = tempfile.mkstemp(suffix='.enex')
+        with os.fdopen(fd, 'wb') as enex_file:
+            enex_file.write(ENEX % (RESOURCE % base64.b64encode('png data')))
+        try:
+            notes = [(note.title, note.tags, note.content, note.updated.day, len(note.resources))
+                     for note in EnexParser(enex_path).parse()]
+        finally:
+            os.remove(enex_path)
+        self.assertEqual(notes, [
+            ('first', ['a', 'b'], '<en-note>one</en-note>', 1, 0),
+            ('second', [], '<en-note>two</en-note>', 2, 1),
+        ])
+
+    def test_lazy_resources(self):
+        bodies = ['first', 'second', 'third']
+        resources = ''.join(RESOURCE % base64.b64encode(body) for body in bodies)
+        note = enexparser.EnNote(etree.fromstring(
+            '<note><title>t</title><content>c</content>%s</note>' % resources))
+        self.assertEqual([resource._data for resource in note.resources], [None, None, None])
+
+        found = note.get_image_resource({'hash': hashlib.md5('second').hexdigest()})
+        self.assertEqual(found.data.body, 'second')
+        self.assertEqual([resource._data is not None for resource in note.resources], [True, True, False])
+        self.assertIs(note.get_image_resource({'hash': hashlib.md5('first').hexdigest()}), note.resources[0])
+        self.assertIsNone(note.get_image_resource({'hash': 'missing'}))
+
+    def test_parse_date(self):
+        self.assertEqual(enexparser.parse_date('20190102T131415Z'),
+                         datetime(2019, 1, 2, 13, 14, 15, tzinfo=pytz.utc))
+        # other formats by dateutil
+        self.assertEqual(enexparser.parse_date('2019-01-02T13:14:15+01:00'),
+                         datetime(2019, 1, 2, 12, 14, 15, tzinfo=pytz.utc))
+        self.assertEqual(enexparser.parse_date('2019-01-02 13:14:15').tzinfo, pytz.utc)
+
+    def test_note_info(self):
+        note = enexparser.EnNote(etree.fromstring(
+            '<note><title>t</title><content>c</content><tag>a</tag><!-- comment -->'
+            '<note-attributes><author>x</author></note-attributes><tag>b</tag>'
+            '<resource><data encoding="base64">YQ==</data><mime>image/png</mime>'
+            '<resource-attributes><file-name>a.png</file-name></resource-attributes></resource>'
+            '<resource><mime>image/gif</mime></resource></note>'))
+        self.assertEqual((note.title, note.content, note.tags), ('t', 'c', ['a', 'b']))
+        self.assertEqual((note.created.year, note.updated.year), (1970, 1970))
+        self.assertEqual([(r.mime_type, r.filename) for r in note.resources], [('image/png', 'a.png')])
+
+    def test_target(self):
+        # same note as test_note_info, fed in pieces
+        xml = ('<en-export><note><title>t</title><content>c</content><tag>a</tag><!-- comment -->'
+               '<note-attributes><author>x</author></note-attributes><tag>b</tag>'
+               '<resource><data encoding="base64">\nYWJj\nZA==\n</data><mime>image/png</mime>'
+               '<resource-attributes><file-name>a.png</file-name></resource-attributes></resource>'
+               '<resource><mime>image/gif</mime></resource></note>'
+               '<note><title>second</title></note></en-export>')
+        chunks = [xml[start:start + 5] for start in range(0, len(xml), 5)]
+        (ordinal, note), (_, second) = list(enexparser.parse_chunks(chunks))
+        self.assertEqual((ordinal, note.title, note.content, note.tags), (0, 't', 'c', ['a', 'b']))
+        self.assertEqual((note.created.year, note.updated.year, second.title), (1970, 1970, 'second'))
+        self.assertEqual([(r.mime_type, r.filename) for r in note.resources], [('image/png', 'a.png')])
+        self.assertTrue(hasattr(note.resources[0]._encoded, 'read'))  # spooled as parsed
+        self.assertEqual(note.resources[0].data.body, 'abcd')
+
+        self.assertEqual([(ordinal, note.title) for ordinal, note in enexparser.parse_chunks([xml], set([1]))],
+                         [(1, 'second')])
+        with self.assertRaises(ValueError):
+            list(enexparser.parse_chunks([xml[:-20]]))
+
+    def test_parse_notes(self):
+        fd, enex_path = tempfile.mkstemp(suffix='.enex')
+        with os.fdopen(fd, 'wb') as enex_file:
+            enex_file.write(ENEX % '')
+        try:
+            parser = EnexParser(enex_path)
+            self.assertEqual([(ordinal, note.title) for ordinal, note in parser.parse_notes(set([1]))],
+                             [(1, 'second')])
+            self.assertEqual(list(parser.parse_notes(set())), [])
+        finally:
+            os.remove(enex_path)
+
+    def test_compressed(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            enex = ENEX % ''
+            with gzip.open(os.path.join(tmp_dir, 'gz.enex.gz'), 'wb') as gz_file:
+                gz_file.write(enex)
+            for fn in ('plain.enex', 'plain.enex.gz', 'other.txt'):
+                with open(os.path.join(tmp_dir, fn), 'wb') as enex_file:
+                    enex_file.write(enex)
+            if enexparser.zstandard is not None:
+                with open(os.path.join(tmp_dir, 'zst.enex.zst'), 'wb') as zst_file:
+                    zst_file.write(enexparser.zstandard.ZstdCompressor().compress(enex))
+
+            enex_files = enexparser.list_enex_files(tmp_dir)
+            self.assertEqual([name for path, name in enex_files],
+                             ['gz', 'plain'] + (['zst'] if enexparser.zstandard is not None else []))
+            self.assertTrue(enex_files[1][0].endswith('plain.enex'))
+            for path, name in enex_files:
+                self.assertEqual([note.title for note in EnexParser(path).parse()], ['first', 'second'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_enex_name(self):
+        self.assertEqual(enexparser.enex_name('/x/Note Book.enex'), 'Note Book')
+        self.assertEqual(enexparser.enex_name('a.b.ENEX.gz'), 'a.b')
+        self.assertEqual(enexparser.enex_name('diary.enex.zst'), 'diary')
+        self.assertTrue(enexparser.is_compressed('diary.enex.zst'))
+        self.assertFalse(enexparser.is_compressed('diary.enex'))
+
+
+def rss_kb(field):
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/clear_refs'), "requires linux /proc")
+class testResourceMemory(unittest.TestCase):
+    """ peak memory parsing a note with a large resource does not grow with the resource """
+
+    RESOURCE_SIZE = 24 * 1024 * 1024
+
+    def setUp(self):
+        fd, self.enex_path = tempfile.mkstemp(suffix='.enex')
+        self.body_hash = hashlib.md5()
+        with os.fdopen(fd, 'wb') as enex_file:
+            enex_file.write(ENEX.split('%s')[0])
+            enex_file.write('<resource><data encoding="base64">\n')
+            chunk = os.urandom(57 * 1024)
+            for n in range(self.RESOURCE_SIZE // len(chunk)):
+                self.body_hash.update(chunk)
+                enex_file.write(base64.encodestring(chunk))
+            enex_file.write('</data><mime>image/png</mime></resource>')
+            enex_file.write(ENEX.split('%s')[1])
+
+    def tearDown(self):
+        for path in (self.enex_path, self.enex_path + '.idx'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def peak_growth(self, parse):
+        """ growth of peak RSS (bytes) while parsing, hash of the resource """
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')  # reset peak RSS
+        start = rss_kb('VmRSS')
+        resource_hash = None
+        for note in parse:
+            for resource in note.resources:
+                resource_hash = resource.hash
+                resource.data.open().close()
+        return (rss_kb('VmHWM') - start) * 1024, resource_hash
+
+    def test_parser(self):
+        growth, resource_hash = self.peak_growth(EnexParser(self.enex_path).parse())
+        self.assertEqual(resource_hash, self.body_hash.hexdigest())
+        self.assertLess(growth, self.RESOURCE_SIZE // 4)
+
+    def test_index(self):
+        enex_index = EnexIndex(self.enex_path)
+        enex_index.load()
+        growth, resource_hash = self.peak_growth(enex_index.parse())
+        self.assertEqual(resource_hash, self.body_hash.hexdigest())
+        self.assertLess(growth, self.RESOURCE_SIZE // 4)
+
+    def test_index_compressed(self):
+        gz_path = self.enex_path + '.gz'
+        with open(self.enex_path, 'rb') as enex_file:
+            with gzip.open(gz_path, 'wb', 1) as gz_file:
+                shutil.copyfileobj(enex_file, gz_file)
+        os.remove(self.enex_path)
+        self.enex_path = gz_path
+        enex_index = EnexIndex(gz_path)
+        entries = enex_index.load()
+        growth, resource_hash = self.peak_growth(enex_index.parse(entries[1:]))
+        self.assertEqual(resource_hash, self.body_hash.hexdigest())
+        self.assertLess(growth, self.RESOURCE_SIZE // 4)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from geeknote.enml import EnmlContent, restore
+
+ENML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
+<en-note><div>caf\xc3\xa9&nbsp;&amp;</div><div></div><img src="file:/C:/Temp/enhtmlclip/Image.jpg"/><en-media hash="aaa" type="image/jpeg"></en-media> tail<br/><en-media hash="bbb" type="application/pdf"></en-media><en-media hash="aaa" type="image/jpeg"></en-media></en-note>'''
+
+
+class testEnml(unittest.TestCase):
+
+    def test_media(self):
+        media = EnmlContent(ENML).media()
+        self.assertEqual([info['hash'] for info in media], ['aaa', 'bbb', 'aaa'])
+        self.assertEqual(media[0]['extension'], 'jpeg')
+        self.assertEqual(media[1]['type'], 'application')
+
+    def test_rewrite(self):
+        calls = []
+
+        def resolve(info):
+            calls.append(info['hash'])
+            return 'ID1'
+
+        content = EnmlContent(ENML).rewrite(resolve)
+        self.assertEqual(calls, ['aaa'])
+        self.assertIn('<img src="/api/file/getImage?fileId=ID1"/> tail<br/>', content)
+        self.assertEqual(content.count('fileId=ID1'), 2)
+        self.assertNotIn('enhtmlclip', content)
+        self.assertIn('<en-media hash="bbb" type="application/pdf"></en-media>', content)
+        self.assertIn('<div>caf\xc3\xa9&nbsp;&amp;</div><div></div>', content)
+        self.assertIn('<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">', content)
+
+    def test_rewrite_attachment(self):
+        calls = []
+
+        def resolve_attachment(info):
+            calls.append(info['hash'])
+            return 'AT1', u'caf\xe9.pdf'
+
+        content = EnmlContent(ENML).rewrite(lambda info: None, resolve_attachment)
+        self.assertEqual(calls, ['bbb'])
+        self.assertIn('<br/><a href="/api/file/getAttach?fileId=AT1">caf\xc3\xa9.pdf</a>', content)
+        self.assertIn('<en-media hash="aaa" type="image/jpeg"></en-media>', content)
+
+    def test_rewrite_unresolved(self):
+        content = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml.dtd">\n' \
+            '<en-note><en-media hash="aaa" type="image/png"/></en-note>'
+        self.assertEqual(EnmlContent(content).rewrite(lambda info: None), content)
+
+    def test_resource_hashes(self):
+        enml = EnmlContent(ENML)
+        digest = enml.digest()
+        enml.rewrite(lambda info: 'ID1')
+        self.assertEqual(enml.resource_hashes(), ['aaa', 'bbb'])
+        self.assertEqual(enml.digest(), digest)
+        self.assertEqual(EnmlContent(ENML.decode('utf-8')).digest(), digest)
+
+    def test_unicode_content(self):
+        media = EnmlContent(ENML.decode('utf-8')).media()
+        self.assertEqual(len(media), 3)
+
+    def test_unsupported_doctype(self):
+        content = '<?xml version="1.0"?>\n<!DOCTYPE html>\n<html></html>'
+        self.assertRaises(ValueError, EnmlContent, content)
+
+    def test_syntax_error(self):
+        self.assertRaises(ValueError, EnmlContent, '<en-note><div></en-note>')
+
+    def test_restore(self):
+        resolved = {'5d9b3f1e2c7a4b0001a1b2c3': ('aaa', 'image/jpeg'), '5d9b3f1e2c7a4b0001a1b2c4': ('bbb', 'application/pdf')}
+        content = EnmlContent(ENML).rewrite(lambda info: '5d9b3f1e2c7a4b0001a1b2c3',
+                                            lambda info: ('5d9b3f1e2c7a4b0001a1b2c4', 'b.pdf'))
+        restored = restore(content, resolved.get, resolved.get)
+        self.assertIn('<en-media hash="aaa" type="image/jpeg"/> tail<br/><en-media hash="bbb" type="application/pdf"/>',
+                      restored)
+        self.assertIn('<div>caf\xc3\xa9&nbsp;&amp;</div>', restored)
+        self.assertEqual([info['hash'] for info in EnmlContent(restored).media()], ['aaa', 'bbb', 'aaa'])
+
+    def test_restore_html(self):
+        # written in leanote, image unknown
+        restored = restore(u'<p>caf\xe9 <img src="/api/file/getImage?fileId=5d9b3f1e2c7a4b0001a1b2c3"></p>',
+                           lambda file_id: None, lambda attach_id: None)
+        self.assertTrue(restored.startswith('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE en-note'))
+        self.assertIn('<en-note><p>caf\xc3\xa9 <img src="/api/file/getImage?fileId=5d9b3f1e2c7a4b0001a1b2c3"/></p></en-note>',
+                      restored)
+        self.assertEqual(EnmlContent(restore('', None, None)).media(), [])
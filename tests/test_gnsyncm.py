@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import unittest
+from geeknote import gnsyncm
+from geeknote.gnsyncm import GNSyncM, PrefetchQueue
+
+
+def wait_until(check, timeout=2.0):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.01)
+    return check()
+
+
+class testPrefetchQueue(unittest.TestCase):
+
+    def put_in_thread(self, queue, item, size=0):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(queue.put(item, size)))
+        thread.daemon = True
+        thread.start()
+        return thread, results
+
+    def test_bounded_by_items(self):
+        queue = PrefetchQueue(2, 1000)
+        self.assertTrue(queue.put('a') and queue.put('b'))
+        thread, results = self.put_in_thread(queue, 'c')
+        time.sleep(0.1)
+        self.assertEqual(results, [])  # producer waits for room
+        self.assertEqual(queue.get(), 'a')
+        thread.join(2)
+        self.assertEqual(results, [True])
+        self.assertEqual([queue.get(), queue.get()], ['b', 'c'])
+
+    def test_bounded_by_bytes(self):
+        queue = PrefetchQueue(10, 100)
+        self.assertTrue(queue.put('a', 60))
+        thread, results = self.put_in_thread(queue, 'b', 60)
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        self.assertEqual(queue.get(), 'a')
+        thread.join(2)
+        self.assertEqual(results, [True])
+        # larger than max_bytes, let through when empty
+        self.assertEqual(queue.get(), 'b')
+        self.assertTrue(queue.put('c', 500))
+        self.assertEqual(queue.get(), 'c')
+
+    def test_close(self):
+        queue = PrefetchQueue(1, 100)
+        queue.put('a')
+        thread, results = self.put_in_thread(queue, 'b')
+        queue.close()
+        thread.join(2)
+        self.assertEqual(results, [False])
+        self.assertFalse(queue.put('c'))
+
+
+class FakeNote:
+
+    def __init__(self, n):
+        self.n = n
+
+    def loaded_size(self):
+        return 10
+
+
+class FakeUpdater:
+    """ records applied notes, optionally waiting for release before the first one """
+
+    def __init__(self, release=None):
+        self.release = release
+        self.applied = []
+        self.finished = False
+
+    def apply(self, note, db_note, enml, lookup=False):
+        if self.release is not None:
+            self.release.wait(5)
+        self.applied.append((note.n, enml, lookup))
+        return note.n % 2 == 0
+
+    def finish(self):
+        self.finished = True
+
+    def update_note_count(self):
+        pass
+
+
+class FakeSync(GNSyncM):
+    """ sync of notes 0..count-1 with fake EN fetch, failing after fail_after notes if set """
+
+    def __init__(self, count, updater, pipeline=True, fail_after=None):
+        self.notebook_name = 'notebook'
+        self.all_set = True
+        self.pipeline = pipeline
+        self.updater = updater
+        self.count = count
+        self.fail_after = fail_after
+        self.fetched = 0
+
+    def _get_notes(self, changed_after=None):
+        return range(self.count)
+
+    def _fetch(self, notes, changed_after, prefetch=False):
+        for n in notes:
+            if n == self.fail_after:
+                raise IOError("EN connection lost")
+            self.fetched += 1
+            yield FakeNote(n), None, 'enml %s' % n
+
+
+class testSyncPipelined(unittest.TestCase):
+
+    def setUp(self):
+        self.old_queue_size = gnsyncm.SYNC_QUEUE_SIZE
+
+    def tearDown(self):
+        gnsyncm.SYNC_QUEUE_SIZE = self.old_queue_size
+
+    def fetch_threads(self):
+        return [thread for thread in threading.enumerate() if thread.name == 'gnsyncm-fetch']
+
+    def test_same_as_sequential(self):
+        pipelined, sequential = FakeUpdater(), FakeUpdater()
+        self.assertEqual(FakeSync(7, pipelined).sync(), 4)
+        self.assertEqual(FakeSync(7, sequential, pipeline=False).sync(), 4)
+        self.assertEqual([applied[:2] for applied in pipelined.applied],
+                         [applied[:2] for applied in sequential.applied])
+        self.assertTrue(pipelined.finished and sequential.finished)
+        self.assertTrue(all(lookup for n, enml, lookup in pipelined.applied))
+
+    def test_fetch_bounded(self):
+        gnsyncm.SYNC_QUEUE_SIZE = 2
+        release = threading.Event()
+        sync = FakeSync(20, FakeUpdater(release))
+        thread = threading.Thread(target=sync.sync)
+        thread.start()
+        # first note taken, two queued, one more fetched waiting for room
+        self.assertTrue(wait_until(lambda: sync.fetched == 4))
+        time.sleep(0.2)
+        self.assertEqual(sync.fetched, 4)
+        release.set()
+        thread.join(5)
+        self.assertEqual(sync.fetched, 20)
+
+    def test_fetch_failure(self):
+        updater = FakeUpdater()
+        sync = FakeSync(10, updater, fail_after=3)
+        self.assertRaises(IOError, sync.sync)
+        self.assertEqual([n for n, enml, lookup in updater.applied], [0, 1, 2])
+        self.assertFalse(updater.finished)
+        self.assertEqual(self.fetch_threads(), [])
+
+    def test_write_failure(self):
+        gnsyncm.SYNC_QUEUE_SIZE = 2
+
+        class FailingUpdater(FakeUpdater):
+            def apply(self, note, db_note, enml, lookup=False):
+                raise IOError("mongodb connection lost")
+        sync = FakeSync(50, FailingUpdater())
+        self.assertRaises(IOError, sync.sync)
+        # fetch stage waiting for room is released and ends
+        self.assertEqual(self.fetch_threads(), [])
+        self.assertTrue(sync.fetched < 50)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from bson.objectid import ObjectId
+from geeknote.imagegc import ImageGC, file_ids
+from geeknote.imagehandler import LocalStore
+from geeknote.notehistory import NoteHistory
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def image_ref(file_id):
+    return '<img src="/api/file/getImage?fileId=%s"/>' % file_id
+
+
+class testImageGC(unittest.TestCase):
+
+    def test_file_ids(self):
+        content = '<img src="/api/file/getImage?fileId=5d9b3f1e2c7a4b0001a1b2c3"/>' \
+            '<img src="/file/outputImage?fileId=5D9B3F1E2C7A4B0001A1B2C4"/>' \
+            '<img src="/api/file/getImage?fileId=5d9b3f1e2c7a4b0001a1b2c3"/><img src="x.png"/>'
+        self.assertEqual(file_ids(content), set([
+            ObjectId('5d9b3f1e2c7a4b0001a1b2c3'), ObjectId('5d9b3f1e2c7a4b0001a1b2c4')]))
+        self.assertEqual(file_ids(None), set())
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class testImageGCSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.store = LocalStore(self.base_dir)
+        self.db = mongomock.MongoClient().db
+        self.user_id = ObjectId()
+        self.note_id = ObjectId()
+        self.files = dict((name, self.add_file(name)) for name in
+                          ('referenced', 'orphan', 'history', 'album', 'variants'))
+        self.db.files.update_one({"_id": self.files['album']}, {"$set": {"AlbumId": ObjectId()}})
+        self.db.note_contents.insert_one({"_id": self.note_id, "UserId": self.user_id,
+                                          "Content": "<p>note</p>" + image_ref(self.files['referenced'])})
+        NoteHistory(self.db).add(self.note_id, self.user_id, image_ref(self.files['history']), "<p>note</p>",
+                                 None, self.user_id)
+        for name in ('referenced', 'orphan', 'history'):  # history: no longer in note, stale
+            self.db.note_images.insert_one({"NoteId": self.note_id, "ImageId": self.files[name]})
+        # other user's image and note_images entry are not touched
+        self.other_file = self.db.files.insert_one({"UserId": ObjectId(), "Path": "files/other.png"}).inserted_id
+        self.db.note_images.insert_one({"NoteId": ObjectId(), "ImageId": self.other_file})
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def add_file(self, name):
+        path = 'files/u1/%s.png' % name
+        self.store.put('files/u1/', '%s.png' % name, io.BytesIO('png ' + name))
+        file_obj = {"UserId": self.user_id, "Path": path, "Size": 4 + len(name)}
+        if name == 'variants':
+            self.store.put('files/u1/', 'variants.thumb.jpg', io.BytesIO('thumb'))
+            file_obj["Variants"] = [{"Name": "thumb", "Path": "files/u1/variants.thumb.jpg", "Size": 5}]
+        return self.db.files.insert_one(file_obj).inserted_id
+
+    def stored(self, name):
+        return self.store.size('files/u1/%s' % name) is not None
+
+    def test_sweep(self):
+        stats = ImageGC(self.db, self.user_id, self.store, batch_size=1).run()
+        self.assertEqual((stats["files"], stats["stored"], stats["missing"], stats["note_images"]), (2, 3, 0, 1))
+        self.assertEqual(stats["bytes"], len('png orphan') + len('png variants') + 5)
+        remaining = set(file_obj["_id"] for file_obj in self.db.files.find())
+        self.assertEqual(remaining, set([self.files['referenced'], self.files['history'], self.files['album'],
+                                         self.other_file]))
+        for name in ('referenced.png', 'history.png', 'album.png'):
+            self.assertTrue(self.stored(name), name)
+        for name in ('orphan.png', 'variants.png', 'variants.thumb.jpg'):
+            self.assertFalse(self.stored(name), name)
+        self.assertEqual(sorted(note_image["ImageId"] for note_image in self.db.note_images.find()),
+                         sorted([self.files['referenced'], self.other_file]))
+
+        # stored file removed meanwhile
+        os.remove(os.path.join(self.base_dir, 'files', 'u1', 'history.png'))
+        self.db.note_content_histories.delete_many({})
+        stats = ImageGC(self.db, self.user_id, self.store).run()
+        self.assertEqual((stats["files"], stats["stored"], stats["missing"]), (1, 0, 1))
+
+    def test_dry_run(self):
+        stats = ImageGC(self.db, self.user_id, self.store).run(dry_run=True)
+        self.assertEqual((stats["files"], stats["note_images"]), (2, 2))
+        self.assertEqual(self.db.files.count_documents({}), 6)
+        self.assertEqual(self.db.note_images.count_documents({}), 4)
+        for name in ('orphan.png', 'variants.png', 'variants.thumb.jpg'):
+            self.assertTrue(self.stored(name), name)
+
+    def test_mongodb_only(self):
+        stats = ImageGC(self.db, self.user_id).run()
+        self.assertEqual((stats["files"], stats["stored"]), (2, 0))
+        self.assertEqual(self.db.files.count_documents({}), 4)
+        self.assertTrue(self.stored('orphan.png'))
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from geeknote import config
+from geeknote.imagehandler import ImageHandler, FTPStore, FTPPool, LocalStore, GridFSStore, get_image_store
+
+try:
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+except ImportError:
+    mongomock = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+try:
+    from ftp_standin import LocalFTPServer
+except ImportError:
+    LocalFTPServer = None  # requires pyftpdlib
+
+
+class StoreChecks:
+    """ put / size / retrieve / delete, common to the image stores """
+
+    def check_store(self, store):
+        img_path = store.put('files/a/b/', 'c.png', io.BytesIO('png data'))
+        self.assertEqual(img_path, 'files/a/b/c.png')
+        self.assertEqual(store.size(img_path), len('png data'))
+        body = io.BytesIO()
+        self.assertTrue(store.retrieve(img_path, body))
+        self.assertEqual(body.getvalue(), 'png data')
+
+        # replaced by a new upload to the same path
+        stream = io.BytesIO('new png data')
+        stream.read(3)  # read from the start regardless
+        self.assertEqual(store.put('files/a/b', 'c.png', stream), img_path)
+        self.assertEqual(store.size(img_path), len('new png data'))
+        body = io.BytesIO()
+        store.retrieve(img_path, body)
+        self.assertEqual(body.getvalue(), 'new png data')
+
+        self.assertTrue(store.delete(img_path))
+        self.assertEqual(store.size(img_path), None)
+        self.assertFalse(store.retrieve(img_path, io.BytesIO()))
+        self.assertFalse(store.delete(img_path))
+        store.close()
+
+
+class BrokenStream(io.BytesIO):
+    """ body failing to be read, e.g. spooled file on a full disk """
+
+    def read(self, size=-1):
+        raise IOError("read failed")
+
+
+class testLocalStore(unittest.TestCase, StoreChecks):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_store(self):
+        self.check_store(LocalStore(self.base_dir))
+        self.assertRaises(AssertionError, LocalStore, os.path.join(self.base_dir, 'missing'))
+
+    def test_replace_through_part(self):
+        store = LocalStore(self.base_dir)
+        img_path = store.put('files/a/', 'c.png', io.BytesIO('png data'))
+        local_dir = os.path.join(self.base_dir, 'files', 'a')
+        self.assertEqual(os.listdir(local_dir), ['c.png'])
+        # failed upload leaves the stored image as it was
+        self.assertRaises(IOError, store.put, 'files/a/', 'c.png', BrokenStream('new png data'))
+        body = io.BytesIO()
+        store.retrieve(img_path, body)
+        self.assertEqual(body.getvalue(), 'png data')
+        store.put('files/a/', 'c.png', io.BytesIO('new png data'))
+        self.assertEqual(os.listdir(local_dir), ['c.png'])
+        self.assertEqual(store.size(img_path), len('new png data'))
+
+    def test_get_image_store(self):
+        old_config = (config.IMAGE_STORE, config.IMAGE_STORE_DIR)
+        config.IMAGE_STORE, config.IMAGE_STORE_DIR = 'local', self.base_dir
+        try:
+            self.assertEqual(get_image_store().base_dir, self.base_dir)
+            self.assertRaises(ValueError, get_image_store, name='s3')
+        finally:
+            config.IMAGE_STORE, config.IMAGE_STORE_DIR = old_config
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class testGridFSStore(unittest.TestCase, StoreChecks):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+
+    def test_store(self):
+        self.check_store(GridFSStore(self.db))
+
+    def test_replaced_file_removed(self):
+        store = GridFSStore(self.db)
+        store.put('files/a/', 'c.png', io.BytesIO('png data'))
+        store.put('files/a/', 'c.png', io.BytesIO('new png data'))
+        store.put('files/a/', 'd.png', io.BytesIO('other'))
+        collection = self.db[config.IMAGE_STORE_GRIDFS]
+        self.assertEqual(sorted(grid_file['filename'] for grid_file in collection.files.find()),
+                         ['files/a/c.png', 'files/a/d.png'])
+        self.assertTrue(store.delete('files/a/c.png'))
+        self.assertEqual(collection.files.count_documents({}), 1)
+        self.assertEqual(collection.chunks.count_documents({}), 1)  # chunks of replaced files removed too
+        self.assertTrue(isinstance(get_image_store(self.db, 'gridfs'), GridFSStore))
+
+
+class FailingStore(LocalStore):
+    """ local store failing uploads of images named bad* """
+
+    def put(self, img_dir, img_name, fp):
+        if img_name.startswith('bad'):
+            raise IOError("upload of %s failed" % img_name)
+        return LocalStore.put(self, img_dir, img_name, fp)
+
+
+class testImageHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_uploads(self):
+        handler = ImageHandler(LocalStore(self.base_dir))
+        # more tasks than the bounded queue holds
+        tasks = [handler.submit('u1/a', '%s.png' % n, 'data %s' % n) for n in range(10)]
+        handler.wait(tasks)
+        self.assertEqual([task.img_path for task in tasks], ['files/u1/a/%s.png' % n for n in range(10)])
+        self.assertTrue(all(task.img_data is None for task in tasks))  # bodies freed
+        with open(os.path.join(self.base_dir, 'files', 'u1', 'a', '7.png'), 'rb') as img_file:
+            self.assertEqual(img_file.read(), 'data 7')
+        self.assertEqual(handler.upload_image('u1/b/', 'c.png', io.BytesIO('streamed')), 'files/u1/b/c.png')
+        handler.close()
+
+    def test_wait_errors(self):
+        handler = ImageHandler(FailingStore(self.base_dir))
+        tasks = [handler.submit('u1', name, 'data') for name in ('a.png', 'bad1.png', 'b.png', 'bad2.png')]
+        try:
+            handler.wait(tasks)
+        except IOError as err:
+            self.assertEqual(str(err), 'upload of bad1.png failed')  # first failure raised
+        else:
+            self.fail("upload failure not raised")
+        # other uploads done regardless
+        self.assertEqual([task.img_path for task in tasks], ['files/u1/a.png', None, 'files/u1/b.png', None])
+        self.assertRaises(IOError, tasks[3].wait)
+        # workers keep running after a failure, and stop on close
+        self.assertEqual(handler.upload_image('u1', 'c.png', 'data'), 'files/u1/c.png')
+        workers = list(handler._workers)
+        handler.close()
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+
+@unittest.skipIf(LocalFTPServer is None, "requires pyftpdlib")
+class testFTPPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFTPServer(idle_timeout=1).start()
+        self.old_config = (config.FTP_HOST, config.FTP_PORT, config.FTP_USER, config.FTP_PWD)
+        self.server.configure(config)
+
+    def tearDown(self):
+        config.FTP_HOST, config.FTP_PORT, config.FTP_USER, config.FTP_PWD = self.old_config
+        self.server.stop()
+
+    def test_session_reused(self):
+        pool = FTPPool(2)
+        self.assertEqual(pool.run(lambda ftp: ftp.pwd()), '/')
+        self.assertEqual(pool.run(lambda ftp: ftp.pwd()), '/')
+        self.assertEqual(self.server.stats['connects'], 1)
+        pool.close()
+
+    def test_dropped_session(self):
+        pool = FTPPool(1)
+        pool.run(lambda ftp: ftp.pwd())
+        self.assertTrue(self.server.wait_for('disconnects', 1))  # idle session dropped by server
+        self.assertEqual(pool.run(lambda ftp: ftp.pwd()), '/')  # 421 or EOF, retried on new session
+        self.assertEqual(self.server.stats['connects'], 2)
+        pool.close()
+
+    def test_connection_errors_retried(self):
+        pool = FTPPool(1, retries=2)
+        attempts = []
+
+        def flaky(ftp):
+            attempts.append(ftp)
+            if len(attempts) < 3:
+                raise EOFError()
+            return ftp.pwd()
+        self.assertEqual(pool.run(flaky), '/')
+        self.assertEqual(len(set(attempts)), 3)  # new session for each retry
+
+        def broken(ftp):
+            raise EOFError()
+        self.assertRaises(RuntimeError, pool.run, broken)
+
+        def failing(ftp):
+            raise ValueError("not a connection error")
+        self.assertRaises(ValueError, pool.run, failing)
+        self.assertEqual(pool.run(lambda ftp: ftp.pwd()), '/')  # session kept
+        pool.close()
+
+
+@unittest.skipIf(LocalFTPServer is None, "requires pyftpdlib")
+class testFTPStore(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFTPServer(idle_timeout=1).start()  # drop idle sessions quickly
+        self.root_dir = self.server.root_dir
+        self.old_config = (config.FTP_HOST, config.FTP_PORT, config.FTP_USER, config.FTP_PWD)
+        self.server.configure(config)
+
+    def tearDown(self):
+        config.FTP_HOST, config.FTP_PORT, config.FTP_USER, config.FTP_PWD = self.old_config
+        self.server.stop()
+
+    def test_put_size_delete(self):
+        store = FTPStore(2)
+        img_path = store.put('files/a/b/', 'c.png', io.BytesIO('png data'))
+        self.assertEqual(img_path, 'files/a/b/c.png')
+        with open(os.path.join(self.root_dir, 'files', 'a', 'b', 'c.png'), 'rb') as img_file:
+            self.assertEqual(img_file.read(), 'png data')
+        self.assertEqual(store.size(img_path), len('png data'))
+        body = io.BytesIO('partial')
+        self.assertTrue(store.retrieve(img_path, body))
+        self.assertEqual(body.getvalue(), 'png data')
+        self.assertTrue(store.delete(img_path))
+        self.assertFalse(store.retrieve(img_path, io.BytesIO()))
+        self.assertEqual(store.size(img_path), None)
+        self.assertFalse(store.delete(img_path))
+        store.close()
+
+    def test_known_dirs(self):
+        store = FTPStore(1)
+        store.put('files/a/b/', 'c.png', io.BytesIO('png data'))
+        self.server.reset_stats()
+        store.put('files/a/b/', 'd.png', io.BytesIO('png data'))
+        store.put('files/a/', 'e.png', io.BytesIO('png data'))  # parent known as well
+        self.assertEqual((self.server.stats['STOR'], self.server.stats['NLST']), (2, 0))
+        self.assertEqual((self.server.stats['MKD'], self.server.stats['CWD']), (0, 0))
+        store.close()
+
+    def test_mkd_failed_not_known(self):
+        read_only = os.path.join(self.root_dir, 'files', 'ro')
+        os.mkdir(read_only)
+        with open(os.path.join(read_only, 'other.png'), 'wb') as img_file:
+            img_file.write('png data')  # listed, not taken as missing
+        self.server.server.handler.authorizer.override_perm('leanote', read_only, 'elr', recursive=True)
+        store = FTPStore(1)
+        self.assertRaises(RuntimeError, store.put, 'files/ro/x/', 'c.png', io.BytesIO('png data'))
+        self.assertEqual(self.server.stats['MKD'], 1)
+        self.assertNotIn('files/ro/x/', store._known_dirs)
+
+        # created meanwhile, checked again
+        os.mkdir(os.path.join(read_only, 'x'))
+        self.server.server.handler.authorizer.override_perm('leanote', read_only, 'elradfmw', recursive=True)
+        self.server.reset_stats()
+        self.assertEqual(store.put('files/ro/x/', 'c.png', io.BytesIO('png data')), 'files/ro/x/c.png')
+        self.assertTrue(self.server.stats['NLST'] > 0)  # probed again, not cached as known
+        self.assertIn('files/ro/x/', store._known_dirs)
+        store.close()
+
+    def test_parallel_uploads_reconnect(self):
+        handler = ImageHandler(FTPStore(3))
+        tasks = [handler.submit('a/%s' % (n % 2), '%s.png' % n, 'data %s' % n) for n in range(6)]
+        handler.wait(tasks)
+        # sessions dropped by server (421 timeout)
+        self.assertTrue(self.server.wait_for('disconnects', self.server.stats['connects']))
+        self.assertTrue(handler.upload_image('a/0', 'late.png', 'late').endswith('/late.png'))
+        handler.close()
+        for n in list(range(6)) + ['late']:
+            self.assertTrue(os.path.isfile(os.path.join(self.root_dir, 'files', 'a', '0' if n == 'late' else str(n % 2), '%s.png' % n)))
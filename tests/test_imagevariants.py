@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import unittest
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from geeknote import config
+from geeknote.imagevariants import ImageVariants, make_variants, parse_variants
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mongofixture import UpdateNoteTestCase, note_xml, media
+
+VARIANTS = [('web', 200), ('thumb', 50)]
+
+
+def noise_image(width, height, mode='RGB'):
+    """ png of random pixels, does not compress """
+    image = Image.frombytes(mode, (width, height), os.urandom(width * height * len(mode)))
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+def variants_in_worker(data):
+    """ runs in a daemonic pool worker, which cannot fork a process pool """
+    variants = ImageVariants(VARIANTS, 1)
+    try:
+        return isinstance(variants._pool, ThreadPool), [variant['Name'] for variant in variants.submit(data).get()]
+    finally:
+        variants.close()
+
+
+@unittest.skipIf(Image is None, "requires Pillow")
+class testImageVariants(unittest.TestCase):
+
+    def check_variant(self, variant, image_format, size):
+        image = Image.open(io.BytesIO(variant['Data']))
+        self.assertEqual(image.format, image_format)
+        self.assertEqual(image.size, size)
+        self.assertEqual((variant['Width'], variant['Height']), size)
+
+    def test_parse_variants(self):
+        self.assertEqual(parse_variants('web:1600, thumb:240,'), [('web', 1600), ('thumb', 240)])
+        self.assertEqual(parse_variants(None), [])
+
+    def test_make_variants(self):
+        data = noise_image(400, 300)
+        web, thumb = make_variants(data, VARIANTS)
+        self.assertEqual((web['Name'], web['Extension'], thumb['Name'], thumb['Extension']),
+                         ('web', 'jpg', 'thumb', 'jpg'))
+        self.check_variant(web, 'JPEG', (200, 150))
+        self.check_variant(thumb, 'JPEG', (50, 37))
+        self.assertTrue(len(thumb['Data']) < len(web['Data']) < len(data))
+
+    def test_transparent(self):
+        thumb, = make_variants(noise_image(100, 80, 'RGBA'), VARIANTS)
+        self.assertEqual(thumb['Extension'], 'png')
+        self.check_variant(thumb, 'PNG', (50, 40))
+        self.assertEqual(Image.open(io.BytesIO(thumb['Data'])).mode, 'RGBA')
+
+    def test_kept_as_is(self):
+        self.assertEqual(make_variants(noise_image(40, 30), VARIANTS), [])  # small already
+        self.assertEqual(make_variants('<svg/>', VARIANTS), [])  # not an image for PIL
+
+    def test_process_pool(self):
+        variants = ImageVariants(VARIANTS, 1)
+        self.assertFalse(isinstance(variants._pool, ThreadPool))
+        self.assertEqual([variant['Name'] for variant in variants.submit(noise_image(400, 300)).get(10)],
+                         ['web', 'thumb'])
+        variants.close()
+
+    def test_daemonic_process(self):
+        pool = multiprocessing.Pool(1)
+        try:
+            in_threads, names = pool.apply(variants_in_worker, (noise_image(400, 300),))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(in_threads)
+        self.assertEqual(names, ['web', 'thumb'])
+
+
+@unittest.skipIf(Image is None, "requires Pillow")
+class testVariantUploads(UpdateNoteTestCase):
+
+    def import_image(self, image_variants):
+        self.old_variants = (config.IMAGE_VARIANTS, config.IMAGE_VARIANT_PROCESSES)
+        config.IMAGE_VARIANTS, config.IMAGE_VARIANT_PROCESSES = image_variants, 1
+        try:
+            updater = self.updater()
+        finally:
+            config.IMAGE_VARIANTS, config.IMAGE_VARIANT_PROCESSES = self.old_variants
+        data = noise_image(400, 300)
+        note, = self.parse(note_xml('note', media(data), resources=[(data, 'image/png', None)]))
+        updater.update(note)
+        updater.finish()
+        return self.db.files.find_one()
+
+    def test_variants(self):
+        file_obj = self.import_image('web:200,thumb:50')
+        web, thumb = file_obj['Variants']
+        self.assertEqual((web['Name'], web['Width'], web['Height']), ('web', 200, 150))
+        self.assertEqual((thumb['Name'], thumb['Width'], thumb['Height']), ('thumb', 50, 37))
+        base_path = file_obj['Path'].rsplit('.', 1)[0]
+        self.assertEqual(web['Path'], base_path + '.web.jpg')
+        for variant in (web, thumb):
+            self.assertEqual(len(self.stored(variant['Path'])), variant['Size'])
+
+    def test_variants_off(self):
+        file_obj = self.import_image(None)
+        self.assertNotIn('Variants', file_obj)
+        image_dir = os.path.dirname(os.path.join(self.store_dir, *file_obj['Path'].split('/')))
+        self.assertEqual(os.listdir(image_dir), [file_obj['Name']])
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import hashlib
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from bson.objectid import ObjectId
+from geeknote import config, mongo2enex
+from geeknote.mongo2enex import EnexWriter, MongoExporter
+from geeknote.enexparser import EnexParser
+from geeknote.imagehandler import LocalStore
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+ENML = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">\n' \
+    '<en-note><div>]]&gt; x</div><en-media hash="%s" type="image/png"/></en-note>'
+
+
+class testEnexWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.enex_path = os.path.join(self.tmp_dir, 'notebook.enex')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_parse(self):
+        body = os.urandom(3 * mongo2enex.ENCODE_CHUNK_SIZE + 5)
+        body_hash = hashlib.md5(body).hexdigest()
+        writer = EnexWriter(self.enex_path)
+        writer.start_note(u't\xfctel <&>', ENML % body_hash, datetime(2019, 1, 2, 3, 4, 5), None, [u'a', u'b&c'])
+        self.assertEqual(writer.resource(io.BytesIO(body), 'image/png', u'b\xe4d.png'), len(body))
+        writer.end_note()
+        writer.start_note('second', ENML % 'none')
+        writer.end_note()
+        self.assertFalse(os.path.exists(self.enex_path))
+        writer.close()
+
+        notes = list(EnexParser(self.enex_path).parse())
+        self.assertEqual(len(notes), 2)
+        note = notes[0]
+        self.assertEqual(note.title, u't\xfctel <&>')
+        self.assertEqual(note.content, ENML % body_hash)
+        self.assertEqual((note.created.year, note.created.second, note.updated.year), (2019, 5, 1970))
+        self.assertEqual(note.tags, [u'a', u'b&c'])
+        resource = note.get_image_resource({'hash': body_hash})
+        self.assertEqual((resource.mime_type, resource.filename), ('image/png', u'b\xe4d.png'))
+        self.assertEqual(resource.data.body, body)
+        self.assertEqual(notes[1].resources, [])
+
+    def test_abort(self):
+        writer = EnexWriter(self.enex_path)
+        writer.abort()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class testMongoExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = LocalStore(self.tmp_dir)
+        self.db = mongomock.MongoClient().db
+        self.user = {"_id": ObjectId()}
+        self.notebook = {"_id": ObjectId(), "Title": "notebook"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_image(self, name, stored=True):
+        if stored:
+            self.store.put('files/u1/', name + '.png', io.BytesIO('png ' + name))
+        return self.db.files.insert_one({"UserId": self.user['_id'], "Path": 'files/u1/%s.png' % name,
+                                         "Title": name + '.png', "Hash": name}).inserted_id
+
+    def test_missing_stored_file(self):
+        present, missing = self.add_image('present'), self.add_image('missing', stored=False)
+        note_id = self.db.notes.insert_one({"NotebookId": self.notebook['_id'], "UserId": self.user['_id'],
+                                            "Title": "note", "Usn": 3}).inserted_id
+        self.db.note_contents.insert_one({"_id": note_id, "Content": '<p><img src="/api/file/getImage?fileId=%s"/>'
+                                          '<img src="/api/file/getImage?fileId=%s"/></p>' % (present, missing)})
+        enex_path = os.path.join(self.tmp_dir, 'notebook.enex')
+        exporter = MongoExporter(self.db, self.user, self.store)
+        self.assertEqual(exporter.export_notebook(self.notebook, enex_path), (1, 3))
+
+        note, = EnexParser(enex_path).parse()
+        self.assertIn('<en-media hash="present" type="image/png"', note.content)
+        # element of the missing image is kept, no en-media without resource
+        self.assertIn('fileId=%s' % missing, note.content)
+        self.assertNotIn('hash="missing"', note.content)
+        self.assertEqual([resource.data.body for resource in note.resources], ['png present'])
+
+    def test_since_usn_kept_apart(self):
+        # export of changes does not replace the full export
+        self.db.users.insert_one({"_id": self.user['_id'], "Username": config.DB_USERNAME})
+        self.db.notebooks.insert_one(dict(self.notebook, UserId=self.user['_id']))
+        for title, usn in (('old', 3), ('new', 5)):
+            note_id = self.db.notes.insert_one({"NotebookId": self.notebook['_id'], "UserId": self.user['_id'],
+                                                "Title": title, "Usn": usn}).inserted_id
+            self.db.note_contents.insert_one({"_id": note_id, "Content": '<p>%s</p>' % title})
+        output = os.path.join(self.tmp_dir, 'backup')
+        old_argv, old_client, old_store = sys.argv, mongo2enex.MongoClient, mongo2enex.get_image_store
+        mongo2enex.MongoClient = lambda *args, **kwargs: {config.DB_NAME: self.db}
+        mongo2enex.get_image_store = lambda db: self.store
+        try:
+            for args in ([], ['--since-usn', '3']):
+                sys.argv = ['mongo2enex.py', output] + args
+                mongo2enex.main()
+        finally:
+            sys.argv, mongo2enex.MongoClient, mongo2enex.get_image_store = old_argv, old_client, old_store
+
+        self.assertEqual(mongo2enex.export_dir(output, 3), os.path.join(output, 'usn3'))
+        self.assertEqual(sorted(note.title for note in EnexParser(os.path.join(output, 'notebook.enex')).parse()),
+                         ['new', 'old'])
+        self.assertEqual([note.title for note in EnexParser(os.path.join(output, 'usn3', 'notebook.enex')).parse()],
+                         ['new'])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime
+from bson.objectid import ObjectId
+from geeknote.notehistory import NoteHistory, make_delta, apply_delta, pack_delta, unpack_delta, tokenize
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+OLD = '<?xml version="1.0" encoding="UTF-8"?>\n<en-note><div>first</div><div>Gr\xc3\xbc\xc3\x9fe</div>' \
+    + '<div>unchanged paragraph</div>' * 200 + '<div>last</div></en-note>'
+NEW = '<?xml version="1.0" encoding="UTF-8"?>\n<en-note><div>first, edited</div>' \
+    + '<div>unchanged paragraph</div>' * 200 + '<div>last</div><div>appended</div></en-note>'
+
+
+class testNoteHistory(unittest.TestCase):
+
+    def test_tokenize_lossless(self):
+        self.assertEqual(u''.join(tokenize(OLD)), OLD.decode('utf-8'))
+        self.assertEqual(tokenize(''), [])
+
+    def test_restore_older(self):
+        ops = make_delta(NEW, OLD)
+        self.assertEqual(apply_delta(NEW, ops), OLD.decode('utf-8'))
+
+    def test_restore_from_empty(self):
+        self.assertEqual(apply_delta(u'', make_delta(u'', OLD)), OLD.decode('utf-8'))
+        self.assertEqual(apply_delta(NEW, make_delta(NEW, u'')), u'')
+
+    def test_packed_delta_small(self):
+        data = pack_delta(make_delta(NEW, OLD))
+        self.assertTrue(len(data) < len(OLD) / 10)
+        self.assertEqual(apply_delta(NEW, unpack_delta(data)), OLD.decode('utf-8'))
+
+    def test_chain(self):
+        versions = [OLD, NEW, NEW.replace('last', 'final'), u'<en-note>rewritten</en-note>']
+        deltas = [make_delta(versions[i + 1], versions[i]) for i in range(len(versions) - 1)]
+        content = versions[-1]
+        for i in reversed(range(len(deltas))):
+            content = apply_delta(content, deltas[i])
+            self.assertEqual(content, versions[i].decode('utf-8') if isinstance(versions[i], str) else versions[i])
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class testNoteHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.history = NoteHistory(self.db, max_versions=3)
+        self.note_id = ObjectId()
+        self.user_id = ObjectId()
+
+    def add(self, old, new, n):
+        self.history.add(self.note_id, self.user_id, old, new, datetime(2020, 1, n), self.user_id)
+
+    def contents(self):
+        return [content for updated, content in self.history.versions(self.note_id)]
+
+    def test_versions(self):
+        versions = [OLD, NEW, NEW.replace('last', 'final'), u'<en-note>rewritten</en-note>']
+        for n in range(1, len(versions)):
+            self.add(versions[n - 1], versions[n], n)
+        self.add(versions[-1], versions[-1], 9)  # unchanged, no version
+        expected = [content.decode('utf-8') if isinstance(content, str) else content for content in versions[:-1]]
+        self.assertEqual(self.contents(), list(reversed(expected)))
+        stored = self.db.note_content_histories.find_one({"_id": self.note_id})
+        self.assertEqual(stored["UserId"], self.user_id)
+        self.assertEqual([version["UpdatedTime"].day for version in stored["Versions"]], [3, 2, 1])
+        # newest is a snapshot, older ones are deltas
+        self.assertEqual(["Snapshot" in version for version in stored["Versions"]], [True, False, False])
+
+        self.add(versions[-1], u'<en-note>again</en-note>', 4)
+        self.assertEqual(self.contents(), [versions[-1]] + list(reversed(expected))[:2])  # capped
+
+    def test_edited_in_leanote(self):
+        self.add(OLD, NEW, 1)
+        # note edited in leanote, so its content is not what was imported last
+        edited = NEW.replace('first, edited', 'edited in leanote')
+        self.db.note_content_histories.update_one(
+            {"_id": self.note_id}, {"$push": {"Histories": {"Content": NEW, "UpdatedTime": datetime(2020, 1, 2)}}})
+        self.add(edited, u'<en-note>imported again</en-note>', 3)
+        self.assertEqual(self.contents(), [edited.decode('utf-8'), OLD.decode('utf-8')])
+        # leanote's own history is kept
+        self.assertEqual(len(self.db.note_content_histories.find_one({"_id": self.note_id})["Histories"]), 1)
+
+    def test_purge(self):
+        self.add(OLD, NEW, 1)
+        self.history.purge(self.note_id)
+        self.assertEqual(self.contents(), [])
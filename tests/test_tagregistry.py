@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from geeknote.tagregistry import TagRegistry, ensure_indexes
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+CREATED = datetime(2019, 8, 21, 13, 36)
+UPDATED = datetime(2019, 8, 22, 9, 0)
+
+
+class TagRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.user_id = self.db.users.insert_one({"Username": "user", "Usn": 100}).inserted_id
+        self.db.tags.insert_one({"_id": self.user_id, "Tags": ["", "old"]})
+        self.db.note_tags.insert_one({"UserId": self.user_id, "Tag": "old", "Count": 3, "Usn": 7})
+
+    def reserve_usns(self, count):
+        db_user = self.db.users.find_one_and_update({"_id": self.user_id}, {"$inc": {"Usn": count}},
+                                                    return_document=True)
+        return db_user['Usn'] - count + 1
+
+    def note_tag(self, tag_name):
+        return self.db.note_tags.find_one({"UserId": self.user_id, "Tag": tag_name})
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class testTagRegistry(TagRegistryTestCase):
+
+    def test_adjust_flush(self):
+        tags = TagRegistry(self.db, self.user_id)
+        self.assertFalse(tags.dirty)
+        tags.add_user_tag('New')
+        tags.adjust('new', +1, CREATED, UPDATED)
+        tags.adjust('new', +1, CREATED, UPDATED)
+        tags.adjust('old', -1, CREATED, UPDATED)
+        tags.adjust('unknown', -1, CREATED, UPDATED)  # not counted, ignored
+        tags.adjust('', +1, CREATED, UPDATED)
+        self.assertEqual(tags.count('new'), 2)
+        self.assertEqual(tags.count('old'), 2)
+        self.assertEqual(self.note_tag('old')['Count'], 3)  # nothing written before flush
+        self.assertTrue(tags.dirty)
+
+        self.assertEqual(tags.flush(self.reserve_usns), 2)
+        self.assertFalse(tags.dirty)
+        self.assertEqual(set(self.db.tags.find_one({"_id": self.user_id})['Tags']), set(["", "old", "new"]))
+        new_tag, old_tag = self.note_tag('new'), self.note_tag('old')
+        self.assertEqual((new_tag['Count'], old_tag['Count']), (2, 2))
+        self.assertEqual(new_tag['CreatedTime'], CREATED)
+        self.assertFalse(new_tag['IsDeleted'])
+        # one usn per changed tag, reserved in a single $inc
+        self.assertEqual(sorted([new_tag['Usn'], old_tag['Usn']]), [101, 102])
+        self.assertEqual(self.db.users.find_one({"_id": self.user_id})['Usn'], 102)
+        self.assertEqual(self.note_tag('unknown'), None)
+        self.assertEqual(tags.flush(self.reserve_usns), 0)
+        self.assertEqual(self.db.users.find_one({"_id": self.user_id})['Usn'], 102)
+
+    def test_concurrent_counts(self):
+        # other importer changed counts meanwhile, deltas are added ($inc) instead of overwriting
+        tags = TagRegistry(self.db, self.user_id)
+        self.db.note_tags.update_one({"UserId": self.user_id, "Tag": "old"}, {"$inc": {"Count": 5}})
+        tags.adjust('old', +1, CREATED, UPDATED)
+        tags.flush(self.reserve_usns)
+        self.assertEqual(self.note_tag('old')['Count'], 9)
+
+    def test_new_user_tags(self):
+        self.db.tags.delete_many({})
+        tags = TagRegistry(self.db, self.user_id)
+        self.assertTrue(tags.dirty)
+        tags.flush(self.reserve_usns)
+        self.assertEqual(self.db.tags.find_one({"_id": self.user_id})['Tags'], [""])
+
+
+@unittest.skipIf(mongomock is None, "requires mongomock")
+class testTagRegistryConcurrent(TagRegistryTestCase):
+    """ concurrent importers, see ensure_indexes """
+
+    def test_ensure_indexes(self):
+        ensure_indexes(self.db)
+        self.assertRaises(DuplicateKeyError, self.db.note_tags.insert_one,
+                          {"UserId": self.user_id, "Tag": "old", "Count": 1})
+
+    def test_ensure_indexes_duplicates(self):
+        # duplicates from before, no index, but no error either
+        self.db.note_tags.insert_one({"UserId": self.user_id, "Tag": "old", "Count": 1})
+        ensure_indexes(self.db)
+        self.db.note_tags.insert_one({"UserId": self.user_id, "Tag": "old", "Count": 1})
+        self.assertEqual(self.db.note_tags.count_documents({"Tag": "old"}), 3)
+
+    def test_duplicate_key_retry(self):
+        tags = TagRegistry(self.db, self.user_id)
+        tags.adjust('new', +1, CREATED, UPDATED)
+        tags.adjust('old', +1, CREATED, UPDATED)
+        bulk_write = self.db.note_tags.bulk_write
+        calls = []
+
+        def racing_bulk_write(requests, ordered=True):
+            calls.append(len(requests))
+            if len(calls) == 1:
+                # other importer created "new" meanwhile, upsert of "old" succeeded
+                bulk_write(requests[1:], ordered=ordered)
+                self.db.note_tags.insert_one({"UserId": self.user_id, "Tag": "new", "Count": 1})
+                raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}]})
+            return bulk_write(requests, ordered=ordered)
+        self.db.note_tags.bulk_write = racing_bulk_write
+        tags.flush(self.reserve_usns)
+        self.assertEqual(calls, [2, 1])  # only the failed upsert retried
+        self.assertEqual(self.note_tag('new')['Count'], 2)
+        self.assertEqual(self.note_tag('old')['Count'], 4)
+
+    def test_other_write_errors_raised(self):
+        tags = TagRegistry(self.db, self.user_id)
+        tags.adjust('new', +1, CREATED, UPDATED)
+
+        def failing_bulk_write(requests, ordered=True):
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 121, "errmsg": "validation failed"}]})
+        self.db.note_tags.bulk_write = failing_bulk_write
+        self.assertRaises(BulkWriteError, tags.flush, self.reserve_usns)
+
+    def test_user_tags_duplicate_retry(self):
+        tags = TagRegistry(self.db, self.user_id)
+        tags.add_user_tag('new')
+        update_one = self.db.tags.update_one
+        calls = []
+
+        def racing_update_one(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise DuplicateKeyError("E11000 duplicate key")
+            return update_one(*args, **kwargs)
+        self.db.tags.update_one = racing_update_one
+        tags.flush(self.reserve_usns)
+        self.assertEqual(len(calls), 2)
+        self.assertIn("new", self.db.tags.find_one({"_id": self.user_id})['Tags'])
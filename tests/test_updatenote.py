@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import hashlib
+from geeknote import config, updatenote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mongofixture import UpdateNoteTestCase, note_xml, media
+
+
+class testTags(UpdateNoteTestCase):
+
+    def tag_counts(self):
+        """ note_tags count and number of notes with tag, per tag """
+        counts = dict((note_tag['Tag'], [note_tag['Count'], 0]) for note_tag in self.db.note_tags.find())
+        for db_note in self.db.notes.find():
+            for tag_name in db_note.get('Tags', []):
+                if tag_name:
+                    counts.setdefault(tag_name, [0, 0])[1] += 1
+        return dict((tag_name, tuple(count)) for tag_name, count in counts.items())
+
+    def test_stopped_import(self):
+        notes = self.parse(*[note_xml('note %s' % n, tags=['a'], created='2019010%sT120000Z' % n)
+                             for n in range(1, 6)])
+        old_interval = updatenote.TAG_FLUSH_INTERVAL
+        updatenote.TAG_FLUSH_INTERVAL = 2
+        try:
+            updater = self.updater()
+            for note in notes[:3]:
+                updater.update(note)
+            updater.close()  # stopped, e.g. ConnectionFailure, finish() not reached
+        finally:
+            updatenote.TAG_FLUSH_INTERVAL = old_interval
+        # tag lists of the notes are written with their counts
+        self.assertEqual(self.tag_counts(), {'a': (2, 2), 'notebook': (2, 2)})
+
+        updater = self.updater()
+        for note in notes:
+            updater.update(note)
+        updater.finish()
+        self.assertEqual(self.tag_counts(), {'a': (5, 5), 'notebook': (5, 5)})
+
+
+class testNoteContent(UpdateNoteTestCase):
+
+    def test_content_write_failed(self):
+        note, = self.parse(note_xml('note', '<div>text</div>'))
+        insert_one = self.db.note_contents.insert_one
+
+        def failing_insert_one(document):
+            raise IOError("connection lost")
+        self.db.note_contents.insert_one = failing_insert_one
+        self.assertRaises(IOError, self.updater().update, note)
+        self.db.note_contents.insert_one = insert_one
+        self.assertEqual(self.db.notes.count_documents({}), 0)
+
+        # no notes entry with content hash, the next import writes the note
+        self.assertTrue(self.updater().update(note))
+        db_note = self.db.notes.find_one()
+        self.assertIn('<div>text</div>', self.db.note_contents.find_one({"_id": db_note["_id"]})["Content"])
+        self.assertFalse(self.updater().update(note))
+
+
+IMAGE = 'png data'
+
+
+class testImagePresent(UpdateNoteTestCase):
+
+    def setUp(self):
+        UpdateNoteTestCase.setUp(self)
+        first, = self.parse(note_xml('first', media(IMAGE), resources=[(IMAGE, 'image/png', None)]))
+        self.updater().update(first)
+        self.imported = 1
+        self.file_obj = self.db.files.find_one()
+        self.assertEqual(self.stored(self.file_obj['Path']), IMAGE)
+
+    def uploads(self, updater):
+        """ names of images uploaded by updater, recorded """
+        store = updater.imghandler.store
+        put = store.put
+        uploaded = []
+
+        def recording_put(img_dir, img_name, fp):
+            uploaded.append(img_name)
+            return put(img_dir, img_name, fp)
+        store.put = recording_put
+        return uploaded
+
+    def import_other(self, **kwargs):
+        """ import another note with the same image, return uploaded images """
+        self.imported += 1
+        note, = self.parse(note_xml('note %s' % self.imported, media(IMAGE), created='2019010%sT120000Z' % self.imported,
+                                    resources=[(IMAGE, 'image/png', None)]))
+        updater = self.updater(**kwargs)
+        uploaded = self.uploads(updater)
+        updater.update(note)
+        updater.finish()
+        return uploaded
+
+    def test_same_hash_and_size(self):
+        self.assertEqual(self.import_other(), [])
+        self.assertEqual(self.db.files.count_documents({}), 1)
+        self.assertEqual(self.db.note_images.count_documents({"ImageId": self.file_obj['_id']}), 2)
+
+    def test_size_mismatch(self):
+        self.db.files.update_one({"_id": self.file_obj['_id']}, {"$set": {"Size": 3}})
+        self.assertEqual(self.import_other(), [self.file_obj['Name']])
+        self.assertEqual(self.db.files.find_one()['Size'], len(IMAGE))  # what is stored now
+
+    def test_hash_mismatch(self):
+        self.db.files.update_one({"_id": self.file_obj['_id']}, {"$set": {"Hash": 'other'}})
+        self.assertEqual(self.import_other(), [self.file_obj['Name']])
+        self.assertEqual(self.db.files.find_one()['Hash'], self.file_obj['Hash'])
+
+    def test_failed_in_queue(self):
+        queue_dir = os.path.join(self.tmp_dir, 'queue', 'notebook')
+        os.makedirs(queue_dir)
+        img_dir, img_name = self.file_obj['Path'].rsplit('/', 1)
+        with open(os.path.join(queue_dir, 'job1.data'), 'wb') as data_file:
+            data_file.write(IMAGE)
+        with open(os.path.join(queue_dir, 'job1.json'), 'w') as json_file:
+            json.dump({"Dir": img_dir + '/', "Name": img_name, "Size": len(IMAGE), "Queued": "2019-01-01T00:00:00",
+                       "Attempts": 5, "Failed": True, "Error": "connection lost"}, json_file)
+        old_config = (config.UPLOAD_QUEUE, config.UPLOAD_QUEUE_DIR)
+        config.UPLOAD_QUEUE, config.UPLOAD_QUEUE_DIR = True, os.path.join(self.tmp_dir, 'queue')
+        try:
+            self.assertEqual(self.import_other(), [img_name])
+        finally:
+            config.UPLOAD_QUEUE, config.UPLOAD_QUEUE_DIR = old_config
+        self.assertEqual(os.listdir(queue_dir), [])  # failed job replaced, then uploaded
+
+    def test_verify(self):
+        self.assertEqual(self.import_other(verify_images=True), [])
+        os.remove(os.path.join(self.store_dir, *self.file_obj['Path'].split('/')))
+        self.assertEqual(self.import_other(), [])  # files entry trusted
+        self.assertEqual(self.import_other(verify_images=True), [self.file_obj['Name']])
+        self.assertEqual(self.stored(self.file_obj['Path']), IMAGE)
+
+
+PDF = '%PDF-1.4 attachment'
+
+
+class testAttachments(UpdateNoteTestCase):
+
+    def import_note(self, text, resources, updated='20190102T120000Z'):
+        """ import (version of) note, return names of uploaded attachments """
+        note, = self.parse(note_xml('note', text, updated=updated, resources=resources))
+        updater = self.updater()
+        store = updater.imghandler.store
+        put = store.put
+        uploaded = []
+
+        def recording_put(img_dir, img_name, fp):
+            uploaded.append(img_name)
+            return put(img_dir, img_name, fp)
+        store.put = recording_put
+        updater.update(note)
+        updater.finish()
+        return uploaded
+
+    def attachs(self):
+        return [(attach_obj['Title'], attach_obj['Type'], self.stored(attach_obj['Path']))
+                for attach_obj in self.db.attachs.find()]
+
+    def test_new(self):
+        other = '%PDF-1.4 other'
+        self.import_note(media(PDF, 'application/pdf') + media(other, 'application/pdf'),
+                         [(PDF, 'application/pdf', 'report.pdf'), (other, 'application/pdf', None)])
+        # without file name, named by hash
+        self.assertEqual(sorted(self.attachs()), sorted([
+            (u'report.pdf', u'pdf', PDF),
+            (u'%s.pdf' % hashlib.md5(other).hexdigest(), u'pdf', other),
+        ]))
+        self.assertEqual(self.db.notes.find_one()['AttachNum'], 2)
+
+    def test_unchanged(self):
+        self.import_note(media(PDF, 'application/pdf'), [(PDF, 'application/pdf', 'report.pdf')])
+        attach_obj = self.db.attachs.find_one()
+        uploaded = self.import_note('changed ' + media(PDF, 'application/pdf'), [(PDF, 'application/pdf', 'report.pdf')],
+                                    updated='20190103T120000Z')
+        self.assertEqual(uploaded, [])
+        self.assertEqual(list(self.db.attachs.find()), [attach_obj])
+
+    def test_unresolved(self):
+        # resource missing in the new version, entry kept as the content still refers to it
+        self.import_note(media(PDF, 'application/pdf'), [(PDF, 'application/pdf', 'report.pdf')])
+        self.import_note('changed ' + media(PDF, 'application/pdf'), [], updated='20190103T120000Z')
+        self.assertEqual(self.attachs(), [(u'report.pdf', u'pdf', PDF)])
+        self.assertEqual(self.db.notes.find_one()['AttachNum'], 1)
+
+    def test_removed(self):
+        self.import_note(media(PDF, 'application/pdf'), [(PDF, 'application/pdf', 'report.pdf')])
+        path = self.db.attachs.find_one()['Path']
+        self.import_note('no attachment', [], updated='20190103T120000Z')
+        self.assertEqual(self.attachs(), [])
+        self.assertIsNone(self.stored(path))
+        self.assertEqual(self.db.notes.find_one()['AttachNum'], 0)
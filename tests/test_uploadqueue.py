@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from geeknote.imagehandler import ImageHandler, LocalStore
+from geeknote.uploadqueue import UploadQueue, queue_report
+
+
+class FlakyStore(LocalStore):
+    """ local store failing the first uploads """
+
+    def __init__(self, base_dir, failures):
+        LocalStore.__init__(self, base_dir)
+        self.failures = failures
+
+    def put(self, img_dir, img_name, fp):
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError("connection lost")
+        return LocalStore.put(self, img_dir, img_name, fp)
+
+
+class testUploadQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.base_dir, 'queue')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def stored(self, img_path):
+        with open(os.path.join(self.base_dir, *img_path.split('/')), 'rb') as img_file:
+            return img_file.read()
+
+    def test_upload_with_retry(self):
+        queue = UploadQueue(self.queue_dir, ImageHandler(FlakyStore(self.base_dir, 2)), retry_delay=0)
+        img_path = queue.put('u1/a', 'b.png', 'png data').wait()
+        self.assertEqual(img_path, 'files/u1/a/b.png')
+        queue.close()
+        self.assertEqual(self.stored(img_path), 'png data')
+        self.assertEqual(queue_report(self.queue_dir), ([], []))
+
+    def test_failed_and_resumed(self):
+        queue = UploadQueue(self.queue_dir, ImageHandler(FlakyStore(self.base_dir, 10)),
+                            max_attempts=2, retry_delay=0)
+        img_path = queue.put('u1/a', 'b.png', 'png data').wait()
+        queue.close()
+        pending, failed = queue_report(self.queue_dir)
+        self.assertEqual(pending, [])
+        self.assertEqual([(info['Name'], info['Attempts']) for info in failed], [('b.png', 2)])
+
+        queue = UploadQueue(self.queue_dir, ImageHandler(LocalStore(self.base_dir)))
+        self.assertEqual(queue.retry_failed(), 1)
+        queue.close()
+        self.assertEqual(self.stored(img_path), 'png data')
+        self.assertEqual(queue_report(self.queue_dir), ([], []))
+
+    def test_failed_replaced(self):
+        queue = UploadQueue(self.queue_dir, ImageHandler(FlakyStore(self.base_dir, 2)),
+                            max_attempts=2, retry_delay=0)
+        img_path = queue.put('u1/a', 'b.png', 'png data').wait()
+        queue.wait()
+        self.assertTrue(queue.failed(img_path))
+        queue.close()
+
+        # known as failed to next run, queued again for the same image replaces the failed job
+        queue = UploadQueue(self.queue_dir, ImageHandler(LocalStore(self.base_dir)))
+        self.assertTrue(queue.failed(img_path))
+        self.assertFalse(queue.failed('files/u1/a/c.png'))
+        queue.put('u1/a', 'b.png', 'png data 2')
+        self.assertFalse(queue.failed(img_path))
+        queue.close()
+        self.assertEqual(self.stored(img_path), 'png data 2')
+        self.assertEqual(queue_report(self.queue_dir), ([], []))
+
+    def test_failed_in_other_queue(self):
+        # same image failed in the queue of another notebook
+        other_dir = os.path.join(self.base_dir, 'queues', 'other')
+        queue = UploadQueue(other_dir, ImageHandler(FlakyStore(self.base_dir, 2)), max_attempts=1, retry_delay=0)
+        img_path = queue.put('u1/a', 'b.png', 'png data').wait()
+        queue.close()
+
+        queue_dir = os.path.join(self.base_dir, 'queues', 'notebook')
+        queue = UploadQueue(queue_dir, ImageHandler(LocalStore(self.base_dir)))
+        self.assertFalse(queue.failed(img_path))  # own queue only
+        queue.close()
+        queue = UploadQueue(queue_dir, ImageHandler(LocalStore(self.base_dir)),
+                            base_dir=os.path.join(self.base_dir, 'queues'))
+        self.assertTrue(queue.failed(img_path))
+        queue.put('u1/a', 'b.png', 'png data 2')
+        self.assertFalse(queue.failed(img_path))
+        queue.close()
+        self.assertEqual(self.stored(img_path), 'png data 2')
+        self.assertEqual(queue_report(other_dir), ([], []))
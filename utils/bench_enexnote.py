@@ -0,0 +1,117 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+microbenchmark of note metadata extraction (EnNote) on synthetic notes
+
+compares the single pass over the children of <note> with fixed-format
+timestamp parsing against the former extraction (an xpath per field,
+dateutil.parser for timestamps); notes are parsed beforehand, only the
+extraction is timed
+"""
+
+import sys
+import time
+import argparse
+
+from lxml import etree
+import dateutil.parser
+import pytz
+
+from geeknote.enexparser import EnNote, ENResource, parse_date
+
+NOTE = '''<note><title>note %(n)s</title><content><![CDATA[<en-note><div>note %(n)s</div></en-note>]]></content>
+<created>2019%(month)02d%(day)02dT12%(minute)02d00Z</created><updated>2019%(month)02d%(day)02dT13%(minute)02d00Z</updated>
+<tag>bench</tag><tag>tag%(tag)s</tag>
+<note-attributes><author>bench</author></note-attributes>
+<resource><data encoding="base64">iVBORw0KGgo=</data><mime>image/png</mime>
+<resource-attributes><file-name>image%(n)s.png</file-name></resource-attributes></resource>
+</note>'''
+
+
+def make_notes(count):
+    """ list of parsed <note> elements """
+    xml = ''.join(NOTE % {'n': n, 'month': n % 12 + 1, 'day': n % 28 + 1, 'minute': n % 60, 'tag': n % 10}
+                  for n in range(count))
+    return list(etree.fromstring('<en-export>%s</en-export>' % xml))
+
+
+class LegacyResource(ENResource):
+    """ former resource info extraction """
+
+    def _extract_resource_info(self, resource):
+        self.mime_type = resource.xpath('mime')[0].text
+        fn_node = resource.xpath('resource-attributes/file-name')
+        self.filename = fn_node[0].text if fn_node else 'unnamed'
+        data_node = resource.xpath('data')[0]
+        if data_node.attrib.get('encoding') == "base64":
+            self._encoded = data_node.text
+
+
+class LegacyNote(EnNote):
+    """ former note info extraction """
+
+    def _extract_dateval(self, note, date_field):
+        if note.xpath(date_field):
+            date_value = note.xpath(date_field)[0].text
+        else:
+            date_value = '19700101T000000Z'
+        date_value = dateutil.parser.parse(date_value)
+        if date_value.tzinfo is None:
+            date_value = pytz.utc.localize(date_value)
+        return date_value
+
+    def _extract_note_info(self, note):
+        self.title = note.xpath('title')[0].text
+        self.created = self._extract_dateval(note, 'created')
+        self.updated = self._extract_dateval(note, 'updated')
+        self.tags = [tag.text for tag in note.xpath('tag')]
+        content = note.xpath('content')
+        self.content = content[0].text if content else ''
+        self.resources = []
+        for resource in note.xpath('resource'):
+            resource_obj = LegacyResource(resource)
+            if resource_obj.has_data:
+                self.resources.append(resource_obj)
+        self._resource_index = {}
+        self._decoded = 0
+
+
+def timed(func, items):
+    start = time.time()
+    for item in items:
+        func(item)
+    return time.time() - start
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, default=100000, help='synthetic notes')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    notes = make_notes(args.notes)
+    timestamps = [note.find('created').text for note in notes]
+
+    # same result either way
+    for note in notes[:100]:
+        legacy, current = LegacyNote(note), EnNote(note)
+        assert (legacy.title, legacy.created, legacy.updated, legacy.tags, legacy.content) == \
+            (current.title, current.created, current.updated, current.tags, current.content)
+        assert [(r.mime_type, r.filename) for r in legacy.resources] == \
+            [(r.mime_type, r.filename or 'unnamed') for r in current.resources]  # now None if unknown
+
+    print("%10s %20s %10s %14s" % ('items', 'measurement', 'secs', 'us/item'))
+    for name, func, items in (
+            ('dateutil.parser', dateutil.parser.parse, timestamps),
+            ('parse_date', parse_date, timestamps),
+            ('legacy EnNote', LegacyNote, notes),
+            ('EnNote', EnNote, notes)):
+        elapsed = timed(func, items)
+        print("%10s %20s %10.2f %14.1f" % (len(items), name, elapsed, elapsed * 1e6 / len(items)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
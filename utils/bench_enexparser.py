@@ -0,0 +1,125 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+benchmark peak memory (RSS) and time of parsing large (synthetic) .enex files
+
+compares the incremental EnexParser (lxml parser target, see NoteTarget)
+and EnexIndex (same parser on the byte range of each note) with the former
+approach (etree.parse of the whole file, then xpath('//note')); each
+measurement runs in a new process, as peak RSS cannot be reset. resources
+are decoded (hash) as on import; with a single note and a large resource
+(--notes 1 --resource-size 100000000) the parse column shows that memory
+does not grow with the resource
+"""
+
+import os
+import sys
+import time
+import base64
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from lxml import etree
+
+from geeknote.enexparser import EnexParser, EnNote
+from geeknote.enexindex import EnexIndex
+
+
+ENEX_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">\n' \
+    '<en-export export-date="20191020T120000Z" application="Evernote/Windows" version="6.x">\n'
+
+NOTE = '''<note><title>note %(n)s</title><content><![CDATA[<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
+<en-note><div>%(text)s</div><en-media hash="%(hash)s" type="image/png"/></en-note>]]></content>
+<created>20190101T120000Z</created><updated>20190102T120000Z</updated><tag>bench</tag>
+<resource><data encoding="base64">
+%(data)s
+</data><mime>image/png</mime><resource-attributes><file-name>image%(n)s.png</file-name></resource-attributes></resource>
+</note>
+'''
+
+
+def make_enex(path, notes, resource_size):
+    """ write .enex with notes each having text and one resource """
+    body = os.urandom(resource_size)
+    data = base64.encodestring(body)
+    text = 'lorem ipsum dolor sit amet ' * 200
+    with open(path, 'wb') as enex_file:
+        enex_file.write(ENEX_HEAD)
+        for n in range(notes):
+            enex_file.write(NOTE % {'n': n, 'text': text, 'hash': '%032x' % n, 'data': data})
+        enex_file.write('</en-export>\n')
+
+
+def legacy_parse(enex_path):
+    """ former EnexParser.parse """
+    parser = etree.XMLParser(huge_tree=True, resolve_entities=False)
+    xml_tree = etree.parse(enex_path, parser)
+    for note in xml_tree.xpath('//note'):
+        yield EnNote(note)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1024.0 / 1024.0  # bytes
+    return peak / 1024.0  # kilobytes
+
+
+def measure(mode, enex_path):
+    """ parse enex in this process, print notes, seconds and peak RSS """
+    baseline = peak_rss_mb()
+    if mode == 'legacy':
+        parse = legacy_parse(enex_path)
+    elif mode == 'index':
+        parse = EnexIndex(enex_path).parse()
+    else:
+        parse = EnexParser(enex_path).parse()
+    start = time.time()
+    count = 0
+    for note in parse:
+        count += 1
+        for resource in note.resources:
+            resource.hash
+    print("%s %.3f %.1f %.1f" % (count, time.time() - start, peak_rss_mb(), baseline))
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, nargs='+', default=[200, 1000, 4000], help='notes per .enex')
+    parser.add_argument('--resource-size', type=int, default=100000, help='bytes per resource')
+    parser.add_argument('--measure', nargs=2, metavar=('MODE', 'ENEX'), help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    if args.measure:
+        measure(*args.measure)
+        return 0
+
+    print("%8s %10s %10s %12s %12s %12s" % ('notes', 'size [MB]', 'mode', 'time [s]', 'peak [MB]', 'parse [MB]'))
+    for notes in args.notes:
+        fd, enex_path = tempfile.mkstemp(suffix='.enex')
+        os.close(fd)
+        try:
+            make_enex(enex_path, notes, args.resource_size)
+            size = os.path.getsize(enex_path) / 1024.0 / 1024.0
+            EnexIndex(enex_path).build()
+            for mode in ('legacy', 'target', 'index'):
+                output = subprocess.check_output([sys.executable, __file__, '--measure', mode, enex_path])
+                count, elapsed, peak, baseline = output.split()
+                print("%8s %10.1f %10s %12s %12s %12.1f" % (
+                    count, size, mode, elapsed, peak, float(peak) - float(baseline)))
+        finally:
+            os.remove(enex_path)
+            if os.path.exists(enex_path + '.idx'):
+                os.remove(enex_path + '.idx')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
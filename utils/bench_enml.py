@@ -0,0 +1,91 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+benchmark ENML image rewrite on large (synthetic) clipped web pages
+
+compares the single lxml pass of geeknote.enml with the former approach
+(BeautifulSoup/lxml to list images, then BeautifulSoup/html.parser to fix refs)
+"""
+
+import sys
+import argparse
+import random
+import timeit
+
+from bs4 import BeautifulSoup
+
+from geeknote.enml import EnmlContent, IMAGE_URL
+
+
+ENML_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">\n'
+
+
+def make_clip(blocks, images):
+    """ generate web clip like ENML with nested divs, tables and images """
+    rnd = random.Random(blocks * 1000 + images)
+    image_every = max(1, blocks // max(images, 1))
+    parts = [ENML_HEAD, '<en-note><div style="font-family: Arial;">']
+    for block in range(blocks):
+        parts.append('<div><h2>Section %s</h2><p style="margin:0">' % block)
+        parts.append(' '.join('word%s' % rnd.randint(0, 10000) for _ in range(40)))
+        parts.append('&nbsp;<a href="https://example.com/%s">link</a></p>' % block)
+        parts.append('<table><tr><td>a</td><td><span>b</span></td></tr></table><div></div>')
+        if images and block % image_every == 0:
+            img_hash = '%032x' % rnd.getrandbits(128)
+            parts.append('<img src="file:/C:/Temp/enhtmlclip/Image%s.jpg"/>' % block)
+            parts.append('<en-media hash="%s" type="image/jpeg"></en-media>' % img_hash)
+        parts.append('</div>')
+    parts.append('</div></en-note>')
+    return ''.join(parts)
+
+
+def legacy_rewrite(content):
+    """ former UpdateNote.get_images + _fixup_img_refs """
+    soup = BeautifulSoup(content, features="lxml")
+    img_map = {}
+    for section in soup.findAll('en-media'):
+        if 'type' in section.attrs and 'hash' in section.attrs:
+            imageType, imageExtension = section['type'].split('/')
+            if imageType == "image":
+                img_map[section['hash']] = {'ImageId': section['hash'][:24]}
+
+    soup = BeautifulSoup(content, 'html.parser')
+    for img_tag in soup.select('img'):
+        next_elmt = img_tag.next_sibling
+        if next_elmt and next_elmt.name == 'en-media':
+            img_tag.extract()
+    for en_media in soup.findAll('en-media'):
+        if en_media['hash'] in img_map:
+            newTag = soup.new_tag("img")
+            newTag['src'] = IMAGE_URL % img_map[en_media['hash']]['ImageId']
+            en_media.replace_with(newTag)
+    return str(soup)
+
+
+def enml_rewrite(content):
+    return EnmlContent(content).rewrite(lambda info: info['hash'][:24])
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, nargs='+', default=[100, 1000, 5000], help='content blocks per note')
+    parser.add_argument('--images', type=int, default=50, help='images per note')
+    parser.add_argument('--repeat', type=int, default=5, help='rewrites per measurement')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    print("%8s %10s %12s %12s %8s" % ('blocks', 'size', 'legacy [ms]', 'enml [ms]', 'speedup'))
+    for blocks in args.blocks:
+        content = make_clip(blocks, args.images)
+        legacy = min(timeit.repeat(lambda: legacy_rewrite(content), number=1, repeat=args.repeat))
+        single = min(timeit.repeat(lambda: enml_rewrite(content), number=1, repeat=args.repeat))
+        print("%8s %10s %12.1f %12.1f %7.1fx" % (
+            blocks, len(content), legacy * 1000, single * 1000, legacy / single))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
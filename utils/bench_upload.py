@@ -0,0 +1,193 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+benchmark image uploads against a local ftp stand-in (utils/ftp_standin.py)
+
+uploads synthetic images of different sizes through ImageHandler / FTPStore
+and reports uploads per second, ftp round trips (commands) per image and
+the cost of reconnecting. with --notebook, synthetic notes with images are
+imported through UpdateNote as well - into the configured mongodb (DB_URI,
+DB_NAME, DB_USERNAME), use a test database
+"""
+
+import os
+import sys
+import time
+import uuid
+import hashlib
+import argparse
+import logging
+import tempfile
+
+from ftp_standin import LocalFTPServer
+
+from geeknote import config
+from geeknote import tools
+from geeknote.imagehandler import ImageHandler, FTPStore
+
+
+ENML = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">\n' \
+    '<en-note><div>%s</div>%s</en-note>'
+
+
+def make_image(size):
+    """ incompressible image body of given size """
+    return os.urandom(size)
+
+
+def upload_images(server, connections, count, size, user_id='5d9b3f1e2c7a4b0001a1b2c3'):
+    """ upload count images, return (seconds, stats) """
+    images = [make_image(size) for _ in range(min(count, 16))]
+    server.reset_stats()
+    store = FTPStore(connections)
+    handler = ImageHandler(store)
+    start = time.time()
+    tasks = []
+    for n in range(count):
+        guid = uuid.uuid4().hex
+        tasks.append(handler.submit(tools.get_random_filepath(user_id, guid), guid + '.png', images[n % len(images)]))
+    handler.wait(tasks)
+    elapsed = time.time() - start
+    handler.close()
+    return elapsed, dict(server.stats)
+
+
+def connect_cost(server, count=20):
+    """ seconds per ftp connect + login """
+    store = FTPStore(1)
+    start = time.time()
+    for _ in range(count):
+        ftp = store.pool._connect()
+        ftp.quit()
+    return (time.time() - start) / count
+
+
+def reconnect_run(server, connections, count, size, idle):
+    """ upload batches with warm sessions and after the server dropped idle sessions
+
+    return seconds for warm batch and batch after timeout, connects during the latter
+    """
+    store = FTPStore(connections)
+    handler = ImageHandler(store)
+    image = make_image(size)
+    timings = []
+    for batch in range(3):
+        if batch == 2:
+            time.sleep(idle)
+        server.reset_stats()
+        start = time.time()
+        tasks = [handler.submit('reconnect/', '%s-%s.png' % (batch, n), image) for n in range(count)]
+        handler.wait(tasks)
+        timings.append(time.time() - start)
+    handler.close()
+    return timings[1], timings[2], server.stats['connects']
+
+
+class SyntheticNote:
+    """ note with images, as UpdateNote expects from EnNote / EN api """
+
+    class Resource:
+        class Data:
+            pass
+
+        def __init__(self, body):
+            self.data = self.Data()
+            self.data.body = body
+            self.data.size = len(body)
+
+    def __init__(self, n, images):
+        self.title = 'bench upload %s' % n
+        self.tagNames = []
+        self.created = self.updated = int(time.time() * 1000) + n
+        self.resources = {}
+        media = []
+        for body in images:
+            img_hash = hashlib.md5(body).hexdigest()
+            self.resources[img_hash] = self.Resource(body)
+            media.append('<en-media hash="%s" type="image/png"></en-media>' % img_hash)
+        self.content = ENML % (self.title, ''.join(media))
+
+    def load_tags(self):
+        pass
+
+    def load_content(self):
+        pass
+
+    def get_image_resource(self, imageInfo):
+        return self.resources.get(imageInfo['hash'])
+
+
+def import_notes(server, notebook, notes, images_per_note, size, queue_dir=None):
+    """ import synthetic notes through UpdateNote, return seconds till all images are stored """
+    from geeknote.updatenote import UpdateNote
+    config.IMAGE_STORE = 'ftp'
+    config.UPLOAD_QUEUE = queue_dir is not None
+    config.UPLOAD_QUEUE_DIR = queue_dir
+    updater = UpdateNote(notebook)
+    try:
+        server.reset_stats()
+        start = time.time()
+        for n in range(notes):
+            updater.update(SyntheticNote(n, [make_image(size) for _ in range(images_per_note)]))
+        processed = time.time() - start
+        updater.finish()
+    finally:
+        updater.close()
+    return processed, time.time() - start, dict(server.stats)
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 200000, 2000000], help='image sizes [bytes]')
+    parser.add_argument('--count', type=int, default=100, help='images per measurement')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 4], help='ftp sessions')
+    parser.add_argument('--latency', type=float, default=5.0, help='delay per ftp command [ms]')
+    parser.add_argument('--notebook', help='also import notes into notebooks of this name (writes to mongodb)')
+    parser.add_argument('--notes', type=int, default=20, help='notes to import with --notebook')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    idle_timeout = 1
+    server = LocalFTPServer(latency=args.latency / 1000.0, idle_timeout=idle_timeout).start()
+    server.configure(config)
+    try:
+        print("latency %.1f ms per command, connect + login %.1f ms\n" % (
+            args.latency, connect_cost(server) * 1000))
+
+        print("%10s %6s %6s %9s %9s %9s %10s" % (
+            'size', 'conns', 'count', 'secs', 'uploads/s', 'MB/s', 'cmds/image'))
+        for size in args.sizes:
+            for connections in args.connections:
+                elapsed, stats = upload_images(server, connections, args.count, size)
+                print("%10s %6s %6s %9.2f %9.1f %9.2f %10.2f" % (
+                    size, connections, args.count, elapsed, args.count / elapsed,
+                    args.count * size / elapsed / 1e6, float(stats['commands']) / args.count))
+
+        connections = max(args.connections)
+        warm, after_timeout, connects = reconnect_run(
+            server, connections, args.count, min(args.sizes), idle_timeout + 1)
+        print("\nreconnect: %s images with %s warm sessions %.2fs, after idle timeout %.2fs "
+              "(%s reconnects, %.1f ms each)" % (
+                  args.count, connections, warm, after_timeout, connects,
+                  (after_timeout - warm) * 1000 / max(connects, 1)))
+
+        if args.notebook:
+            print("\n%12s %6s %14s %14s %10s" % ('mode', 'notes', 'notes secs', 'stored secs', 'cmds/image'))
+            images = 3
+            for mode in ('direct', 'queue'):
+                queue_dir = tempfile.mkdtemp(prefix='upload_queue_') if mode == 'queue' else None
+                processed, stored, stats = import_notes(
+                    server, '%s %s' % (args.notebook, mode), args.notes, images, min(args.sizes), queue_dir)
+                print("%12s %6s %14.2f %14.2f %10.2f" % (
+                    mode, args.notes, processed, stored, float(stats.get('commands', 0)) / (args.notes * images)))
+    finally:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -55,6 +55,8 @@ class CleanMongoDB:
         self.db.note_tags.remove({})
         logger.info("removing %s files ...", self.db.files.count())
         self.db.files.remove({})
+        logger.info("removing %s attachs ...", self.db.attachs.count())
+        self.db.attachs.remove({})
         if 0:
             logger.info("removing %s tag_count objs ...", self.db.tag_count.count())
             self.db.tag_count.remove({})
@@ -2,22 +2,38 @@
 # -*- coding: utf-8 -*-
 """
 ls for notes in .enex files - list title, size, created, updated
+
+with --format csv / json notes (and with --stats aggregates: count, sizes,
+size histogram, resources) are written to stdout, streaming through the
+.enex without parsing notes or decoding resources; with --sort and --limit
+only the top notes are kept (heap), instead of sorting all
 """
 import sys
 import os
+import csv
+import json
+import heapq
+import bisect
+import itertools
 import argparse
 from datetime import datetime
 import dateutil
 
 import warnings
 
-from geeknote.enexparser import EnexParser
+from geeknote.enexparser import EnexParser, parse_date, EPOCH, list_enex_files
+from geeknote.enexindex import EnexIndex, scan_file
 import geeknote.config as config
 
 import logging
 
 warnings.filterwarnings("ignore", message="Unicode equal comparison failed to convert both arguments to Unicode")
 
+NOTE_FIELDS = ['notebook', 'title', 'size', 'created', 'updated', 'resources', 'resource_bytes']
+STATS_FIELDS = ['notebook', 'notes', 'size', 'resources', 'resource_bytes']
+SIZE_BUCKET_LIMITS = [1000, 10000, 100000, 1000000]  # content size histogram
+SIZE_BUCKETS = ['<1k', '<10k', '<100k', '<1M', '>=1M']
+
 
 class SortNote:
 
@@ -58,53 +74,197 @@ def get_note_updated(note):
     return updated
 
 
-def list_notes(enex_path, notebook_name, args):
-    logger.info("%s:", notebook_name)
-    enex_parser = EnexParser(enex_path)
-    notes = []
-    notes_count = 0
-    for note in enex_parser.parse():
-        notes_count += 1
-        info = {}
-        note_size = len(note.content)
-        if args.minsize and note_size < args.minsize:
-            continue
-        info['size'] = note_size
-        info['updated'] = get_note_updated(note)
-        info['title'] = note.title
-        notes.append(info)
-    logger.info("total %s", notes_count)  # len(notes))
+def parse_notes(enex_path):
+    """ yield info on notes in .enex, parsing it (size in characters) """
+    for note in EnexParser(enex_path).parse():
+        yield {'title': note.title, 'size': len(note.content), 'created': note.created,
+               'updated': get_note_updated(note), 'resources': len(note.resources), 'resource_bytes': None}
+
+
+def entry_info(entry):
+    """ info on note from .enex index entry (size in bytes) """
+    created = parse_date(entry['created'] or EPOCH)
+    updated = parse_date(entry['updated'] or entry['created'] or EPOCH)
+    if updated.year == 1970:
+        updated = created
+    return {'title': entry['title'] or u'', 'size': entry['size'], 'created': created, 'updated': updated,
+            'resources': entry['resources'], 'resource_bytes': entry['resource_bytes']}
+
+
+def indexed_notes(enex_path):
+    """ yield info on notes in .enex from its index (built if missing) """
+    for entry in EnexIndex(enex_path).load():
+        yield entry_info(entry)
+
+
+def scanned_notes(enex_path):
+    """ yield info on notes in .enex, streaming through it without parsing notes or decoding resources """
+    for entry in scan_file(enex_path):
+        yield entry_info(entry)
+
+
+class NoteStats:
+    """ aggregates on notes: count, sizes, size histogram, resources """
 
+    def __init__(self, notebook):
+        self.notebook = notebook
+        self.notes = 0
+        self.size = 0
+        self.resources = 0
+        self.resource_bytes = 0
+        self.histogram = [0] * len(SIZE_BUCKETS)
+
+    def add(self, info):
+        self.notes += 1
+        self.size += info['size']
+        self.resources += info['resources']
+        self.resource_bytes += info['resource_bytes'] or 0
+        self.histogram[bisect.bisect_right(SIZE_BUCKET_LIMITS, info['size'])] += 1
+
+    def update(self, other):
+        self.notes += other.notes
+        self.size += other.size
+        self.resources += other.resources
+        self.resource_bytes += other.resource_bytes
+        self.histogram = [mine + theirs for mine, theirs in zip(self.histogram, other.histogram)]
+
+    def as_dict(self):
+        info = dict((field, getattr(self, field)) for field in STATS_FIELDS[:5])
+        info.update(zip(SIZE_BUCKETS, self.histogram))
+        return info
+
+
+def counted(notes, stats):
+    for info in notes:
+        stats.add(info)
+        yield info
+
+
+def select_notes(notes, args):
+    """ notes to list, filtered and ordered as of args - streamed unless sorted """
+    if args.minsize:
+        notes = (info for info in notes if info['size'] >= args.minsize)
     if args.sort:  # sorting on notes list
         sort_notes = SortNote(args)
-        notes = sorted(notes, key=sort_notes)
+        if args.limit:  # top-k heap instead of sorting all
+            select = heapq.nlargest if args.reverse else heapq.nsmallest
+            return select(args.limit, notes, key=sort_notes)
+        return sorted(notes, key=sort_notes, reverse=args.reverse)
     if args.reverse:
-        notes = reversed(notes)
+        notes = reversed(list(notes))
+    if args.limit:
+        notes = itertools.islice(notes, args.limit)
+    return notes
 
-    for info in notes:
-        updated = info['updated'] or info['created']
-        updated = updated.strftime("%c")  # TODO fix timezone issues (on Windows e.g.)
+
+class TextOutput:
+    """ notes and stats logged, as readable text """
+
+    def note(self, notebook_name, info):
+        updated = info['updated'].strftime("%c")  # TODO fix timezone issues (on Windows e.g.)
         # datetime.now(dateutil.tz.tzlocal()).tzname()
         # datetime.utcnow().astimezone().tzinfo
-        title = info['title']
+        title = info['title'] or u''
         if len(title) > 60:
             title = title[:60] + '..'
         # TODO adjust title encoding to match console codepage - assume latin-1 for now
-        if isinstance(title, unicode):
-            # title = title.encode('latin-1', 'xmlcharrefreplace')
-            # title = unicode(title, 'utf-8')
-            title = title
         logger.info("%8s %12s %s", info['size'], updated, title)
-    logger.info("")
-    return
+
+    def stats(self, stats):
+        logger.info("%s: %s notes, %s bytes content, %s resources (%s bytes)",
+                    stats.notebook, stats.notes, stats.size, stats.resources, stats.resource_bytes)
+        logger.info("  content size %s", ', '.join(
+            '%s: %s' % bucket for bucket in zip(SIZE_BUCKETS, stats.histogram)))
+
+    def close(self):
+        pass
+
+
+class CsvOutput:
+    """ notes as csv on stdout, stats as second table following them """
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.writer = csv.writer(out)
+        self.writer.writerow(NOTE_FIELDS)
+        self.stats_rows = []
+
+    def note(self, notebook_name, info):
+        row = [notebook_name] + [info[field] for field in NOTE_FIELDS[1:]]
+        self.writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else
+                              value.isoformat() if isinstance(value, datetime) else value for value in row])
+
+    def stats(self, stats):
+        info = stats.as_dict()
+        self.stats_rows.append([info[field] for field in STATS_FIELDS + SIZE_BUCKETS])
+
+    def close(self):
+        if self.stats_rows:
+            self.out.write('\n')
+            self.writer.writerow(STATS_FIELDS + SIZE_BUCKETS)
+            self.writer.writerows(self.stats_rows)
+        self.out.flush()
+
+
+class JsonOutput:
+    """ notes and stats as json lines on stdout """
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+
+    def _write(self, info):
+        self.out.write(json.dumps(info, default=lambda value: value.isoformat()) + '\n')
+
+    def note(self, notebook_name, info):
+        self._write(dict(info, type='note', notebook=notebook_name))
+
+    def stats(self, stats):
+        self._write(dict(stats.as_dict(), type='stats'))
+
+    def close(self):
+        self.out.flush()
+
+
+OUTPUTS = {'text': TextOutput, 'csv': CsvOutput, 'json': JsonOutput}
+
+
+def list_notes(enex_path, notebook_name, args, output=None):
+    """ list notes of .enex to output, return their NoteStats """
+    output = output or TextOutput()
+    if args.format == 'text':
+        logger.info("%s:", notebook_name)
+    if args.index:
+        notes = indexed_notes(enex_path)
+    elif args.stats or args.format != 'text':
+        notes = scanned_notes(enex_path)
+    else:
+        notes = parse_notes(enex_path)
+    stats = NoteStats(notebook_name)
+    for info in select_notes(counted(notes, stats), args):
+        output.note(notebook_name, info)
+    for info in notes:
+        stats.add(info)  # not consumed by listing limited number of notes
+    if args.format == 'text':
+        logger.info("total %s", stats.notes)
+    if args.stats:
+        output.stats(stats)
+    if args.format == 'text':
+        logger.info("")
+    return stats
 
 
 def get_argparse():
     parser = argparse.ArgumentParser()
-    parser.add_argument('enexdir', help='directory with .enex files to list notes for')
+    parser.add_argument('enexdir', help='directory with .enex files (also .enex.gz, .enex.zst) to list notes for')
     parser.add_argument('--sort', help='sort by WORD instead of name (size, time)')
     parser.add_argument('--reverse', '-r', action='store_true', help='reverse order while sorting')
     parser.add_argument('--minsize', help='list only notes larger than given size', type=int, default=0)
+    parser.add_argument('--index', action='store_true',
+                        help='list from .enex.idx sidecar index (size in bytes), build index if missing or stale')
+    parser.add_argument('--format', choices=sorted(OUTPUTS), default='text',
+                        help='output format, csv and json (lines) are written to stdout (size in bytes)')
+    parser.add_argument('--stats', action='store_true', help='output aggregates per notebook and total')
+    parser.add_argument('--limit', type=int, default=0, help='list only first N notes per notebook (as sorted)')
     return parser
 
 
@@ -116,15 +276,18 @@ def main():
     try:
         enex_dir = args.enexdir
         assert os.path.isdir(enex_dir), "directory not found: %s" % enex_dir
-        enex_files = [fn for fn in os.listdir(enex_dir) if fn.endswith('.enex')]
+        enex_files = list_enex_files(enex_dir)
         if not enex_files:
             logger.info("no .enex files found in %s", enex_dir)
             return
-        for enex_file in enex_files:
-            # assume .enex file name matches notebook name - what is when created using evernote-backup.cmd
-            notebook_name = os.path.splitext(os.path.basename(enex_file))[0]
-            enex_path = os.path.join(enex_dir, enex_file)
-            list_notes(enex_path, notebook_name, args)
+        output = OUTPUTS[args.format]()
+        total = NoteStats('(total)')
+        # assume .enex file name matches notebook name - what is when created using evernote-backup.cmd
+        for enex_path, notebook_name in enex_files:
+            total.update(list_notes(enex_path, notebook_name, args, output))
+        if args.stats and len(enex_files) > 1:
+            output.stats(total)
+        output.close()
         logger.info("enex_list_notes done.")
 
     except Exception as err:
@@ -0,0 +1,141 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+local stand-in for the leanote ftp host (requires pyftpdlib)
+
+serves a (temporary) directory, counts connections and commands, can add
+latency to each command to mimic a remote host and drop idle sessions
+(421 Timeout) like the production server does
+
+    python utils/ftp_standin.py --port 2121 --latency 20
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import collections
+import logging
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+FTP_USER = 'leanote'
+FTP_PWD = 'leanote'
+
+# pyftpdlib logs each command / transfer, to stderr if not configured otherwise
+logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+
+
+class CountingHandler(FTPHandler):
+    """ ftp handler counting commands, delayed by latency seconds each """
+
+    stats = None
+    latency = 0.0
+
+    def on_connect(self):
+        self.stats['connects'] += 1
+
+    def on_disconnect(self):
+        self.stats['disconnects'] += 1
+
+    def pre_process_command(self, line, cmd, arg):
+        self.stats['commands'] += 1
+        self.stats[cmd] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        FTPHandler.pre_process_command(self, line, cmd, arg)
+
+
+class LocalFTPServer:
+    """ ftp server on localhost, run in a background thread """
+
+    def __init__(self, root_dir=None, port=0, latency=0.0, idle_timeout=300):
+        self.own_dir = root_dir is None
+        self.root_dir = root_dir or tempfile.mkdtemp(prefix='ftp_standin_')
+        if not os.path.isdir(os.path.join(self.root_dir, 'files')):
+            os.mkdir(os.path.join(self.root_dir, 'files'))  # like leanote's base dir
+        self.stats = collections.Counter()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(FTP_USER, FTP_PWD, self.root_dir, perm='elradfmw')
+
+        class Handler(CountingHandler):
+            pass
+        Handler.authorizer = authorizer
+        Handler.stats = self.stats
+        Handler.latency = latency
+        Handler.timeout = idle_timeout
+        self.server = ThreadedFTPServer(('127.0.0.1', port), Handler)
+        self.host, self.port = self.server.address[:2]
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='ftp-standin')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False, handle_exit=False)
+        self.server.close_all()
+
+    def configure(self, config):
+        """ point config (geeknote.config) to this server """
+        config.FTP_HOST = self.host
+        config.FTP_PORT = self.port
+        config.FTP_USER = FTP_USER
+        config.FTP_PWD = FTP_PWD
+
+    def reset_stats(self):
+        self.stats.clear()
+
+    def wait_for(self, key, count, timeout=10.0):
+        """ wait until stats[key] reaches count, e.g. idle sessions dropped; False on timeout """
+        deadline = time.time() + timeout
+        while self.stats[key] < count:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.own_dir:
+            shutil.rmtree(self.root_dir, ignore_errors=True)
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='directory to serve, default temporary directory')
+    parser.add_argument('--port', type=int, default=2121)
+    parser.add_argument('--latency', type=float, default=0.0, help='delay per command [ms]')
+    parser.add_argument('--idle-timeout', type=int, default=300, help='drop idle sessions after [s]')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    server = LocalFTPServer(args.dir, args.port, args.latency / 1000.0, args.idle_timeout).start()
+    print("serving %s on ftp://%s:%s@%s:%s/ - ctrl-c to stop" % (
+        server.root_dir, FTP_USER, FTP_PWD, server.host, server.port))
+    try:
+        while 1:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    print(dict(server.stats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+""" remove images no longer referenced by any note (files, note_images and image store)
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+from pymongo import MongoClient
+
+from geeknote import config
+from geeknote.imagehandler import get_image_store
+from geeknote.imagegc import ImageGC, BATCH_SIZE
+
+
+# set default logger (write log to file)
+def_logpath = os.path.join(config.APP_DIR, 'gc_images.log')
+formatter = logging.Formatter('%(asctime)-15s : %(message)s')
+handler = logging.FileHandler(def_logpath)
+handler.setFormatter(formatter)
+
+logger = logging.getLogger("en2mongo")
+logger.setLevel(os.environ.get('LOGLEVEL') or logging.INFO)
+logger.addHandler(handler)
+logger.addHandler(logging.StreamHandler(sys.stderr))
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true', help='report unreferenced images only, remove nothing')
+    parser.add_argument('--db-only', action='store_true', help='do not delete images from the image store')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='files removed per batch')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    logger.debug('gc images, args: %s', repr(args))
+
+    try:
+        db = MongoClient(config.DB_URI, tz_aware=False)[config.DB_NAME]
+        user = db.users.find_one({"Username": config.DB_USERNAME})
+        assert user is not None, "failed to lookup db user %s" % config.DB_USERNAME
+        store = None
+        if not args.db_only and not args.dry_run:
+            store = get_image_store(db)
+        try:
+            ImageGC(db, user['_id'], store, args.batch_size).run(args.dry_run)
+        finally:
+            if store is not None:
+                store.close()
+
+    except Exception:
+        logger.exception("gc images failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python2 # noqa: E902
+# -*- coding: utf-8 -*-
+"""
+report on the local image upload queue (pending and failed uploads),
+optionally retry failed uploads / drain the queue now
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+from geeknote import config
+from geeknote.uploadqueue import UploadQueue, queue_dirs, queue_report
+
+
+logger = logging.getLogger("en2mongo")
+logger.setLevel(os.environ.get('LOGLEVEL') or logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stderr))
+
+
+def print_jobs(title, jobs):
+    print("%s: %s" % (title, len(jobs)))
+    for info in jobs:
+        print("  %s  %s%s  %s bytes, %s attempts  %s" % (
+            info.get('Queued'), info['Dir'], info['Name'], info.get('Size'),
+            info.get('Attempts', 0), info.get('Error') or ''))
+
+
+def get_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue-dir', default=config.UPLOAD_QUEUE_DIR,
+                        help='upload queue base directory (with a queue per notebook)')
+    parser.add_argument('--retry', action='store_true', help='retry failed uploads')
+    parser.add_argument('--drain', action='store_true', help='upload pending images now')
+    return parser
+
+
+def main():
+    args = get_argparse().parse_args()
+    queue_dirs_found = queue_dirs(args.queue_dir)
+    if args.retry or args.drain:
+        from geeknote.imagehandler import ImageHandler, get_image_store
+        db = None
+        if config.IMAGE_STORE == 'gridfs':
+            from pymongo import MongoClient
+            db = MongoClient(config.DB_URI)[config.DB_NAME]
+        handler = ImageHandler(get_image_store(db))
+        for queue_dir in queue_dirs_found:
+            queue = UploadQueue(queue_dir, handler)
+            if args.retry:
+                logger.info("retrying %s failed uploads in %s", queue.retry_failed(), queue_dir)
+            queue.close()
+            queue.report()
+        handler.close()
+
+    failed_count = 0
+    for queue_dir in queue_dirs_found:
+        pending, failed = queue_report(queue_dir)
+        print("%s:" % queue_dir)
+        print_jobs("pending", pending)
+        print_jobs("failed", failed)
+        failed_count += len(failed)
+    return 1 if failed_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())